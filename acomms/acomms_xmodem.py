@@ -1,18 +1,27 @@
 #__author__ = 'andrew'
 
 #This is an implementation of the Xmodem Protocol modified for the Microcmodem IO methods.
-from .messageparams import Rates, FDPRates, data_from_hexstring, hexstring_from_data
+from .messageparams import Rates, DataFrame, data_from_hexstring, hexstring_from_data
+from . import compression
+from .ratecontrol import AUTO
+from .transferjournal import TransferJournal
+from .txscheduler import SENT
 from .unifiedlog import UnifiedLog
 from acomms import Micromodem
 from queue import Queue,Empty,Full
+from concurrent.futures import Future
 import crcmod
-import time
+import io
 import os
+import struct
+import uuid
 
 class acomms_xymodem(object):
     '''
     XMODEM Like Protocol handler, expects an object to read from and an object to
     write to.
+    :param rate: Packet rate, 0-6, or 'auto' to have the modem's RateController
+                 choose the rate of each data packet as it is sent.
     :type mode: string
     :param pad: Padding character to make the packets match the packet size
     :type pad: char
@@ -20,9 +29,13 @@ class acomms_xymodem(object):
 
     def __init__(self, micromodem, dest,rate = 1, timeout=60,pad='\x1a',ymodem_enabled = True,unified_log=None,log_path=None, ):
         assert isinstance(micromodem, Micromodem), "micromodem object isn't a Micromodem: %r" & micromodem
+        #With 'auto', this is only the first choice: see _select_rate.
+        self.auto_rate = rate == AUTO
+        if self.auto_rate:
+            rate = micromodem.rate_controller.select_rate(dest)
         assert rate in range(0,7), "Invalid Rate: %d" & rate
         assert dest != micromodem.id, "Can't send file to self."
-        self.pad = pad
+        self.pad = pad.encode('latin-1') if isinstance(pad, str) else pad
 
         self.rate = Rates[rate]
         self.micromodem = micromodem
@@ -41,19 +54,31 @@ class acomms_xymodem(object):
         self.micromodem.ack_listeners.append(self.ack_recv)
         self.ack_list = Queue()
 
-    SOH = '0001'
-    STX = '0002'
-    EOT = '0004'
-    ACK = '0006'
-    DLE = '0010'
-    NAK = '0015'
-    CAN = '0018'
-    CRC = '0043'
+    #Control characters are sent as bytes, like the data.
+    SOH = b'0001'
+    STX = b'0002'
+    EOT = b'0004'
+    ACK = b'0006'
+    DLE = b'0010'
+    NAK = b'0015'
+    CAN = b'0018'
+    CRC = b'0043'
+    #Resume offset, sent by the receiver after the ymodem header.
+    RSM = b'0012'
 
     CRC_BIT_ID = 0xF000
     SEQ_NUM_BIT_ID = 0x0F00
     MAX_SEQ_NUM = 256
 
+    def _select_rate(self):
+        '''
+        With rate='auto', choose the rate again from what the modem has heard
+        of the link lately.
+        '''
+        if self.auto_rate:
+            self.rate = Rates[self.micromodem.rate_controller.select_rate(self.target_id)]
+            self.fsk_mode = self.rate.number == 0
+
     def ack_recv(self,ack,msg):
         self.micromodem._daemon_log.info("Ack Received: {}".format(ack))
         self.ack_list.put_nowait(ack)
@@ -66,15 +91,14 @@ class acomms_xymodem(object):
                 print(("Acking Minipacket Data: {}".format(data)))
                 self.micromodem.send_minipacket(dest_id=self.target_id,databytes=self.ACK)
                 self.micromodem.wait_for_xst(timeout)
-                time.sleep(delay)
+                self.micromodem.clock.sleep(delay)
             return data
         else:
             data = self.micromodem.wait_for_data_packet(fsk=self.fsk_mode,timeout=timeout)
             #while data is None:
             #    data = self.micromodem.wait_for_data_packet(fsk=self.fsk_mode,timeout=timeout)
-            if ack:
-                self.micromodem._daemon_log.info("Waiting for Ack to Finish Transmitting")
-                self.micromodem.wait_for_xst(timeout=timeout)
+            #The modem sends the ack by itself, and the sender waits for it before sending the next packet, so there's
+            #nothing to wait for here: waiting could miss that packet.
             return data
 
     def _send_across_link(self,data,ack,timeout = None,delay = 3,force_packet = False, validate_packet=False):
@@ -82,7 +106,7 @@ class acomms_xymodem(object):
         if self.use_minipackets and not force_packet:
             self.micromodem.send_minipacket(dest_id=self.target_id,databytes=data)
             self.micromodem.wait_for_xst(timeout)
-            time.sleep(delay)
+            self.micromodem.clock.sleep(delay)
             if ack:
                 self.micromodem._daemon_log.info("Waiting for Minpacket ACK")
                 char = self.micromodem.wait_for_minipacket(timeout=None)
@@ -91,7 +115,11 @@ class acomms_xymodem(object):
                     value = False
             value = True
         else:
-            self.micromodem.send_packet_data(dest=self.target_id,rate_num=self.rate.number,databytes=data,ack=ack)
+            rate_num = self.rate.number
+            if self.auto_rate and not force_packet:
+                #Control characters fit in a frame at any rate.
+                rate_num = AUTO
+            self.micromodem.send_packet_data(dest=self.target_id,rate_num=rate_num,databytes=data,ack=ack)
             self.micromodem.ack_listeners.append(self.ack_recv)
             xst = self.micromodem.wait_for_xst(timeout=None)
 
@@ -102,31 +130,20 @@ class acomms_xymodem(object):
                     return False
             if ack:
                 self.micromodem._daemon_log.info("Waiting for {} Acks".format(xst['num_frames_sent']))
-                self.micromodem.wait_for_cst(timeout=timeout)
-                #for i in range(1,xst['num_frames_sent']+1):
-                #    ack_reply = self.micromodem.wait_for_nmea_type('CAACK',timeout=10)
-                #    if ack_reply is None:
-                #        print "No ACK received for frame {}.".format(i)
-                #        return False
-                    #if int(ack_reply['params'][2]) != int(i):
-                    #    print "Ack Received not for current frame ({} != {}).".format(ack_reply['params'][2],i)
-                    #    return False
-                    #print("Received Ack: {}".format(ack_reply))
-                self.micromodem.ack_listeners.remove(self.ack_recv)
                 frames = list(range(1,xst['num_frames_sent']+1))
                 self.micromodem._daemon_log.info("Frames to Match: {}".format(frames))
-                while True:
+                #Wait for the CAACKs themselves: no CST is reported for an acknowledgement.
+                deadline = self.micromodem.clock.time() + (timeout if timeout is not None else self.timeout)
+                while frames:
                     try:
-                        ack_recv = self.ack_list.get_nowait()
-                        if ack_recv.frame_num in frames:
-                            self.micromodem._daemon_log.info("Matched Frame #:{}".format(ack_recv.frame_num))
-                            frames.remove(ack_recv.frame_num)
-                            if not frames:
-                                value = True
-                                break
+                        ack_recv = self.ack_list.get(timeout=max(deadline - self.micromodem.clock.time(), 0))
                     except Empty:
                         self.micromodem._daemon_log.info("Empty Queue")
                         break
+                    if ack_recv.frame_num in frames:
+                        self.micromodem._daemon_log.info("Matched Frame #:{}".format(ack_recv.frame_num))
+                        frames.remove(ack_recv.frame_num)
+                self.micromodem.ack_listeners.remove(self.ack_recv)
 
                 if frames:
                         self.micromodem._daemon_log.info("No ACK received for frames {}.".format(frames))
@@ -156,7 +173,7 @@ class acomms_xymodem(object):
             self._send_across_link(self.CAN,False,timeout=timeout)
 
 
-    def send(self, file_io, retry=16, timeout=15, delay = 1, callback=None):
+    def send(self, file_io, retry=16, timeout=15, delay = 1, callback=None, resume=False, compress=None):
         '''
         Send a stream via the XMODEM Like protocol.
 
@@ -184,7 +201,33 @@ class acomms_xymodem(object):
                          Expected callback signature:
                          def callback(total_packets, success_count, error_count)
         :type callback: callable
+        :param resume: In ymodem mode, keep a journal of the acknowledged data
+                       next to the file (file.<dest>.acj) and send the header
+                       with its session id, so that an interrupted transfer
+                       continues from where the receiver left off.  The
+                       receiver has to resume too: older receivers can't
+                       parse this header, and waiting for a resume offset
+                       that never comes costs a timeout.
+        :type resume: bool
+        :param compress: In ymodem mode, compress the file before sending it
+                         with this compression Codec, or the one this
+                         CodecSelector picks (True for the default selector).
+                         The codec goes in the header and the receiver
+                         decompresses the file once it has all of it.
         '''
+        self._journal = None
+        try:
+            return self._send(file_io, retry, timeout, delay, callback, resume, compress)
+        finally:
+            if self._journal is not None:
+                #Nothing to resume if nothing was acknowledged.
+                if self._journal.committed:
+                    self._journal.close()
+                else:
+                    self._journal.discard()
+                self._journal = None
+
+    def _send(self, file_io, retry, timeout, delay, callback, resume, compress):
         assert delay != None, "Invalid Delay."
         if self.ymodem_mode:
             assert os.path.isfile(file_io), "Ymodem Mode Enabled and File not passed in."
@@ -202,8 +245,20 @@ class acomms_xymodem(object):
             raise ValueError("An invalid mode was supplied")
 
 
+        codec = None
         if self.ymodem_mode:
             stream = open(file_io,'rb')
+            if compress is not None and compress is not False:
+                with stream:
+                    raw = stream.read()
+                codec = compression.choose_codec(compress, raw)
+                self.micromodem._daemon_log.info("Compressing with {}".format(compression.describe(codec)))
+                stream = io.BytesIO(codec.compress(raw))
+            if resume:
+                stream.seek(0,2)
+                self._journal = TransferJournal('{0}.{1}.acj'.format(file_io, self.target_id),
+                                                size=stream.tell(), clock=self.micromodem.clock)
+                stream.seek(0,0)
         else:
             stream = file_io
 
@@ -257,9 +312,21 @@ class acomms_xymodem(object):
                 stream.seek(0,2)
                 data = os.path.basename(file_io).lower() + " " + \
                        str(stream.tell())
+                if self._journal is not None:
+                    data += " " + self._journal.session_id
+                elif codec is not None:
+                    data += " -"
+                if codec is not None:
+                    data += " " + compression.describe(codec)
+                data = data.encode()
                 stream.seek(0,0)
             #Otherwise just send data
             else:
+                #Each packet goes at the rate the link supports now.
+                if self.auto_rate:
+                    self._select_rate()
+                    packet_size = self.rate.getpacketsize() - 1
+                position = stream.tell()
                 data = stream.read(packet_size)
             if not data:
                 self.micromodem._daemon_log.info('No more data. End of Stream')
@@ -273,12 +340,12 @@ class acomms_xymodem(object):
             while True:
                 self.micromodem._daemon_log.info("Starting Transmission")
                 self._send_across_link(data=self.STX,ack=False,timeout=None,delay=delay)
-                time.sleep(delay)
+                self.micromodem.clock.sleep(delay)
 
                 #Send our sequence number
                 sequence_num = sequence + self.SEQ_NUM_BIT_ID #Add Sequence Bit ID to the front.
                 self.micromodem._daemon_log.info("Sending Sequence Number: {} ({})".format(sequence_num, "{:04X}".format(sequence_num)))
-                ok = self._send_across_link(data="{:04X}".format(sequence_num),ack=True,timeout=None,delay=delay)
+                ok = self._send_across_link(data="{:04X}".format(sequence_num).encode(),ack=True,timeout=None,delay=delay)
                 if not ok:
                     self.micromodem._daemon_log.info('Sequence number not acked, Aborting')
                     self.abort(timeout=timeout)
@@ -296,7 +363,7 @@ class acomms_xymodem(object):
 
                 if crc_mode:
                     self.micromodem._daemon_log.info("Sending CRC: {} ({:04X})".format(crc, crc + self.CRC_BIT_ID))
-                    self._send_across_link(data="{:04X}".format(crc + self.CRC_BIT_ID),ack=False,timeout=None,delay=delay)
+                    self._send_across_link(data="{:04X}".format(crc + self.CRC_BIT_ID).encode(),ack=False,timeout=None,delay=delay)
 
                 self.micromodem._daemon_log.info("Waiting For Ack.")
                 char = self._receive_across_link(ack=False,timeout=None)
@@ -305,6 +372,12 @@ class acomms_xymodem(object):
                     success_count += 1
                     if callback != None:
                         callback(total_packets, success_count, error_count)
+                    if self._journal is not None:
+                        if sequence == 0:
+                            position = self._wait_for_resume(timeout)
+                            stream.seek(position)
+                        else:
+                            self._journal.append(position, position + len(data))
                     # keep track of sequence
                     sequence = (sequence + 1) % self.MAX_SEQ_NUM
                     break
@@ -337,6 +410,9 @@ class acomms_xymodem(object):
             ok = self._receive_across_link(ack=False,timeout=None)
             if ok == self.ACK:
                 self.micromodem._daemon_log.info("File Transfer Success.")
+                if self._journal is not None:
+                    self._journal.discard()
+                    self._journal = None
                 break
             if ok == self.NAK:
                 self.micromodem._daemon_log.warning("File Transfer Failed")
@@ -350,7 +426,62 @@ class acomms_xymodem(object):
 
         return True
 
-    def recv(self, file_io, crc_mode=1, retry=16, timeout=15, delay=1):
+    def _wait_for_resume(self, timeout):
+        '''
+        Wait for the receiver to say how much of the file it already has.
+        Returns the offset to continue from (0 if the receiver doesn't resume).
+        '''
+        reply = self._receive_across_link(ack=False,timeout=timeout)
+        if not reply or not bytes(reply).startswith(self.RSM):
+            self.micromodem._daemon_log.info("No resume offset received, sending from the start.")
+            return 0
+        try:
+            offset = int(bytes(reply[len(self.RSM):]), 16)
+        except ValueError:
+            return 0
+        if offset > self._journal.size:
+            return 0
+        self.micromodem._daemon_log.info("Receiver has {} bytes, resuming.".format(offset))
+        self._journal.append(0, offset)
+        return offset
+
+    def recv(self, file_io, crc_mode=1, retry=16, timeout=15, delay=1, resume=False):
+        '''
+        Receive a stream (or in ymodem mode, a file into the directory
+        file_io) via the XMODEM Like protocol.
+
+        :param resume: In ymodem mode, keep a journal of the received data
+                       next to the file (file.acj), and if the sender's header
+                       names the same session, continue from the end of the
+                       data already received instead of starting again.  Use
+                       it with senders that resume too.
+        :type resume: bool
+        '''
+        self._journal = None
+        self._stream = None
+        try:
+            return self._recv(file_io, crc_mode, retry, timeout, delay, resume)
+        finally:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _sync_stream(self):
+        if self._stream is None or self._stream.closed:
+            return
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+
+    def _decompress_file(self, path, codec):
+        with open(path, 'rb') as f:
+            data = codec.decompress(f.read())
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        self.micromodem._daemon_log.info("Decompressed {} to {} bytes".format(path, len(data)))
+        return len(data)
+
+    def _recv(self, file_io, crc_mode, retry, timeout, delay, resume):
         assert delay != None, "Invalid Delay."
         if self.ymodem_mode:
             assert os.path.isdir(file_io), "Ymodem Mode Enabled and Directory for saving not passed in."
@@ -377,7 +508,7 @@ class acomms_xymodem(object):
                 ok = self._send_across_link(data=self.CRC,ack=True,timeout=None,delay=delay)
                 if not ok:
                         self.micromodem._daemon_log.info("CRC Mode Not Acked. {} Error Count:{}".format(char,error_count))
-                        time.sleep(delay)
+                        self.micromodem.clock.sleep(delay)
                         error_count += 1
                         continue
                 else:
@@ -390,6 +521,9 @@ class acomms_xymodem(object):
 
             self.micromodem._daemon_log.info("Waiting For Start of Transmission.")
             char = self._receive_across_link(ack=False,timeout=None)
+            if char == self.ACK:
+                #The sender acknowledges CRC mode before it starts.
+                char = self._receive_across_link(ack=False,timeout=None)
 
             if char == self.STX:
                 break
@@ -413,6 +547,7 @@ class acomms_xymodem(object):
             sequence = 1
         cancel = 0
         filename = ""
+        codec = None
         while True:
             while True:
                 if char == self.STX:
@@ -424,11 +559,22 @@ class acomms_xymodem(object):
                     self.micromodem._daemon_log.info("End of Transmission. Confirming File Transmission.")
                     if self.ymodem_mode:
                         stream.close()
+                        if self._journal is not None:
+                            self._journal.discard()
+                            self._journal = None
                     if str(income_size) != str(size) and str(size) != "0":
                         self.micromodem._daemon_log.info("Invalid Size: ({} != {}). Nacking".format(str(income_size),str(size)))
                         self._send_across_link(data=self.NAK,ack=False,timeout=None,delay=delay)
                         os.remove(file_io + '/'+ str(filename))
                         return 0
+                    if codec is not None:
+                        try:
+                            #Report the size of the file, not of what came over the link.
+                            income_size = self._decompress_file(path, codec)
+                        except ValueError as e:
+                            self.micromodem._daemon_log.info("Can't decompress file: {}. Nacking".format(e))
+                            self._send_across_link(data=self.NAK,ack=False,timeout=None,delay=delay)
+                            return 0
                     self._send_across_link(data=self.ACK,ack=False,timeout=None,delay=delay)
                     return income_size
                 elif char == self.CAN:
@@ -459,15 +605,48 @@ class acomms_xymodem(object):
                     self.micromodem._daemon_log.info("Waiting For CRC.")
                     crc_recv= self._receive_across_link(ack=False,timeout=None)
 
-            real_seq = int("0x{}".format(seq),16)  - self.SEQ_NUM_BIT_ID
+            real_seq = int(bytes(seq),16)  - self.SEQ_NUM_BIT_ID
             self.micromodem._daemon_log.info("Calculated Sequence Num: {}".format(real_seq))
             data = data.rstrip(self.pad)
 
             #Process Header
             if real_seq == 0 and self.ymodem_mode:
-                (filename,size) = data.split()
+                if isinstance(data, (bytes, bytearray)):
+                    data = bytes(data).decode()
+                #The session id is only sent by senders that can resume, and
+                #the codec by senders that compressed the file.
+                fields = data.split()
+                (filename,size) = fields[:2]
+                session_id = fields[2] if len(fields) > 2 and fields[2] != "-" else None
+                if len(fields) > 3:
+                    try:
+                        codec = compression.codec_from_description(fields[3])
+                    except (KeyError, ValueError):
+                        self.micromodem._daemon_log.error("Unknown compression: {}".format(fields[3]))
+                        self.abort(timeout=timeout)
+                        return None
                 self.micromodem._daemon_log.info("Saving {}/{} of size: {}".format(file_io,filename,size))
-                stream = open(file_io + '/'+ str(filename), 'w+')
+                path = file_io + '/'+ str(filename)
+                if resume and session_id is not None:
+                    if self._journal is not None:
+                        self._journal.close()
+                    self._journal = TransferJournal(path + '.acj', session_id=session_id, size=int(size),
+                                                    clock=self.micromodem.clock, before_sync=self._sync_stream)
+                    income_size = self._journal.committed
+                    if income_size and not (os.path.isfile(path) and os.path.getsize(path) >= income_size):
+                        #The journal outlived the partial file.
+                        self._journal.discard()
+                        self._journal = TransferJournal(path + '.acj', session_id=session_id, size=int(size),
+                                                        clock=self.micromodem.clock, before_sync=self._sync_stream)
+                        income_size = 0
+                if income_size:
+                    self.micromodem._daemon_log.info("Resuming at byte {}".format(income_size))
+                    stream = open(path, 'r+b')
+                    stream.truncate(income_size)
+                    stream.seek(income_size)
+                else:
+                    stream = open(path, 'w+b')
+                self._stream = stream
                 valid = 1
             #Otherwise process data.
             elif real_seq == sequence:
@@ -475,8 +654,8 @@ class acomms_xymodem(object):
                 # packet_size + checksum
                 if crc_mode:
                     self.micromodem._daemon_log.info("Calculating CRC")
-                    csum = int("0x{}".format(crc_recv),16) - self.CRC_BIT_ID
-                    calc_csum = self.calc_crc(str(data))
+                    csum = int(bytes(crc_recv),16) - self.CRC_BIT_ID
+                    calc_csum = self.calc_crc(bytes(data))
                     self.micromodem._daemon_log.info('CRC (%04x <> %04x)' % (csum, calc_csum))
                     valid = csum == calc_csum
                 else:
@@ -490,8 +669,15 @@ class acomms_xymodem(object):
                     income_size += len(data)
                     stream.write(data)
                     stream.flush()
+                    if self._journal is not None:
+                        self._journal.append(income_size - len(data), income_size)
                 self.micromodem._daemon_log.info("Acking Data.")
                 ok = self._send_across_link(data=self.ACK,ack=False,timeout=None,delay=delay)
+                if real_seq == 0 and self._journal is not None:
+                    self.micromodem._daemon_log.info("Sending Resume Offset: {}".format(income_size))
+                    self.micromodem.clock.sleep(delay)
+                    self._send_across_link(data=self.RSM + "{:08X}".format(income_size).encode(),ack=False,
+                                           timeout=None,delay=delay,force_packet=True)
                 sequence = (sequence + 1) % self.MAX_SEQ_NUM
                 char = self._receive_across_link(ack=False,timeout=None,delay=delay)
                 continue
@@ -527,39 +713,455 @@ class acomms_ymodem(acomms_xymodem):
                  unified_log = None, log_path = None):
         super(acomms_ymodem, self).__init__(micromodem, dest, rate, timeout, pad, True, unified_log, log_path)
 
-    def recv(self, file_io, crc_mode = 1, retry = 16, timeout = 15, delay = 1):
-        return super(acomms_ymodem, self).recv(file_io, crc_mode, retry, timeout, delay)
-
-    def send(self, file_io, retry = 16, timeout = 15, delay = 1, callback = None):
-        return super(acomms_ymodem, self).send(file_io, retry, timeout, delay, callback)
+    def recv(self, file_io, crc_mode = 1, retry = 16, timeout = 15, delay = 1, resume = False):
+        return super(acomms_ymodem, self).recv(file_io, crc_mode, retry, timeout, delay, resume)
 
+    def send(self, file_io, retry = 16, timeout = 15, delay = 1, callback = None, resume = False, compress = None):
+        return super(acomms_ymodem, self).send(file_io, retry, timeout, delay, callback, resume, compress)
 
 
 class acomms_zmodem(object):
-    def __init__(self, micromodem, dest,rate = 1, timeout=60,pad='\x1a',ymodem_enabled = True,unified_log=None,log_path=None, ):
-        assert isinstance(micromodem, Micromodem), "micromodem object isn't a Micromodem: %r" & micromodem
-        assert rate in range(0,6), "Invalid Rate: %d" & rate
+    '''
+    ZMODEM like streaming file transfer.
+
+    Instead of stopping for an acknowledgement after every block, the sender
+    streams ZDATA frames back to back, each carrying the file offset of its
+    data.  Every report_interval packets (or when window bytes are
+    unconfirmed) the last frame is a ZDATAW, and the sender pauses for the
+    receiver's position report: ZACK if everything so far arrived, or ZRPOS
+    with the offset to go back to if a frame was lost.  The sender only ever
+    rewinds to the last offset the receiver confirmed.  ZEOF carries the file
+    size and the receiver answers ZFIN once the CRC-32 of the whole file
+    matches the one in the ZFILE header.
+
+    Control frames (ZFILE, ZEOF, ZRPOS, ZACK, ZFIN) end in a CRC-32 of the
+    frame; data frames rely on the modem's frame CRC and the file CRC-32.
+
+    The receiver keeps a journal of the data it has written (see
+    transferjournal), so if either end restarts, the answer to the next
+    ZFILE for the same file is a ZRPOS from where it left off (crash
+    recovery).
+
+    :param rate: Packet rate, 0-6, or 'auto' to have the modem's RateController
+                 choose it, and choose again after every report.
+    :param window: Most bytes sent but not confirmed before the sender stops
+                   to wait for a report (default: two report intervals).
+    :param report_interval: Packets between report requests.
+    :param report_timeout: Seconds to wait for a report.  The default allows
+                           a round trip of up to 15 s and the report itself.
+    '''
+
+    # frame type, transfer id, offset
+    HEADER = struct.Struct('!BBI')
+    # file size, CRC-32 of the file (then the file name)
+    FILE_INFO = struct.Struct('!II')
+    CRC_SIZE = 4
+
+    ZACK = 0x03
+    ZFILE = 0x04
+    ZFIN = 0x08
+    ZRPOS = 0x09
+    ZDATA = 0x0a
+    ZEOF = 0x0b
+    ZDATAW = 0x0c
+
+    def __init__(self, micromodem, dest, rate=1, timeout=60, window=None, report_interval=8, report_timeout=None,
+                 unified_log=None, log_path=None):
+        assert isinstance(micromodem, Micromodem), "micromodem object isn't a Micromodem: %r" % micromodem
+        #With 'auto', this is only the first choice: see _select_rate.
+        self.auto_rate = rate == AUTO
+        if self.auto_rate:
+            rate = micromodem.rate_controller.select_rate(dest)
+        assert rate in range(0,7), "Invalid Rate: %d" % rate
         assert dest != micromodem.id, "Can't send file to self."
-        self.pad = pad
 
         self.rate = Rates[rate]
         self.micromodem = micromodem
         self.micromodem.set_config('RXP',1)
         self.micromodem.set_config('MOD',1)
-        #use CRC-8/CDMA2000 instead of CRC-16 CCITT Unreflected.
-        self.calc_crc = crcmod.mkCrcFun(0x19b, rev=False, initCrc=0xff, xorOut=0x00)
+        #CRC-32, as in ZMODEM.
+        self.calc_crc = crcmod.mkCrcFun(0x104C11DB7, rev=True, initCrc=0, xorOut=0xFFFFFFFF)
         if unified_log is None:
             unified_log = UnifiedLog(log_path=log_path)
-        self.log = unified_log.getLogger("xmodem.{0}".format(micromodem.name))
+        self.log = unified_log.getLogger("zmodem.{0}".format(micromodem.name))
         self.target_id = dest
         self.timeout = timeout
-        self.ymodem_mode = True
+        self.report_interval = report_interval
+        self._window = window
+        self._set_rate(self.rate)
+        if report_timeout is None:
+            report_timeout = self.rate.packet_duration(1) + 15.0
+        self.report_timeout = report_timeout
+
+        # Statistics for the last transfer
+        self.stats = None
+
+        self._transfer_id = None
+        self._report = None
+        self._rx = None
+
+    def _set_rate(self, rate):
+        self.rate = rate
+        self.payload_size = rate.framesize - self.HEADER.size
+        self.window = self._window
+        if self.window is None:
+            self.window = 2 * self.report_interval * rate.numframes * self.payload_size
+
+    def _select_rate(self):
+        '''
+        With rate='auto', choose the rate again from what the modem has heard
+        of the link lately (the report that just arrived, for one).
+        '''
+        if self.auto_rate:
+            rate = Rates[self.micromodem.rate_controller.select_rate(self.target_id)]
+            if rate is not self.rate:
+                self.log.info("Switching to rate {0}".format(rate.number))
+                self._set_rate(rate)
 
-    SOH = '0001'
-    STX = '0002'
-    EOT = '0004'
-    ACK = '0006'
-    DLE = '0010'
-    NAK = '0015'
-    CAN = '0018'
-    CRC = '0043'
+    def _control(self, frame_type, transfer_id, offset, args=b''):
+        frame = self.HEADER.pack(frame_type, transfer_id, offset) + args
+        return frame + struct.pack('!I', self.calc_crc(frame))
+
+    def _parse(self, dataframe):
+        '''
+        Returns (frame type, transfer id, offset, payload) for a good frame
+        from the other end, or None.
+        '''
+        if dataframe.bad_crc or dataframe.data is None or len(dataframe.data) < self.HEADER.size:
+            return None
+        data = bytes(dataframe.data)
+        frame_type, transfer_id, offset = self.HEADER.unpack_from(data)
+        if frame_type in (self.ZDATA, self.ZDATAW):
+            return frame_type, transfer_id, offset, data[self.HEADER.size:]
+        if len(data) < self.HEADER.size + self.CRC_SIZE:
+            return None
+        body, (crc,) = data[:-self.CRC_SIZE], struct.unpack('!I', data[-self.CRC_SIZE:])
+        if self.calc_crc(body) != crc:
+            self.log.warning("Bad CRC-32 on control frame {0:#x}".format(frame_type))
+            return None
+        return frame_type, transfer_id, offset, body[self.HEADER.size:]
+
+    def _send_frames(self, payloads, rate_num=None):
+        modem = self.micromodem
+        frames = [DataFrame(modem.id, self.target_id, False, frame_num, payload)
+                  for frame_num, payload in enumerate(payloads, 1)]
+        return modem.send_packet_frames(self.target_id, self.rate.number if rate_num is None else rate_num, frames)
+
+    # Sender
+
+    def send(self, file_io, retry=16, timeout=None, callback=None):
+        '''
+        Send the file at path file_io.  Returns True once the receiver
+        reports the whole file intact.
+
+        :param retry: Most report requests in a row that can go unanswered.
+        :param timeout: Give up after this many seconds (default: never).
+        :param callback: Called as callback(file_size, confirmed_bytes,
+                         rewinds) after each report.
+        '''
+        assert os.path.isfile(file_io), "File not passed in."
+        with open(file_io, 'rb') as f:
+            data = f.read()
+        size = len(data)
+        modem = self.micromodem
+        clock = modem.clock
+        self._transfer_id = transfer_id = ord(os.urandom(1))
+
+        # The name gets whatever room the frame has left.
+        room = self.rate.framesize - self.HEADER.size - self.FILE_INFO.size - self.CRC_SIZE
+        name = os.path.basename(file_io).encode()[:room]
+        zfile = self._control(self.ZFILE, transfer_id, 0, self.FILE_INFO.pack(size, self.calc_crc(data)) + name)
+        zeof = self._control(self.ZEOF, transfer_id, size)
+
+        position = confirmed = resumed_at = 0
+        since_report = unanswered = rewinds = packets = 0
+        success = False
+        handshake = True
+        start = clock.time()
+        modem.packet_listeners.append(self._on_packet)
+        try:
+            while True:
+                if timeout is not None and clock.time() - start > timeout:
+                    self.log.warning("Transfer timed out")
+                    break
+
+                packet_start = position
+                if handshake:
+                    payloads = [zfile]
+                    wait = True
+                elif position >= size:
+                    payloads = [zeof]
+                    wait = True
+                else:
+                    payloads = []
+                    while len(payloads) < self.rate.numframes and position < size:
+                        payloads.append(self.HEADER.pack(self.ZDATA, transfer_id, position) +
+                                        data[position:position + self.payload_size])
+                        position += self.payload_size
+                    position = min(position, size)
+                    since_report += 1
+                    wait = (since_report >= self.report_interval or position >= size or
+                            position - confirmed >= self.window)
+                    if wait:
+                        payloads[-1] = bytes([self.ZDATAW]) + payloads[-1][1:]
+
+                if wait:
+                    self._report = Future()
+                future = self._send_frames(payloads)
+                packets += 1
+                if not clock.wait_future(future, self.rate.packet_duration(len(payloads)) + 30):
+                    # Withdraw it, or it could still go out after the packets sent in its place.  Once it is on the
+                    # air it can't be withdrawn, and the modem will finish with it soon enough.
+                    if not future.cancel():
+                        clock.wait_future(future)
+                if not future.done() or future.cancelled() or future.result() != SENT:
+                    self.log.warning("Packet transmit failed")
+                    position = packet_start
+                    continue
+                if not wait:
+                    continue
+
+                since_report = 0
+                if not clock.wait_future(self._report, self.report_timeout):
+                    unanswered += 1
+                    if unanswered > retry:
+                        self.log.error("No report after {0} requests".format(unanswered))
+                        break
+                    # Go back to what we know has arrived, since the receiver can't tell us what hasn't.
+                    if position - confirmed >= self.window:
+                        self.log.info("No report, rewinding to {0}".format(confirmed))
+                        position = confirmed
+                        rewinds += 1
+                    continue
+
+                unanswered = 0
+                frame_type, offset = self._report.result()
+                if frame_type == self.ZFIN:
+                    success = True
+                    confirmed = size
+                    break
+                offset = min(offset, size)
+                if handshake:
+                    handshake = False
+                    resumed_at = offset
+                    if offset:
+                        self.log.info("Receiver has {0} bytes, resuming".format(offset))
+                if offset < position:
+                    self.log.info("Receiver at {0}, rewinding from {1}".format(offset, position))
+                    rewinds += 1
+                confirmed = position = offset
+                self._select_rate()
+                if callback is not None:
+                    callback(size, confirmed, rewinds)
+        finally:
+            modem.packet_listeners.remove(self._on_packet)
+            self._report = None
+
+        elapsed = clock.time() - start
+        raw = self.rate.bitrate / 8.0
+        delivered = confirmed - resumed_at
+        goodput = delivered / elapsed if elapsed > 0 else 0.0
+        self.stats = {'success': success, 'bytes': delivered, 'resumed_at': resumed_at, 'elapsed': elapsed,
+                      'packets': packets, 'rewinds': rewinds, 'goodput': goodput, 'raw_throughput': raw,
+                      'efficiency': goodput / raw}
+        self.log.info("Transfer {0}: {1} bytes confirmed in {2:.1f} s, {3:.1f} B/s ({4:.0%} of the {5:.0f} B/s raw "
+                      "rate), {6} packets, {7} rewinds".format("complete" if success else "failed", delivered,
+                                                               elapsed, goodput, goodput / raw, raw, packets, rewinds))
+        return success
+
+    def _on_packet(self, packet):
+        if packet.src != self.target_id or packet.dest != self.micromodem.id:
+            return
+        for frame in packet.good_frames:
+            parsed = self._parse(frame)
+            if parsed is None:
+                continue
+            frame_type, transfer_id, offset, payload = parsed
+            if transfer_id != self._transfer_id or frame_type not in (self.ZACK, self.ZRPOS, self.ZFIN):
+                continue
+            if self._report is not None and not self._report.done():
+                self._report.set_result((frame_type, offset))
+
+    # Receiver
+
+    def listen(self, file_io):
+        '''
+        Start receiving into the directory file_io without blocking.  Returns
+        a future whose result is the path of the received file.  The receiver
+        keeps answering until stop_listening() is called.
+        '''
+        assert os.path.isdir(file_io), "Directory for saving not passed in."
+        self._rx = _ZmodemReceiver(self, file_io)
+        self.micromodem.packet_listeners.append(self._rx.on_packet)
+        return self._rx.done
+
+    def stop_listening(self):
+        if self._rx is not None:
+            self._rx.close()
+            try:
+                self.micromodem.packet_listeners.remove(self._rx.on_packet)
+            except ValueError:
+                pass
+
+    def recv(self, file_io, timeout=60, linger=None):
+        '''
+        Receive a file into the directory file_io.  Gives up if nothing
+        arrives for timeout seconds.  Once the file is complete, keeps
+        answering for linger seconds (default: report_timeout) in case the
+        sender missed the ZFIN.
+
+        Returns the path of the received file, or None if it didn't arrive.
+        A partial file is kept, and the next transfer of it carries on.
+        '''
+        done = self.listen(file_io)
+        clock = self.micromodem.clock
+        try:
+            while not done.done():
+                packets = self._rx.packets
+                clock.wait_future(done, timeout)
+                if not done.done() and self._rx.packets == packets:
+                    self.log.warning("No packets for {0} s, giving up".format(timeout))
+                    return None
+            clock.sleep(linger if linger is not None else self.report_timeout)
+            return done.result()
+        finally:
+            self.stop_listening()
+
+
+class _ZmodemReceiver(object):
+    def __init__(self, transfer, directory):
+        self.transfer = transfer
+        self.directory = directory
+        self.done = Future()
+        self.transfer_id = None
+        self.path = None
+        self.size = None
+        self.crc = None
+        self.stream = None
+        self.journal = None
+        self.expected = 0
+        self.error = False
+        self.packets = 0
+
+    def on_packet(self, packet):
+        transfer = self.transfer
+        if packet.src != transfer.target_id or packet.dest != transfer.micromodem.id:
+            return
+        self.packets += 1
+        reply = None
+        for frame in packet.frames:
+            parsed = transfer._parse(frame)
+            if parsed is None:
+                # A lost frame: the frames after it are out of order.
+                self.error = True
+                continue
+            frame_type, transfer_id, offset, payload = parsed
+            if frame_type == transfer.ZFILE:
+                reply = self._open(transfer_id, payload)
+            elif transfer_id != self.transfer_id or (self.stream is None and not self.done.done()):
+                continue
+            elif frame_type in (transfer.ZDATA, transfer.ZDATAW):
+                if self.stream is not None:
+                    self._write(offset, payload)
+                if frame_type == transfer.ZDATAW:
+                    reply = self._position()
+            elif frame_type == transfer.ZEOF:
+                reply = self._finish(offset)
+        if reply is not None:
+            self.error = False
+            frame_type, offset = reply
+            # A report fits in a frame at any rate.
+            transfer._send_frames([transfer._control(frame_type, self.transfer_id, offset)],
+                                  AUTO if transfer.auto_rate else None)
+
+    def _position(self):
+        if self.done.done():
+            return self.transfer.ZFIN, self.size
+        return (self.transfer.ZRPOS if self.error else self.transfer.ZACK), self.expected
+
+    def _open(self, transfer_id, payload):
+        transfer = self.transfer
+        if transfer_id == self.transfer_id and (self.stream is not None or self.done.done()):
+            # The sender didn't hear our answer.
+            return self._position()
+        self.close()
+        size, crc = transfer.FILE_INFO.unpack_from(payload)
+        name = os.path.basename(payload[transfer.FILE_INFO.size:].decode('utf-8', 'replace')) or 'zmodem.out'
+        self.transfer_id = transfer_id
+        self.path = os.path.join(self.directory, name)
+        self.size = size
+        self.crc = crc
+        self.done = self.done if not self.done.done() else Future()
+
+        session_id = uuid.uuid5(uuid.NAMESPACE_URL, "{0}:{1}:{2:08x}".format(name, size, crc)).hex
+        self.journal = TransferJournal(self.path + '.acj', session_id=session_id, size=size,
+                                       clock=transfer.micromodem.clock, before_sync=self._sync)
+        self.expected = self.journal.committed
+        if self.expected and not (os.path.isfile(self.path) and os.path.getsize(self.path) >= self.expected):
+            # The journal outlived the partial file.
+            self.journal.discard()
+            self.journal = TransferJournal(self.path + '.acj', session_id=session_id, size=size,
+                                           clock=transfer.micromodem.clock, before_sync=self._sync)
+            self.expected = 0
+        if self.expected:
+            transfer.log.info("Resuming {0} at byte {1}".format(self.path, self.expected))
+            self.stream = open(self.path, 'r+b')
+            self.stream.truncate(self.expected)
+            self.stream.seek(self.expected)
+        else:
+            transfer.log.info("Receiving {0} ({1} bytes)".format(self.path, size))
+            self.stream = open(self.path, 'w+b')
+        self.error = False
+        return transfer.ZRPOS, self.expected
+
+    def _write(self, offset, payload):
+        if offset != self.expected:
+            if offset > self.expected:
+                self.error = True
+            return
+        # Anything after a gap is dropped (above) until the sender rewinds to it.
+        payload = payload[:self.size - self.expected]
+        if not payload:
+            return
+        self.stream.write(payload)
+        self.journal.append(self.expected, self.expected + len(payload))
+        self.expected += len(payload)
+
+    def _finish(self, offset):
+        transfer = self.transfer
+        if self.done.done():
+            return transfer.ZFIN, self.size
+        if self.expected < self.size:
+            return transfer.ZRPOS, self.expected
+        self.stream.flush()
+        self.stream.seek(0)
+        crc = transfer.calc_crc(self.stream.read())
+        if crc != self.crc:
+            transfer.log.error("CRC mismatch on received file, starting again")
+            self.stream.seek(0)
+            self.stream.truncate()
+            self.journal.discard()
+            self.journal = TransferJournal(self.journal.path, session_id=self.journal.session_id, size=self.size,
+                                           clock=transfer.micromodem.clock, before_sync=self._sync)
+            self.expected = 0
+            return transfer.ZRPOS, 0
+        self.stream.close()
+        self.stream = None
+        self.journal.discard()
+        self.journal = None
+        transfer.log.info("Received {0}".format(self.path))
+        self.done.set_result(self.path)
+        return transfer.ZFIN, self.size
+
+    def _sync(self):
+        if self.stream is not None and not self.stream.closed:
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
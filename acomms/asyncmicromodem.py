@@ -0,0 +1,318 @@
+'''
+asyncio front end for the Micromodem.
+
+AsyncMicromodem wraps an ordinary Micromodem.  Reads and writes run on the event loop through asyncio transports
+(serial, TCP or UDP), so no listen or writer threads are started.  Incoming sentences still go through the modem's
+MessageParser and commstate machine, and the request/response methods are coroutines with timeouts that wait on
+the modem's waiter registry.
+'''
+
+import asyncio
+import os
+from collections import namedtuple
+
+from serial import Serial
+
+from . import timeutil
+from .micromodem import Micromodem, UnavailableInApiLevelError
+from .txscheduler import PRIORITY_NORMAL
+from .waiterregistry import params_predicate
+from acomms.modem_connections import ModemConnection
+from acomms.modem_connections import NmeaFramer
+
+
+class AsyncioConnection(ModemConnection, asyncio.Protocol):
+    ''' Modem connection that runs on an asyncio event loop.
+    It is the protocol for the transport that carries the NMEA stream (stream or datagram).
+    '''
+
+    def __init__(self, modem, loop, connection_type):
+        self._framer = NmeaFramer()
+        self.connection_type = connection_type
+
+        self.modem = modem
+        self._loop = loop
+        self._transport = None
+
+        # Queued NMEA is sent from the loop as soon as it is queued, from whichever thread queued it.
+        modem.tx_notify = self._notify_tx
+
+    @property
+    def is_connected(self):
+        return self._transport is not None and not self._transport.is_closing()
+
+    @property
+    def can_change_baudrate(self):
+        return False
+
+    def change_baudrate(self, baudrate):
+        return None
+
+    def _listen(self):
+        # The event loop does the listening.
+        pass
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def write(self, data):
+        if self._transport is None:
+            raise ConnectionError("Not connected")
+        self._transport.write(data)
+
+    def _notify_tx(self):
+        self._loop.call_soon_threadsafe(self.modem._process_outgoing_nmea)
+
+    # asyncio protocol callbacks
+    def connection_made(self, transport):
+        if self._transport is None:
+            self._transport = transport
+
+    def data_received(self, data):
+        for msg in self._framer.feed(data):
+            self.modem._process_incoming_nmea(msg)
+
+    def datagram_received(self, data, addr):
+        self.data_received(data)
+
+    def error_received(self, exc):
+        self.modem._daemon_log.warn("Connection error: {0}".format(exc))
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.modem._daemon_log.error("Connection lost: {0}".format(exc))
+
+
+class SerialAsyncioConnection(AsyncioConnection):
+    ''' Serial port on an asyncio event loop.
+    pyserial opens and configures the port; the descriptor is then read and written through pipe transports.
+    POSIX only.
+    '''
+
+    def __init__(self, modem, loop, port, baudrate):
+        super(SerialAsyncioConnection, self).__init__(modem, loop, "serial")
+        self.port = port
+        self.baudrate = baudrate
+        self._serialport = Serial(port, baudrate, timeout=0)
+        self._read_transport = None
+
+    async def open(self):
+        fd = self._serialport.fileno()
+        # Each transport owns (and will close) its own copy of the descriptor.
+        self._read_transport, protocol = await self._loop.connect_read_pipe(
+            lambda: self, os.fdopen(os.dup(fd), 'rb', buffering=0))
+        self._transport, protocol = await self._loop.connect_write_pipe(
+            asyncio.Protocol, os.fdopen(os.dup(fd), 'wb', buffering=0))
+
+    @property
+    def can_change_baudrate(self):
+        return True
+
+    def change_baudrate(self, baudrate):
+        self.baudrate = baudrate
+        self._serialport.baudrate = baudrate
+        return baudrate
+
+    def close(self):
+        if self._read_transport is not None:
+            self._read_transport.close()
+        super(SerialAsyncioConnection, self).close()
+        self._serialport.close()
+
+
+class AsyncMicromodem(object):
+    ''' Coroutine interface to a Micromodem.
+
+    Methods that only send something (send_ping, send_packet_frames, etc.) are passed straight through to the
+    wrapped modem.  The methods defined here wait for a response without tying up a thread.
+    '''
+
+    def __init__(self, modem=None, loop=None, **modem_args):
+        if modem is None:
+            modem = Micromodem(**modem_args)
+        self.modem = modem
+        self._loop = loop
+
+    def __getattr__(self, name):
+        return getattr(self.modem, name)
+
+    @property
+    def loop(self):
+        # Only used from coroutines, so default to the loop that is running them.
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop
+
+    async def connect_serial(self, port, baudrate=19200):
+        connection = SerialAsyncioConnection(self.modem, self.loop, port, baudrate)
+        await connection.open()
+        self.modem.connection = connection
+        self.modem._daemon_log.info("Connected to {0} ({1} bps)".format(port, baudrate))
+        await self.get_config('SRC')
+
+    async def connect_tcp(self, remote_host, remote_port):
+        connection = AsyncioConnection(self.modem, self.loop, "tcp")
+        await self.loop.create_connection(lambda: connection, remote_host, remote_port)
+        self.modem.connection = connection
+        self.modem._daemon_log.info("Connected to {0}:{1}".format(remote_host, remote_port))
+
+    async def connect_udp(self, remote_host, remote_port, local_host=None, local_port=None):
+        if local_host is None:
+            local_host = ""
+        if local_port is None:
+            local_port = remote_port
+        connection = AsyncioConnection(self.modem, self.loop, "udp")
+        await self.loop.create_datagram_endpoint(lambda: connection, local_addr=(local_host, local_port),
+                                                 remote_addr=(remote_host, remote_port))
+        self.modem.connection = connection
+        self.modem._daemon_log.info("Connected to {0}:{1} (UDP)".format(remote_host, remote_port))
+
+    def disconnect(self):
+        if self.modem.connection is not None:
+            self.modem.connection.close()
+            self.modem.connection = None
+
+    async def _wait(self, waiter, timeout):
+        ''' Wait for a registry waiter.  Returns its event, or None on timeout. '''
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(waiter, loop=self.loop), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiter.cancel()
+
+    async def wait_for_nmea_type(self, type_string, timeout=None, params=None):
+        predicate = params_predicate(params) if params else None
+        return await self._wait(self.modem.waiters.add(type_string, predicate), timeout)
+
+    async def wait_for_nmea_types(self, type_string_list, timeout=None):
+        return await self._wait(self.modem.waiters.add(type_string_list), timeout)
+
+    async def wait_for_cst(self, timeout=None):
+        return await self._wait(self.modem.waiters.add('cst'), timeout)
+
+    async def wait_for_xst(self, timeout=None):
+        return await self._wait(self.modem.waiters.add('xst'), timeout)
+
+    async def get_config(self, param, response_timeout=2):
+        # A group query gets several CACFG responses, which can arrive in a single read.  Queue them all up, rather
+        # than using a one-shot waiter, so that none slip past us between awaits.
+        responses = asyncio.Queue()
+
+        def on_nmea(msg):
+            if msg['type'] == 'CACFG':
+                self.loop.call_soon_threadsafe(responses.put_nowait, msg)
+
+        self.modem.nmea_listeners.append(on_nmea)
+        config_dict = {}
+        try:
+            self.modem.write_nmea({'type': "CCCFQ", 'params': [param]})
+            while response_timeout:
+                try:
+                    msg = await asyncio.wait_for(responses.get(), response_timeout)
+                except asyncio.TimeoutError:
+                    break
+                param_name = msg['params'][0]
+                param_value = msg['params'][1]
+                # If we queried a config group, there is no associated value to add to the dictionary.
+                if param_value != "":
+                    config_dict[param_name] = param_value
+                # We aren't done unless this config parameter matched the one we queried
+                if param_name == param:
+                    break
+        finally:
+            self.modem.nmea_listeners.remove(on_nmea)
+
+        if config_dict:
+            return config_dict
+        return None
+
+    async def set_config(self, name, value, response_timeout=2):
+        params = [str(name), str(value)]
+        waiter = self.modem.waiters.add('CACFG', params_predicate(params))
+        self.modem.write_nmea({'type': 'CCCFG', 'params': params})
+
+        if not response_timeout:
+            waiter.cancel()
+            return None
+
+        response = await self._wait(waiter, response_timeout)
+        if not response:
+            return None
+        return {str(name), str(value)}
+
+    async def ping(self, dest_id, timeout=30):
+        ''' Send a ping and wait for the reply.  Returns the one-way travel time (in seconds), or None. '''
+        waiter = self.modem.waiters.add('CAMPR', lambda msg: int(msg['params'][1]) == self.modem.id)
+        self.modem.send_ping(dest_id)
+        ping_reply = await self._wait(waiter, timeout)
+        if ping_reply is None:
+            return None
+        return abs(float(ping_reply["params"][2]))
+
+    async def send_packet_data(self, dest, databytes, rate_num=1, ack=False, timeout=30, priority=PRIORITY_NORMAL,
+                               deadline=None, compress=None):
+        ''' Queue a packet and wait for the modem to finish transmitting it.
+        Returns the transmit scheduler's outcome ('sent', 'failed' or 'expired'), or None if the packet wasn't done
+        within timeout.  A packet that times out before it starts transmitting is taken off the queue.
+        '''
+        future = self.modem.send_packet_data(dest, databytes, rate_num=rate_num, ack=ack, priority=priority,
+                                             deadline=deadline, compress=compress)
+        return await self._wait(future, timeout)
+
+    async def set_time(self, time_to_set=None, mode=None, ignore_response=False, extpps_drive_fxn=None):
+        if self.modem.api_level < 11:
+            raise UnavailableInApiLevelError
+
+        if time_to_set is None:
+            time_to_set = self.modem.clock.now()
+        if mode is None:
+            mode = 0
+
+        waiter = self.modem.waiters.add('CATMS')
+        self.modem.write_nmea({'type': "CCTMS", 'params': ["{0}Z".format(timeutil.to_utc_iso8601(time_to_set, True)),
+                                                          mode]})
+
+        if (mode == 1) and (extpps_drive_fxn is not None):
+            extpps_drive_fxn()
+
+        if ignore_response:
+            waiter.cancel()
+            return None
+
+        # CCTMS may take up to 3 seconds to time out in mode 1.
+        response = await self._wait(waiter, 4)
+        if response is None:
+            return None
+        CATMS = namedtuple("CATMS", ["time", "timed_out"])
+        return CATMS(time=timeutil.convert_to_datetime(response['params'][1]), timed_out=response['params'][0])
+
+    async def get_time_info(self, timeout=0.5):
+        if self.modem.api_level < 11:
+            raise UnavailableInApiLevelError
+
+        waiter = self.modem.waiters.add('CATMQ')
+        self.modem.write_nmea("$CCTMQ,0")
+        response = await self._wait(waiter, timeout)
+        if response is None:
+            return None
+
+        modem_time = timeutil.convert_to_datetime(response['params'][0])
+        return (modem_time, response['params'][1], response['params'][2])
+
+    async def get_time(self, timeout=0.5):
+        time_info = await self.get_time_info(timeout)
+        if time_info is None:
+            return None
+        return time_info[0]
+
+    async def wait_for_packet(self, timeout=None, predicate=None):
+        return await self._wait(self.modem.expect_packet(predicate), timeout)
+
+    async def wait_for_data_packet(self, fsk=False, timeout=30, decompress=False):
+        ''' Wait for a packet addressed to this modem and return its data, as Micromodem.wait_for_data_packet does.
+        fsk is ignored.
+        '''
+        packet = await self.wait_for_packet(timeout, self.modem._is_data_packet_for_me)
+        return self.modem._data_packet_payload(packet, decompress)
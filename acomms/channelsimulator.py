@@ -0,0 +1,310 @@
+'''
+Simulated acoustic network, on a virtual clock.
+
+A ChannelSimulator runs any number of simulated Micromodems, each with a host-side Micromodem object, on a shared
+AcousticChannel.  Nothing sleeps: everything runs on a VirtualClock that jumps straight from one event to the next, so
+hours of network traffic take seconds to minutes of real time.
+
+The channel knows where each node is (fixed coordinates, or a function of time for moving vehicles), delays each
+transmission by its travel time at the configured sound speed, and works out the SNR of each reception from a simple
+sonar equation (spherical spreading plus absorption, against ambient noise).  Receptions that overlap at a node
+interfere with each other, and a node can't hear while it is transmitting.  Each frame is then lost with a
+probability that depends on its SINR and the packet rate, and the receiving modem reports what it got with the usual
+CARXP/CACYC/CARXD/CAMSG/CACST sentences.
+
+Everything runs on one thread.  Host code can schedule actions with sim.clock.call_later and collect results with
+listeners (cst_listeners, rxframe_listeners, ...).  The blocking methods (get_config, wait_for_*, ...) also work from
+the top level, because waiting on the virtual clock runs the simulation until the response arrives; don't call them
+from inside listeners or scheduled callbacks.
+'''
+
+from collections import Counter, defaultdict
+from math import exp, log10, sqrt
+import random
+
+from .clock import VirtualClock
+from .micromodem import Micromodem
+from .simulatedmodem import SimulatedModemCore
+from .unifiedlog import UnifiedLog
+from acomms.modem_connections import NmeaFramer
+from acomms.modem_connections.modem_connection import ModemConnection
+
+
+# SINR (dB) at which half of the frames are lost, by packet rate.  'detect' applies to detecting a packet at all, and
+# 'mini' to minipackets (cycle inits, pings and acknowledgements).  These are rough, but keep the rates in the right
+# order of robustness.
+DEFAULT_SNR_THRESHOLDS = {
+    'detect': -4.0,
+    'mini': 0.0,
+    0: 5.0,
+    1: -2.0,
+    2: -6.0,
+    3: 0.0,
+    4: 3.0,
+    5: 9.0,
+    6: -6.0,
+}
+
+
+class _Reception(object):
+    __slots__ = ('sender', 'kind', 'args', 'start', 'end', 'snr')
+
+    def __init__(self, sender, kind, args, start, end, snr):
+        self.sender = sender
+        self.kind = kind
+        self.args = args
+        self.start = start
+        self.end = end
+        self.snr = snr
+
+
+class AcousticChannel(object):
+    ''' Shared medium for SimulatedModemCores.
+
+    :param clock: VirtualClock (or anything with time() and call_later()).
+    :param sound_speed: m/s.
+    :param source_level: Transmit source level, dB re 1 uPa @ 1 m.
+    :param noise_level: Ambient noise over the receive band, dB re 1 uPa.
+    :param absorption: dB/km.
+    :param snr_thresholds: Overrides for DEFAULT_SNR_THRESHOLDS.
+    :param snr_slope: Width (dB) of the transition from no loss to total loss around each threshold.
+    :param seed: Seed for the random number generator, for repeatable runs.
+    '''
+
+    def __init__(self, clock, sound_speed=1500.0, source_level=185.0, noise_level=100.0, absorption=1.0,
+                 snr_thresholds=None, snr_slope=1.5, seed=None):
+        self.clock = clock
+        self.sound_speed = sound_speed
+        self.source_level = source_level
+        self.noise_level = noise_level
+        self.absorption = absorption
+        self.snr_thresholds = dict(DEFAULT_SNR_THRESHOLDS)
+        if snr_thresholds:
+            self.snr_thresholds.update(snr_thresholds)
+        self.snr_slope = snr_slope
+        self.random = random.Random(seed)
+
+        self._positions = {}
+        self._receptions = defaultdict(list)
+        self._transmissions = defaultdict(list)
+        # Longest transmission so far; anything that ended longer ago than this can't overlap a current reception.
+        self._longest = 0.0
+
+        # Statistics
+        self.stats = Counter()
+
+    def add(self, core, position):
+        ''' Put core on the channel.  position is (x, y, z) in meters, or a function of virtual time that returns one.
+        '''
+        self._positions[core] = position
+        core.channel = self
+
+    def remove(self, core):
+        self._positions.pop(core, None)
+        self._receptions.pop(core, None)
+        self._transmissions.pop(core, None)
+        core.channel = None
+
+    def move(self, core, position):
+        self._positions[core] = position
+
+    def position(self, core, t=None):
+        position = self._positions[core]
+        if callable(position):
+            return position(self.clock.time() if t is None else t)
+        return position
+
+    def distance(self, a, b, t=None):
+        pa = self.position(a, t)
+        pb = self.position(b, t)
+        return sqrt(sum((i - j) ** 2 for i, j in zip(pa, pb)))
+
+    def snr(self, distance):
+        ''' SNR (dB) of a transmission received distance meters away. '''
+        distance = max(distance, 1.0)
+        transmission_loss = 20 * log10(distance) + self.absorption * distance / 1000.0
+        return self.source_level - transmission_loss - self.noise_level
+
+    def loss_probability(self, sinr, rate):
+        ''' Probability that a frame at the given rate (or 'detect' or 'mini') is lost at this SINR. '''
+        x = (sinr - self.snr_thresholds[rate]) / self.snr_slope
+        if x > 50:
+            return 0.0
+        if x < -50:
+            return 1.0
+        return 1.0 / (1.0 + exp(x))
+
+    def transmit(self, sender, start, duration, kind, args):
+        ''' Called by SimulatedModemCore._radiate. '''
+        now = self.clock.time()
+        t0 = now + start
+        self._transmissions[sender].append((t0, t0 + duration))
+        self._longest = max(self._longest, duration)
+        self.stats['transmissions'] += 1
+        self.stats[kind + '_transmissions'] += 1
+
+        for core in self._positions:
+            if core is sender:
+                continue
+            distance = self.distance(sender, core, t0)
+            arrival = t0 + distance / self.sound_speed
+            reception = _Reception(sender, kind, args, arrival, arrival + duration, self.snr(distance))
+            self._receptions[core].append(reception)
+            self.clock.call_later(reception.end - now, self._complete, core, reception)
+
+    def _prune(self, core):
+        horizon = self.clock.time() - self._longest
+        self._receptions[core] = [r for r in self._receptions[core] if r.end >= horizon]
+        self._transmissions[core] = [t for t in self._transmissions[core] if t[1] >= horizon]
+
+    def _complete(self, core, reception):
+        if core not in self._positions:
+            return
+        self._prune(core)
+
+        # Half duplex: we can't hear anything while we're transmitting.
+        for (t0, t1) in self._transmissions[core]:
+            if t0 < reception.end and t1 > reception.start:
+                self.stats['half_duplex_losses'] += 1
+                return
+
+        interference = 0.0
+        for other in self._receptions[core]:
+            if other is not reception and other.start < reception.end and other.end > reception.start:
+                interference += 10 ** (other.snr / 10.0)
+        if interference:
+            self.stats['collisions'] += 1
+        sinr = reception.snr - 10 * log10(1.0 + interference)
+
+        if self.random.random() < self.loss_probability(sinr, 'detect'):
+            self.stats['missed'] += 1
+            return
+
+        if reception.kind == 'data':
+            src, dest, rate, ack, frames = reception.args
+            bad_frames = set(n for n in range(1, len(frames) + 1)
+                             if self.random.random() < self.loss_probability(sinr, rate))
+            self.stats['frames_received'] += len(frames) - len(bad_frames)
+            self.stats['frames_lost'] += len(bad_frames)
+            core.hear(reception.kind, reception.args, bad_frames, sinr)
+        else:
+            if self.random.random() < self.loss_probability(sinr, 'mini'):
+                self.stats['missed'] += 1
+                return
+            core.hear(reception.kind, reception.args)
+        self.stats['receptions'] += 1
+
+
+class VirtualConnection(ModemConnection):
+    ''' Connects a Micromodem directly to a SimulatedModemCore, on the thread that runs the clock. '''
+
+    def __init__(self, modem, core, clock):
+        self.modem = modem
+        self.core = core
+        self.clock = clock
+        self._framer = NmeaFramer()
+        self._connected = True
+        core.output = self._from_core
+        modem.tx_notify = self._notify
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    @property
+    def can_change_baudrate(self):
+        return False
+
+    def change_baudrate(self, baudrate):
+        return None
+
+    def _listen(self):
+        pass
+
+    def close(self):
+        self._connected = False
+        self.modem.tx_notify = None
+
+    def _notify(self):
+        self.clock.call_soon(self.modem._process_outgoing_nmea)
+
+    def write(self, data):
+        if not self._connected:
+            return
+        for line in self._framer.feed(data):
+            self.core.handle_line(line)
+
+    def _from_core(self, line):
+        if self._connected:
+            self.modem._process_incoming_nmea(line)
+
+
+class SimulatedNode(object):
+    ''' A host Micromodem and the simulated modem it is connected to. '''
+
+    def __init__(self, modem, core, channel):
+        self.modem = modem
+        self.core = core
+        self.channel = channel
+
+    @property
+    def id(self):
+        return self.core.id
+
+    @property
+    def position(self):
+        return self.channel.position(self.core)
+
+    @position.setter
+    def position(self, position):
+        self.channel.move(self.core, position)
+
+
+class ChannelSimulator(object):
+    ''' Build and run a simulated acoustic network.
+
+        sim = ChannelSimulator(seed=1)
+        a = sim.add_node(1, (0, 0, 10))
+        b = sim.add_node(2, (2000, 0, 10))
+        b.modem.cst_listeners.append(on_cst)
+        sim.clock.call_later(5, a.modem.send_packet_data, 2, data, 1)
+        sim.run_for(12 * 3600)
+
+    :param start_time: datetime that virtual time 0 corresponds to.
+    :param unified_log: UnifiedLog shared by the host Micromodems (one is created under log_path if not given).
+    :param channel_args: Passed to AcousticChannel (sound_speed, noise_level, seed, ...).
+    '''
+
+    def __init__(self, start_time=None, unified_log=None, log_path=None, **channel_args):
+        self.clock = VirtualClock(start_time)
+        self.channel = AcousticChannel(self.clock, **channel_args)
+        self.unified_log = unified_log if unified_log is not None else UnifiedLog(log_path=log_path)
+        self.nodes = {}
+
+    def time(self):
+        return self.clock.time()
+
+    def add_node(self, modem_id, position, name=None, baudrate=19200, latencies=None, **core_args):
+        ''' Add a node at position (see AcousticChannel.add).  Returns a SimulatedNode.
+        Packet durations come from the rate tables unless latencies sets a fixed 'transmit' time.
+        '''
+        node_latencies = {'transmit': None}
+        if latencies:
+            node_latencies.update(latencies)
+        core = SimulatedModemCore(modem_id, loop=self.clock, baudrate=baudrate, latencies=node_latencies,
+                                  now=self.clock.now, **core_args)
+        modem = Micromodem(name=name if name is not None else "node{0}".format(modem_id),
+                           unified_log=self.unified_log, clock=self.clock)
+        modem.id = int(modem_id)
+        modem.connection = VirtualConnection(modem, core, self.clock)
+        self.channel.add(core, position)
+
+        node = SimulatedNode(modem, core, self.channel)
+        self.nodes[int(modem_id)] = node
+        return node
+
+    def run_until(self, end_time):
+        self.clock.run_until(end_time)
+
+    def run_for(self, seconds):
+        self.clock.run_for(seconds)
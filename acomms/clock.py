@@ -0,0 +1,265 @@
+'''
+Clocks for timeouts, sleeps and timers.
+
+Everything in pyacomms that waits (wait_for_* deadlines, commstate and correlator timeouts, sleeps in the
+connections and in xmodem) asks a clock instead of calling time.sleep or threading.Timer directly.  The default is
+MonotonicClock, which is real time and isn't affected by steps in the system clock.  VirtualClock only advances when
+it is told to, or when somebody sleeps or waits on it, and then jumps straight to the next timer, so protocol tests
+and simulations that would take hours of acoustic time run in milliseconds.
+
+Timers on the real clock all run on one TimerScheduler thread, shared by every modem in the process, rather than a
+thread per timer.
+'''
+
+from concurrent.futures import wait as wait_futures
+from datetime import datetime, timedelta
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
+import logging
+import threading
+import time
+
+
+class TimerHandle(object):
+    ''' A callback due at monotonic time 'when', as kept by IoHub.call_later and TimerScheduler.
+    Call cancel() to stop the callback from running. '''
+    __slots__ = ('when', 'callback', 'cancelled')
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ScheduledTimer(TimerHandle):
+    ''' Returned by call_later.  Call cancel() to stop the callback from running. '''
+    __slots__ = ('scheduler', 'fired')
+
+    def __init__(self, scheduler, when, callback):
+        super(ScheduledTimer, self).__init__(when, callback)
+        self.scheduler = scheduler
+        self.fired = False
+
+    def cancel(self):
+        self.scheduler._cancel(self)
+
+
+class TimerScheduler(object):
+    ''' Heap of timers, serviced by a single thread (started when the first timer is armed).
+    Arming and firing are O(log n).  Cancelled timers are left in the heap and skipped when they come due.
+    Callbacks run on the scheduler thread, so they should be quick.
+    '''
+
+    def __init__(self, name='timers'):
+        self.name = name
+        self._log = logging.getLogger(name)
+        self._timers = []
+        self._timer_seq = count()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+        # Statistics
+        self.pending = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.errors = 0
+
+    def call_later(self, delay, callback, *args):
+        handle = ScheduledTimer(self, time.monotonic() + delay, partial(callback, *args))
+        with self._cond:
+            heappush(self._timers, (handle.when, next(self._timer_seq), handle))
+            self.pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            elif self._timers[0][2] is handle:
+                # This is the new earliest timer, so the thread needs to wake up sooner.
+                self._cond.notify()
+        return handle
+
+    def _cancel(self, handle):
+        with self._cond:
+            if handle.cancelled or handle.fired:
+                return
+            handle.cancelled = True
+            self.pending -= 1
+            self.cancelled += 1
+
+    def stats(self):
+        return {'pending': self.pending, 'fired': self.fired, 'cancelled': self.cancelled, 'errors': self.errors}
+
+    def _next_due(self):
+        ''' Wait for the next timer to come due, and pop it.  Called with the lock held. '''
+        while True:
+            if not self._timers:
+                self._cond.wait()
+                continue
+            when, seq, handle = self._timers[0]
+            if handle.cancelled:
+                heappop(self._timers)
+                continue
+            delay = when - time.monotonic()
+            if delay > 0:
+                self._cond.wait(delay)
+                continue
+            heappop(self._timers)
+            handle.fired = True
+            self.pending -= 1
+            self.fired += 1
+            return handle
+
+    def _run(self):
+        while True:
+            with self._cond:
+                handle = self._next_due()
+            try:
+                handle.callback()
+            except Exception:
+                self.errors += 1
+                self._log.exception("Error in timer callback")
+
+
+# Services call_later for every MonotonicClock that isn't given its own scheduler.
+SHARED_TIMERS = TimerScheduler()
+
+
+class MonotonicClock(object):
+    ''' Real time, from time.monotonic.  Timers run on timers (a TimerScheduler), by default SHARED_TIMERS. '''
+
+    def __init__(self, timers=None):
+        self.timers = timers if timers is not None else SHARED_TIMERS
+
+    def time(self):
+        return time.monotonic()
+
+    def now(self):
+        ''' Current UTC time, as a datetime. '''
+        return datetime.utcnow()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait_future(self, future, timeout=None):
+        ''' Block until future (a concurrent.futures.Future) is done or timeout expires.  Returns future.done(). '''
+        wait_futures([future], timeout)
+        return future.done()
+
+    def call_later(self, delay, callback, *args):
+        ''' Run callback(*args) after delay seconds, on the timer thread.  Returns a ScheduledTimer. '''
+        return self.timers.call_later(delay, callback, *args)
+
+    def timer_stats(self):
+        ''' Counts of pending, fired and cancelled timers (for every clock that shares this one's scheduler). '''
+        return self.timers.stats()
+
+
+# Shared by everything that isn't given a clock.
+REAL_CLOCK = MonotonicClock()
+
+
+class VirtualClock(object):
+    ''' Simulated time, with an event queue.
+
+    Time stands still until run_until/run_for/run_until_idle is called, or somebody sleeps or waits on the clock.
+    Then it jumps from one timer to the next, running each callback on the calling thread, so nothing actually
+    waits.  call_later can be used from any thread, but only one thread should advance the clock.
+
+    :param start_time: datetime that virtual time 0 corresponds to (for now()).  Default: now (UTC).
+    '''
+
+    def __init__(self, start_time=None):
+        self.start_time = start_time if start_time is not None else datetime.utcnow()
+        self._time = 0.0
+        self._timers = []
+        self._timer_seq = count()
+        self._lock = threading.Lock()
+        self.events_run = 0
+        self._pending = 0
+        self._cancelled = 0
+
+    def time(self):
+        ''' Seconds since start_time. '''
+        return self._time
+
+    def now(self):
+        ''' Current virtual time, as a datetime. '''
+        return self.start_time + timedelta(seconds=self._time)
+
+    @property
+    def pending_count(self):
+        return self._pending
+
+    def timer_stats(self):
+        return {'pending': self._pending, 'fired': self.events_run, 'cancelled': self._cancelled, 'errors': 0}
+
+    def call_soon(self, callback, *args):
+        return self.call_later(0, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        ''' Run callback(*args) delay seconds from now.  Returns a ScheduledTimer. '''
+        handle = ScheduledTimer(self, self._time + max(0.0, delay), partial(callback, *args))
+        with self._lock:
+            heappush(self._timers, (handle.when, next(self._timer_seq), handle))
+            self._pending += 1
+        return handle
+
+    def _cancel(self, handle):
+        with self._lock:
+            if handle.cancelled or handle.fired:
+                return
+            handle.cancelled = True
+            self._pending -= 1
+            self._cancelled += 1
+
+    def call_at(self, when, callback, *args):
+        return self.call_later(when - self._time, callback, *args)
+
+    def _run_next(self, end_time):
+        ''' Run the next timer that is due by end_time.  Returns False if there isn't one. '''
+        with self._lock:
+            if not self._timers or self._timers[0][0] > end_time:
+                return False
+            when, seq, handle = heappop(self._timers)
+            if handle.cancelled:
+                return True
+            handle.fired = True
+            self._pending -= 1
+        self._time = max(self._time, when)
+        self.events_run += 1
+        handle.callback()
+        return True
+
+    def run_until(self, end_time):
+        ''' Run every timer due up to virtual time end_time, and then set the clock to end_time. '''
+        while self._run_next(end_time):
+            pass
+        self._time = max(self._time, end_time)
+
+    def run_for(self, seconds):
+        self.run_until(self._time + seconds)
+
+    def run_until_idle(self, max_time=float('inf')):
+        ''' Run until there are no timers left (or the next one is after virtual time max_time). '''
+        while self._run_next(max_time):
+            pass
+
+    def sleep(self, seconds):
+        ''' Advance the clock by seconds, running whatever comes due. '''
+        self.run_for(seconds)
+
+    def wait_future(self, future, timeout=None):
+        ''' Run timers until future is done, or until timeout seconds of virtual time have passed.
+        Returns future.done().  With no timeout, gives up when there is nothing left to run.
+        '''
+        end_time = float('inf') if timeout is None else self._time + timeout
+        while not future.done():
+            if not self._run_next(end_time):
+                break
+        if not future.done() and timeout is not None:
+            self._time = max(self._time, end_time)
+        return future.done()
@@ -6,7 +6,6 @@ Created on Jan 25, 2012
 
 from .messageparams import Packet, Rates, DataFrame
 
-import threading
 
 class CommState(object):
     '''
@@ -19,22 +18,33 @@ class CommState(object):
     def __init__(self, modem):
         self.modem = modem
         self.state_timer = None
+        self.deadline = None
 
 
     def entering(self):
         self.modem._daemon_log.debug("Entering new state: " + str(self))
 
-        # Stop any timeout timer that is currently running.
-        try:
+        # Stop the previous state's timeout timer, if it is still running.
+        if self.modem.state_timer is not None:
             self.modem.state_timer.cancel()
-        except:
-            pass
 
         self.state_timer = None
 
-        # Start a new timeout timer, if this state requires one.
+        # Start a new timeout timer, if this state requires one.  All modems share the clock's timer scheduler.
+        self.deadline = None
         if self.timeout_seconds:
-            self.state_timer = threading.Timer(self.timeout_seconds, self.timeout)
+            self.deadline = self.modem.clock.time() + self.timeout_seconds
+            self.state_timer = self.modem.clock.call_later(self.timeout_seconds, self._state_timed_out)
+        self.modem.state_timer = self.state_timer
+
+    def _state_timed_out(self):
+        # This runs on the timer thread, so take the state lock against the reader thread.
+        with self.modem.state_lock:
+            # The modem may have moved on to another state while this timer was coming due.
+            if self.modem.state is not self:
+                return
+            self.modem.state_timeouts += 1
+            self.timeout()
 
 
     def got_cacyc(self, cycleinfo):
@@ -329,16 +339,25 @@ class WaitingForDrq(CommState):
         return "Waiting for CADRQ"
     
 
-class WaitingForTxf(CommState):
+class PacketTimeoutState(CommState):
+    ''' Base for states that wait while a packet is on the air.  The timeout allows for the time the current cycle's
+    packet takes to transmit, so that slow rates and long packets don't time out while they are still arriving.
+    '''
+
+    @property
+    def timeout_seconds(self):
+        cycleinfo = self.modem.current_cycleinfo
+        if cycleinfo is None or cycleinfo.rate_num not in Rates:
+            return CommState.timeout_seconds
+        return CommState.timeout_seconds + Rates[cycleinfo.rate_num].packet_duration(cycleinfo.num_frames)
+
+
+class WaitingForTxf(PacketTimeoutState):
     ''' State: Waiting for the $CATXF message when we expect the modem to transmit. '''
 
     def entering(self):
         CommState.entering(self)
         
-        # Start the timeout timer
-        #self.modem.start_timeout(settings.txf_timeout)
-        #TODO: Adjust this interval based on the packet type, number of frames, and BW0.
-        
     def got_catxf(self):
         CommState.got_catxf(self)
         
@@ -349,11 +368,19 @@ class WaitingForTxf(CommState):
         # Now, go back to Idle.
         self.modem._changestate(Idle)
         
+    def timeout(self):
+        CommState.timeout(self)
+        
+        # The modem never reported the end of the transmission.
+        if self.modem.current_txpacket != None:
+            self.modem.on_packettx_failed()
+        
+        self.modem._changestate(Idle)
         
     def __str__(self):
         return "Waiting for CATXF"
         
-class WaitingForCiTxf(CommState):
+class WaitingForCiTxf(PacketTimeoutState):
     ''' State: Waiting for the $CATXF message when we expect the modem to transmit a cycle init. '''
 
     def entering(self):
@@ -409,7 +436,7 @@ class WaitingForMinipacketTxf(CommState):
         return "Waiting for Minipacket Command CATXF"
 
 
-class WaitingForPacket(CommState):
+class WaitingForPacket(PacketTimeoutState):
     ''' State: Waiting for a packet following an uplink request. '''
 
     def entering(self):
@@ -450,7 +477,7 @@ class WaitingForPacket(CommState):
     def __str__(self):
         return "Waiting for packet"
         
-class WaitingForRxData(CommState):
+class WaitingForRxData(PacketTimeoutState):
     ''' State: Waiting for $CARXD or $CARXA messages after getting a $CACYC message that suggests we should.  '''
 
     def entering(self):
@@ -483,8 +510,9 @@ class WaitingForRxData(CommState):
                 else:
                     self.modem.on_packetrx_success()
 
-                # Are we sending ACKs?  If so, wait for that.
-                if self.modem.current_rxpacket.cycleinfo.ack:
+                # Are we sending ACKs?  If so, wait for that.  (Only the addressed modem acknowledges.)
+                if (self.modem.current_rxpacket.cycleinfo.ack
+                        and self.modem.current_rxpacket.cycleinfo.dest == self.modem.id):
                     self.modem._changestate(WaitingForMinipacketTxf)
                 else:
                     # Go back to Idle
@@ -503,8 +531,9 @@ class WaitingForRxData(CommState):
     def got_badcrc(self):
         CommState.got_badcrc(self)
 
-        # Add this BAD_CRC as a "frame" to the current packet.
-        this_frame_num = self.modem.current_rxpacket.frames[-1].frame_num + 1
+        # Add this BAD_CRC as a "frame" to the current packet (which may be its first).
+        frames = self.modem.current_rxpacket.frames
+        this_frame_num = frames[-1].frame_num + 1 if frames else 1
         this_quote_frame = DataFrame(self.modem.current_rxpacket.cycleinfo.src,
                                      self.modem.current_rxpacket.cycleinfo.dest,
                                      self.modem.current_rxpacket.cycleinfo.ack,
@@ -0,0 +1,273 @@
+'''
+Compression for acoustic transfers.
+
+Every byte sent costs airtime, so logs and CSV files are worth compressing before they go out.  A Codec compresses
+and decompresses byte strings; the codecs are:
+
+    NullCodec        no compression
+    ZlibCodec        raw DEFLATE (no zlib header or checksum: the link has its own CRCs)
+    LzmaCodec        raw LZMA2
+    DictionaryCodec  DEFLATE primed with a Dictionary trained on typical payloads, which is what makes small
+                     payloads (a packet, a short log) compress at all
+
+A CodecSelector tries its codecs on a sample of the data and picks the one that makes it smallest, falling back to
+NullCodec if none of them is worth it.  Call select() once per file, or once per chunk when streaming.
+
+compress() prefixes the compressed data with a short header (a codec id byte, followed by the 4 byte dictionary id
+for DictionaryCodec) so that decompress() needs nothing else to undo it except the dictionaries:
+
+    data = compress(payload, CodecSelector())
+    payload = decompress(data)
+
+Transfers that have their own session header can carry describe(codec) in it instead, and compress with
+codec.compress() directly.  Trailing padding after compressed data is ignored.
+'''
+
+from collections import Counter
+import heapq
+import lzma
+import struct
+import zlib
+
+
+NONE = 0
+ZLIB = 1
+LZMA = 2
+DICTIONARY = 3
+
+DICTIONARY_ID = struct.Struct('!I')
+
+
+class Dictionary(object):
+    ''' Preset dictionary for DictionaryCodec.  Its id is the CRC-32 of its contents, so both ends agree on it. '''
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.id = zlib.crc32(self.data) & 0xffffffff
+
+    def __repr__(self):
+        return "Dictionary({0:08x}, {1} bytes)".format(self.id, len(self.data))
+
+
+# Dictionaries known to this process, by id.  decompress() looks dictionaries up here by default.
+dictionaries = {}
+
+
+def register_dictionary(dictionary):
+    dictionaries[dictionary.id] = dictionary
+    return dictionary
+
+
+def train_dictionary(samples, size=4096, kmer_length=8, segment_length=32):
+    ''' Build a Dictionary of at most size bytes from a list of sample payloads.
+
+    This is a greedy cover, in the spirit of the zstd dictionary trainer: it repeatedly picks the segment of a sample
+    whose k-mers occur in the most samples (counting only k-mers that aren't in the dictionary yet).  The most useful
+    segments go at the end of the dictionary, where DEFLATE can reach them most cheaply.
+    '''
+    samples = [bytes(sample) for sample in samples if len(sample) >= kmer_length]
+    frequency = Counter()
+    for sample in samples:
+        frequency.update(set(sample[i:i + kmer_length] for i in range(len(sample) - kmer_length + 1)))
+
+    def score(segment):
+        return sum(frequency[segment[i:i + kmer_length]] for i in range(len(segment) - kmer_length + 1)
+                   if segment[i:i + kmer_length] not in covered)
+
+    covered = set()
+    heap = []
+    for sample in samples:
+        for start in range(0, max(len(sample) - segment_length, 0) + 1, kmer_length):
+            segment = sample[start:start + segment_length]
+            heap.append((-score(segment), segment))
+    heapq.heapify(heap)
+
+    chosen = []
+    total = 0
+    while heap and total < size:
+        stale, segment = heapq.heappop(heap)
+        current = score(segment)
+        if current <= 1:
+            # Only in one sample: not worth a place in the dictionary.
+            continue
+        if heap and -current > heap[0][0]:
+            # Scores only go down as the dictionary fills, so this one can be checked again later.
+            heapq.heappush(heap, (-current, segment))
+            continue
+        chosen.append(segment)
+        total += len(segment)
+        covered.update(segment[i:i + kmer_length] for i in range(len(segment) - kmer_length + 1))
+
+    return Dictionary(b''.join(reversed(chosen))[-size:])
+
+
+class NullCodec(object):
+    id = NONE
+    name = 'none'
+    dictionary = None
+
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data):
+        return bytes(data)
+
+
+class ZlibCodec(object):
+    id = ZLIB
+    name = 'zlib'
+    dictionary = None
+
+    def __init__(self, level=9):
+        self.level = level
+
+    def _compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+
+    def _decompressor(self):
+        return zlib.decompressobj(-15)
+
+    def compress(self, data):
+        compressor = self._compressor()
+        return compressor.compress(bytes(data)) + compressor.flush()
+
+    def decompress(self, data):
+        # A decompressobj stops at the end of the stream, so padding after it is ignored.
+        decompressor = self._decompressor()
+        try:
+            result = decompressor.decompress(bytes(data))
+        except zlib.error as e:
+            raise ValueError("Corrupt {0} data: {1}".format(self.name, e))
+        if not decompressor.eof:
+            raise ValueError("Truncated {0} data".format(self.name))
+        return result
+
+
+class DictionaryCodec(ZlibCodec):
+    id = DICTIONARY
+    name = 'dict'
+
+    def __init__(self, dictionary, level=9):
+        super(DictionaryCodec, self).__init__(level)
+        self.dictionary = dictionary
+
+    def _compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=self.dictionary.data)
+
+    def _decompressor(self):
+        return zlib.decompressobj(-15, zdict=self.dictionary.data)
+
+
+class LzmaCodec(object):
+    id = LZMA
+    name = 'lzma'
+    dictionary = None
+
+    def __init__(self, preset=6):
+        self.filters = [{'id': lzma.FILTER_LZMA2, 'preset': preset}]
+
+    def compress(self, data):
+        return lzma.compress(bytes(data), format=lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompress(self, data):
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=self.filters)
+        try:
+            result = decompressor.decompress(bytes(data))
+        except lzma.LZMAError as e:
+            raise ValueError("Corrupt lzma data: {0}".format(e))
+        if not decompressor.eof:
+            raise ValueError("Truncated lzma data")
+        return result
+
+
+class CodecSelector(object):
+    ''' Picks the codec that compresses a sample of the data best.
+
+    :param codecs: Codecs to try (default: zlib, lzma, and a DictionaryCodec for each dictionary given).
+    :param sample_size: Bytes per sample.  Data longer than samples * sample_size is sampled at evenly spaced
+        offsets instead of being compressed whole.
+    :param min_saving: Fraction of the sample a codec has to save to be used instead of no compression.
+    '''
+
+    def __init__(self, codecs=None, dictionaries=(), sample_size=4096, samples=4, min_saving=0.02):
+        if codecs is None:
+            codecs = [ZlibCodec(), LzmaCodec()] + [DictionaryCodec(d) for d in dictionaries]
+        self.codecs = list(codecs)
+        self.sample_size = sample_size
+        self.samples = samples
+        self.min_saving = min_saving
+
+    def sample(self, data):
+        if len(data) <= self.sample_size * self.samples:
+            return bytes(data)
+        step = (len(data) - self.sample_size) // (self.samples - 1) if self.samples > 1 else 0
+        return b''.join(bytes(data[i * step:i * step + self.sample_size]) for i in range(self.samples))
+
+    def select(self, data):
+        sample = self.sample(data)
+        best = NullCodec()
+        best_size = len(sample) * (1 - self.min_saving)
+        for codec in self.codecs:
+            size = len(codec.compress(sample))
+            if size < best_size:
+                best, best_size = codec, size
+        return best
+
+
+def describe(codec):
+    ''' Text form of a codec for session headers: its name, with the dictionary id for DictionaryCodec. '''
+    if codec.dictionary is not None:
+        return "{0}-{1:08x}".format(codec.name, codec.dictionary.id)
+    return codec.name
+
+
+def codec_from_description(description, known_dictionaries=None):
+    ''' Inverse of describe().  Raises KeyError for an unknown codec or dictionary. '''
+    if known_dictionaries is None:
+        known_dictionaries = dictionaries
+    name, _, dictionary_id = description.partition('-')
+    if name == DictionaryCodec.name:
+        return DictionaryCodec(known_dictionaries[int(dictionary_id, 16)])
+    return {NullCodec.name: NullCodec, ZlibCodec.name: ZlibCodec, LzmaCodec.name: LzmaCodec}[name]()
+
+
+def choose_codec(codec_or_selector, data):
+    ''' The codec to compress data with: codec_or_selector itself, or the one it selects if it is a CodecSelector
+    (True or None for a selector over the registered dictionaries).
+    '''
+    if codec_or_selector is None or codec_or_selector is True:
+        codec_or_selector = CodecSelector(dictionaries=dictionaries.values())
+    if isinstance(codec_or_selector, CodecSelector):
+        return codec_or_selector.select(data)
+    return codec_or_selector
+
+
+def compress(data, codec=None):
+    ''' Compress data with a codec, or with the one a CodecSelector picks (default: a selector over the registered
+    dictionaries), and prefix the header.
+    '''
+    codec = choose_codec(codec, data)
+    header = bytes([codec.id])
+    if codec.dictionary is not None:
+        header += DICTIONARY_ID.pack(codec.dictionary.id)
+    return header + codec.compress(data)
+
+
+def decompress(data, known_dictionaries=None):
+    ''' Undo compress().  Raises KeyError for an unknown codec or dictionary, ValueError for corrupt data. '''
+    if known_dictionaries is None:
+        known_dictionaries = dictionaries
+    data = bytes(data)
+    if not data:
+        raise ValueError("No compression header")
+    codec_id = data[0]
+    if codec_id == DICTIONARY:
+        if len(data) < 1 + DICTIONARY_ID.size:
+            raise ValueError("Truncated compression header")
+        dictionary_id, = DICTIONARY_ID.unpack_from(data, 1)
+        codec = DictionaryCodec(known_dictionaries[dictionary_id])
+        data = data[1 + DICTIONARY_ID.size:]
+    else:
+        codec = {NONE: NullCodec, ZLIB: ZlibCodec, LZMA: LzmaCodec}[codec_id]()
+        data = data[1:]
+    return codec.decompress(data)
@@ -0,0 +1,138 @@
+'''
+Pipelined command/response correlation.
+
+Most modem commands (CCCFG, CCCFQ, CCTMS, ...) get a single CA* response.  Rather than sending one command and
+blocking until its response arrives, the correlator keeps several commands in flight, and matches each response to
+its request by sentence type and key parameters (for example, CACFG and the parameter name).
+'''
+
+from collections import deque
+from concurrent.futures import Future
+import threading
+
+
+def key_params_predicate(key_params):
+    ''' Build a predicate that matches messages whose leading parameters equal key_params (compared as strings).
+    None in key_params matches anything.
+    '''
+    expected = [(i, str(p)) for (i, p) in enumerate(key_params) if p is not None]
+    num_params = len(key_params)
+
+    def predicate(msg):
+        msg_params = msg['params']
+        if len(msg_params) < num_params:
+            return False
+        for (i, p) in expected:
+            if msg_params[i] != p:
+                return False
+        return True
+
+    return predicate
+
+
+class _Request(object):
+    __slots__ = ('command', 'response_type', 'key', 'predicate', 'timeout', 'future', 'waiter', 'timer')
+
+    def __init__(self, command, response_type, key_params, timeout):
+        self.command = command
+        self.response_type = response_type
+        self.key = (response_type,) + tuple(str(p) for p in key_params)
+        self.predicate = key_params_predicate(key_params) if key_params else None
+        self.timeout = timeout
+        self.future = Future()
+        self.waiter = None
+        self.timer = None
+
+
+class CommandCorrelator(object):
+    ''' Send modem commands without waiting for the previous response.
+
+    Requests whose responses would be indistinguishable (same response type and key parameters) are sent one at a
+    time, in order.  At most max_in_flight commands are outstanding at once, so that we don't overrun the modem's
+    command buffer.
+    '''
+
+    def __init__(self, modem, max_in_flight=8):
+        self.modem = modem
+        self.max_in_flight = max_in_flight
+
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._in_flight = set()
+        self._busy_keys = set()
+
+    @property
+    def in_flight_count(self):
+        return len(self._in_flight)
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def submit(self, command, response_type, key_params=(), timeout=None):
+        ''' Queue command for transmission, and return a Future for its response.
+        :param command: NMEA message (string or dict) to send.
+        :param response_type: Sentence type of the response, such as 'CACFG'.
+        :param key_params: Leading response parameters that identify the response to this command.
+        :param timeout: Seconds to wait for the response after the command is sent.  On timeout, the future's
+            result is None.
+        '''
+        request = _Request(command, response_type, key_params, timeout)
+        with self._lock:
+            self._pending.append(request)
+        self._pump()
+        return request.future
+
+    def request(self, command, response_type, key_params=(), timeout=None):
+        ''' Send command and block until its response arrives.  Returns the response, or None on timeout. '''
+        return self.wait(self.submit(command, response_type, key_params, timeout))
+
+    def wait(self, future, timeout=None):
+        ''' Wait, on the modem's clock, for a future returned by submit.  Returns its result, or None if it isn't
+        done in time.
+        '''
+        if not self.modem.clock.wait_future(future, timeout):
+            return None
+        return future.result()
+
+    def _pump(self):
+        to_send = []
+        with self._lock:
+            # Walk the queue in order, skipping requests whose key is already in flight.
+            skipped = deque()
+            while self._pending and len(self._in_flight) < self.max_in_flight:
+                request = self._pending.popleft()
+                if request.key in self._busy_keys:
+                    skipped.append(request)
+                    continue
+                self._busy_keys.add(request.key)
+                self._in_flight.add(request)
+                to_send.append(request)
+            skipped.extend(self._pending)
+            self._pending = skipped
+
+        for request in to_send:
+            self._send(request)
+
+    def _send(self, request):
+        # Register before sending, so that even an immediate response is caught.
+        request.waiter = self.modem.waiters.add(request.response_type, request.predicate)
+        if request.timeout is not None:
+            request.timer = self.modem.clock.call_later(request.timeout, request.waiter.cancel)
+        request.waiter.add_done_callback(lambda waiter: self._complete(request))
+        self.modem.write_nmea(request.command)
+
+    def _complete(self, request):
+        if request.timer is not None:
+            request.timer.cancel()
+        with self._lock:
+            self._in_flight.discard(request)
+            self._busy_keys.discard(request.key)
+
+        if request.waiter.cancelled():
+            self.modem._daemon_log.debug("No {0} response to {1}".format(request.response_type, request.command))
+            request.future.set_result(None)
+        else:
+            request.future.set_result(request.waiter.result())
+
+        self._pump()
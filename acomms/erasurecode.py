@@ -0,0 +1,170 @@
+'''
+Systematic Reed-Solomon erasure code over GF(256).
+
+A generation of k source symbols (equal-sized byte strings) is extended with repair symbols, and the k source symbols
+can be recovered from any k distinct symbols of the generation.  Symbol i < k is source symbol i; repair symbol i >= k
+is sum over l of C[i][l] * source[l], where C[i][l] = 1 / (i + l) in GF(256) (addition is XOR) is a Cauchy matrix, so
+every square submatrix is invertible.  Symbol indices fit in a byte, so k plus the number of repair symbols is at most
+256.
+
+The arithmetic is vectorized over the bytes of each symbol: with NumPy (pip install acomms[fec]) through a 256x256
+multiplication table, and without it through bytes.translate and XOR on Python ints, which is slower but needs
+nothing else.
+'''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1 (0x11d) and generator 2.
+EXP = [0] * 512
+LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+del _x, _i
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+# MUL_TABLES[c] maps each byte b to c * b, for bytes.translate.
+MUL_TABLES = [bytes(gf_mul(c, b) for b in range(256)) for c in range(256)]
+
+if numpy is not None:
+    MUL_ARRAY = numpy.frombuffer(b''.join(MUL_TABLES), dtype=numpy.uint8).reshape(256, 256)
+
+
+MAX_SYMBOLS = 256
+
+
+def coefficient(index, source_index):
+    ''' Coefficient of source symbol source_index in symbol index (for index >= k). '''
+    return gf_inv(index ^ source_index)
+
+
+def invert_matrix(matrix):
+    ''' Invert a square matrix (list of lists of ints) over GF(256) by Gauss-Jordan elimination. '''
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv, v) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor:
+                table = MUL_TABLES[factor]
+                rows[r] = [v ^ table[p] for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def _combine_python(coefficients, symbols, symbol_size):
+    acc = 0
+    for c, symbol in zip(coefficients, symbols):
+        if c == 0:
+            continue
+        if c != 1:
+            symbol = symbol.translate(MUL_TABLES[c])
+        acc ^= int.from_bytes(symbol, 'little')
+    return acc.to_bytes(symbol_size, 'little')
+
+
+def _combine_numpy(coefficients, symbols, symbol_size):
+    # symbols is a (len(coefficients), symbol_size) uint8 array.
+    coefficients = numpy.asarray(coefficients, dtype=numpy.uint8)
+    products = MUL_ARRAY[coefficients[:, None], symbols]
+    return numpy.bitwise_xor.reduce(products, axis=0).tobytes()
+
+
+class ErasureCode(object):
+    ''' Encoder and decoder for one generation of k symbols of symbol_size bytes.
+
+    :param use_numpy: Use NumPy if it is installed (default), or force the pure Python code with False.
+    '''
+
+    def __init__(self, k, symbol_size, use_numpy=True):
+        if not 0 < k < MAX_SYMBOLS:
+            raise ValueError("k must be between 1 and {0}".format(MAX_SYMBOLS - 1))
+        self.k = k
+        self.symbol_size = symbol_size
+        self.use_numpy = use_numpy and numpy is not None
+
+    @property
+    def max_repair(self):
+        return MAX_SYMBOLS - self.k
+
+    def _combine(self, coefficients, symbols):
+        if self.use_numpy:
+            array = numpy.frombuffer(b''.join(symbols), dtype=numpy.uint8).reshape(len(symbols), self.symbol_size)
+            return _combine_numpy(coefficients, array, self.symbol_size)
+        return _combine_python(coefficients, symbols, self.symbol_size)
+
+    def encode(self, source, indices):
+        ''' Return the symbols with the given indices (source symbols for indices < k).
+        source is the list of k source symbols, each symbol_size bytes.
+        '''
+        source = [bytes(symbol) for symbol in source]
+        if len(source) != self.k or any(len(symbol) != self.symbol_size for symbol in source):
+            raise ValueError("Expected {0} source symbols of {1} bytes".format(self.k, self.symbol_size))
+        if self.use_numpy:
+            array = numpy.frombuffer(b''.join(source), dtype=numpy.uint8).reshape(self.k, self.symbol_size)
+        encoded = []
+        for index in indices:
+            if not 0 <= index < MAX_SYMBOLS:
+                raise ValueError("Symbol index out of range: {0}".format(index))
+            if index < self.k:
+                encoded.append(source[index])
+                continue
+            coefficients = [coefficient(index, l) for l in range(self.k)]
+            if self.use_numpy:
+                encoded.append(_combine_numpy(coefficients, array, self.symbol_size))
+            else:
+                encoded.append(_combine_python(coefficients, source, self.symbol_size))
+        return encoded
+
+    def decode(self, symbols):
+        ''' Recover the k source symbols from a dict of at least k distinct symbols (index: bytes).
+        Raises ValueError if there are too few.
+        '''
+        if len(symbols) < self.k:
+            raise ValueError("Need {0} symbols, have {1}".format(self.k, len(symbols)))
+        source = [symbols.get(l) for l in range(self.k)]
+        missing = [l for l in range(self.k) if source[l] is None]
+        if not missing:
+            return [bytes(symbol) for symbol in source]
+
+        repair = sorted(i for i in symbols if i >= self.k)[:len(missing)]
+        known = [l for l in range(self.k) if source[l] is not None]
+        known_symbols = [bytes(source[l]) for l in known]
+
+        # Take the known source symbols out of each repair symbol, leaving a combination of the missing ones.
+        residuals = []
+        for index in repair:
+            coefficients = [1] + [coefficient(index, l) for l in known]
+            residuals.append(self._combine(coefficients, [bytes(symbols[index])] + known_symbols))
+
+        inverse = invert_matrix([[coefficient(index, l) for l in missing] for index in repair])
+        for row, l in zip(inverse, missing):
+            source[l] = self._combine(row, residuals)
+        return [bytes(symbol) for symbol in source]
@@ -0,0 +1,364 @@
+'''
+Erasure-coded file transfer.
+
+Round trips on an acoustic link take seconds, so instead of acknowledging and resending frames, FecTransfer sends each
+generation of the file (up to generation_size frames) followed by repair frames from a Reed-Solomon erasure code (see
+erasurecode).  The receiver can rebuild a generation from any generation_size of its frames, whichever ones arrive, so
+losses only cost the redundancy that was sent anyway.  There is a single acknowledgement, from the receiver when it
+has the whole file.
+
+The sender streams the file in rounds: the first round carries every source frame plus redundancy repair frames per
+generation, interleaved across generations so that a burst of losses is spread out.  It then listens for the
+acknowledgement, and if none comes, sends another round of new repair frames.  The receiver sends its acknowledgement
+once it has the whole file and the sender has gone quiet (ack_delay), and again if more frames arrive afterwards.
+
+Each frame starts with a 4 byte header: transfer id, generation number (16 bits) and symbol index.  Generation 0xffff
+is used for control frames: index 0 carries the symbol size, generation size, file size and CRC-32 of the file, and
+is repeated every metadata_interval frames; index 0xff is the acknowledgement.
+'''
+
+from concurrent.futures import Future
+import os
+import struct
+import zlib
+
+from .erasurecode import ErasureCode, MAX_SYMBOLS
+from .messageparams import DataFrame, Rates
+from .unifiedlog import UnifiedLog
+
+
+# transfer id, generation, symbol index
+HEADER = struct.Struct('!BHB')
+# symbol size, generation size, file size, CRC-32 of the file
+METADATA = struct.Struct('!HBII')
+
+CONTROL_GENERATION = 0xffff
+METADATA_INDEX = 0
+ACK_INDEX = 0xff
+ACK_PAYLOAD = b'ACK'
+
+
+class FecTransfer(object):
+    ''' Erasure-coded file transfer to or from dest.  Use send() on one end and recv() (or listen()) on the other.
+
+    :param rate: Packet rate, 0-6, or 'auto' to let the modem's RateController choose.
+    :param generation_size: Source frames per generation (at most 255; the rest of the 256 symbol indices are left for
+        repair frames).
+    :param redundancy: Repair frames sent per source frame in each round, as far as the symbol indices go: with
+        generation_size=200 and redundancy=0.5, the first round has only 56 repair frames per generation.
+    :param ack_timeout: Seconds the sender listens for the acknowledgement after each round.  The default allows for
+        ack_delay, a round trip of up to 15 s and the acknowledgement itself.
+    :param ack_delay: Seconds of quiet the receiver waits for before acknowledging.  Must be longer than a packet
+        (frames are only reported at the end of each one); the default is a packet plus 2 s.
+    '''
+
+    def __init__(self, micromodem, dest, rate=1, generation_size=128, redundancy=0.25, ack_timeout=None,
+                 ack_delay=None, metadata_interval=32, unified_log=None, log_path=None):
+        if rate == 'auto':
+            rate = micromodem.rate_controller.select_rate(dest)
+        assert rate in range(0, 7), "Invalid Rate: %d" % rate
+        assert dest != micromodem.id, "Can't send file to self."
+        assert 0 < generation_size < MAX_SYMBOLS, "Invalid generation size: %d" % generation_size
+
+        self.micromodem = micromodem
+        self.target_id = dest
+        self.rate = Rates[rate]
+        self.symbol_size = self.rate.framesize - HEADER.size
+        self.generation_size = generation_size
+        self.redundancy = redundancy
+        self.ack_delay = ack_delay if ack_delay is not None else self.rate.packet_duration() + 2.0
+        if ack_timeout is None:
+            ack_timeout = self.ack_delay + self.rate.packet_duration(1) + 15.0
+        self.ack_timeout = ack_timeout
+        self.metadata_interval = metadata_interval
+        if unified_log is None:
+            unified_log = UnifiedLog(log_path=log_path)
+        self.log = unified_log.getLogger("fectransfer.{0}".format(micromodem.name))
+
+        # Statistics for the last transfer
+        self.stats = None
+
+        self._transfer_id = None
+        self._acked = None
+        self._rx = None
+
+    # Sender
+
+    def send(self, file_io, max_rounds=8, callback=None):
+        ''' Send everything read from file_io.  Returns True once the receiver acknowledges the whole file.
+        :param max_rounds: Most rounds to send before giving up.
+        :param callback: Called as callback(round, frames_sent) after each round.
+        '''
+        data = file_io.read()
+        if isinstance(data, str):
+            data = data.encode()
+        modem = self.micromodem
+        clock = modem.clock
+        size = self.symbol_size
+        k_max = self.generation_size
+
+        # Split into generations of source symbols; the last symbol is padded out with zeros.
+        chunk = k_max * size
+        generations = []
+        for start in range(0, max(len(data), 1), chunk):
+            block = data[start:start + chunk]
+            source = [block[i:i + size].ljust(size, b'\0') for i in range(0, max(len(block), 1), size)]
+            generations.append((ErasureCode(len(source), size), source))
+        if len(generations) >= CONTROL_GENERATION:
+            self.log.error("File is too large to send at this rate ({0} bytes)".format(len(data)))
+            return False
+
+        self._transfer_id = transfer_id = ord(os.urandom(1))
+        metadata = (HEADER.pack(transfer_id, CONTROL_GENERATION, METADATA_INDEX) +
+                    METADATA.pack(size, k_max, len(data), zlib.crc32(data) & 0xffffffff))
+        self._acked = Future()
+        modem.rxframe_listeners.append(self._on_rxframe)
+
+        start = clock.time()
+        next_index = [0] * len(generations)
+        frames_sent = 0
+        success = False
+        try:
+            for round_num in range(1, max_rounds + 1):
+                # Which symbols of each generation to send this round.  A round stops at the last symbol index, so that
+                # it never sends a symbol twice; once the repair symbols run out, the next round starts over.
+                wanted = []
+                for gen, (code, source) in enumerate(generations):
+                    count = int(round(code.k * self.redundancy)) or 1
+                    if round_num == 1:
+                        count += code.k
+                    count = min(count, MAX_SYMBOLS - next_index[gen])
+                    indices = list(range(next_index[gen], next_index[gen] + count))
+                    next_index[gen] = (next_index[gen] + count) % MAX_SYMBOLS
+                    wanted.append(indices)
+
+                # Interleave the generations.
+                frames = []
+                for position in range(max(len(indices) for indices in wanted)):
+                    for gen, indices in enumerate(wanted):
+                        if position < len(indices):
+                            frames.append((gen, indices[position]))
+
+                # The metadata goes first and then every metadata_interval frames, in case it is lost.
+                encoded = [dict(zip(indices, code.encode(source, indices)))
+                           for (code, source), indices in zip(generations, wanted)]
+                payloads = []
+                for gen, index in frames:
+                    if len(payloads) % self.metadata_interval == 0:
+                        payloads.append(metadata)
+                    payloads.append(HEADER.pack(transfer_id, gen, index) + encoded[gen][index])
+                frames_sent += len(payloads)
+                futures = [self._send_frames(payloads[i:i + self.rate.numframes])
+                           for i in range(0, len(payloads), self.rate.numframes)]
+
+                # Wait for the round to go out, and then listen for the acknowledgement.
+                for future in futures:
+                    clock.wait_future(future, self.rate.packet_duration() + 30)
+                    if self._acked.done():
+                        break
+                if clock.wait_future(self._acked, self.ack_timeout):
+                    success = True
+                    break
+                self.log.info("No acknowledgement after round {0}".format(round_num))
+                if callback is not None:
+                    callback(round_num, frames_sent)
+        finally:
+            modem.rxframe_listeners.remove(self._on_rxframe)
+            self._acked = None
+
+        elapsed = clock.time() - start
+        raw = self.rate.bitrate / 8.0
+        goodput = len(data) / elapsed if success and elapsed > 0 else 0.0
+        self.stats = {'success': success, 'bytes': len(data), 'elapsed': elapsed, 'frames_sent': frames_sent,
+                      'source_frames': sum(code.k for code, source in generations), 'goodput': goodput,
+                      'raw_throughput': raw, 'efficiency': goodput / raw}
+        self.log.info("Transfer {0}: {1} bytes in {2:.1f} s, {3:.1f} B/s ({4:.0%} of the {5:.0f} B/s raw rate), "
+                      "{6} frames for {7} source frames".format("complete" if success else "failed", len(data),
+                                                                elapsed, goodput, goodput / raw, raw, frames_sent,
+                                                                self.stats['source_frames']))
+        return success
+
+    def _send_frames(self, payloads):
+        modem = self.micromodem
+        frames = [DataFrame(modem.id, self.target_id, False, frame_num, payload)
+                  for frame_num, payload in enumerate(payloads, 1)]
+        return modem.send_packet_frames(self.target_id, self.rate.number, frames)
+
+    def _on_rxframe(self, dataframe):
+        if dataframe.bad_crc or dataframe.src != self.target_id or dataframe.dest != self.micromodem.id:
+            return
+        if dataframe.data is None or len(dataframe.data) < HEADER.size or self._acked is None:
+            return
+        transfer_id, gen, index = HEADER.unpack_from(bytes(dataframe.data))
+        if transfer_id == self._transfer_id and gen == CONTROL_GENERATION and index == ACK_INDEX:
+            if not self._acked.done():
+                self._acked.set_result(True)
+
+    # Receiver
+
+    def listen(self, file_io):
+        ''' Start receiving into file_io (anything with write()) without blocking.
+        Returns a future whose result is True when the whole file has arrived and its CRC matches, or False if the
+        CRC doesn't match.  The receiver keeps acknowledging until stop_listening() is called.
+        If a newer transfer's metadata arrives before the file is complete, the receiver starts over on that one,
+        rewinding and truncating file_io if it has already written to it.
+        '''
+        self._rx = _Receiver(self, file_io)
+        self.micromodem.rxframe_listeners.append(self._rx.on_rxframe)
+        return self._rx.done
+
+    def stop_listening(self):
+        if self._rx is not None:
+            self._rx.stop()
+            try:
+                self.micromodem.rxframe_listeners.remove(self._rx.on_rxframe)
+            except ValueError:
+                pass
+
+    def recv(self, file_io, timeout=60, linger=None):
+        ''' Receive a file into file_io.  Gives up if nothing arrives for timeout seconds.
+        After the file is complete, keeps acknowledging repeated frames for linger seconds (default: ack_timeout
+        plus ack_delay), in case the sender missed the acknowledgement.
+        Returns True if the file arrived intact, False if its CRC didn't match, or None if it didn't arrive.
+        '''
+        done = self.listen(file_io)
+        clock = self.micromodem.clock
+        try:
+            while not done.done():
+                frames = self._rx.frames
+                clock.wait_future(done, timeout)
+                if not done.done() and self._rx.frames == frames:
+                    self.log.warn("No frames for {0} s, giving up".format(timeout))
+                    return None
+            clock.sleep(linger if linger is not None else self.ack_timeout + self.ack_delay)
+            return done.result()
+        finally:
+            self.stop_listening()
+
+
+class _Receiver(object):
+    def __init__(self, transfer, file_io):
+        self.transfer = transfer
+        self.file_io = file_io
+        self.done = Future()
+        self.transfer_id = None
+        self.metadata = None
+        # generation: {index: symbol}, until it is decoded
+        self.symbols = {}
+        self.decoded = {}
+        self.next_generation = 0
+        self.written = 0
+        self.crc = 0
+        self.frames = 0
+        self.duplicates = 0
+        self.restarts = 0
+        self._ack_timer = None
+        self._stopped = False
+
+    def on_rxframe(self, dataframe):
+        transfer = self.transfer
+        modem = transfer.micromodem
+        if dataframe.bad_crc or dataframe.src != transfer.target_id or dataframe.dest != modem.id:
+            return
+        if dataframe.data is None or len(dataframe.data) < HEADER.size:
+            return
+        transfer_id, gen, index = HEADER.unpack_from(bytes(dataframe.data))
+        if self.transfer_id is None:
+            self.transfer_id = transfer_id
+        elif transfer_id != self.transfer_id:
+            # The sender runs one transfer at a time, so metadata from another transfer means the one we locked onto
+            # is over (we may have started on the tail of an earlier one).  Anything else from it is stale.
+            if self.done.done() or gen != CONTROL_GENERATION or index != METADATA_INDEX:
+                return
+            self._restart(transfer_id)
+        self.frames += 1
+        payload = bytes(dataframe.data[HEADER.size:])
+
+        if self.done.done():
+            # The sender hasn't heard our acknowledgement yet.
+            self._schedule_ack()
+            return
+
+        if gen == CONTROL_GENERATION:
+            if index == METADATA_INDEX and self.metadata is None:
+                self.metadata = METADATA.unpack(payload[:METADATA.size])
+        elif gen in self.decoded or gen < self.next_generation:
+            self.duplicates += 1
+        else:
+            symbols = self.symbols.setdefault(gen, {})
+            if index in symbols:
+                self.duplicates += 1
+            else:
+                symbols[index] = payload
+        self._decode()
+
+    def _restart(self, transfer_id):
+        ''' Drop what we have of the current transfer and follow transfer_id instead. '''
+        self.transfer.log.warn("Transfer {0:#04x} replaced by {1:#04x}".format(self.transfer_id, transfer_id))
+        self.transfer_id = transfer_id
+        self.metadata = None
+        self.symbols = {}
+        self.decoded = {}
+        self.next_generation = 0
+        self.crc = 0
+        self.restarts += 1
+        if self.written:
+            # What we wrote belongs to the old file.
+            self.file_io.seek(0)
+            self.file_io.truncate()
+            self.written = 0
+
+    def _generation_k(self, gen):
+        symbol_size, generation_size, size, crc = self.metadata
+        total_symbols = max(1, (size + symbol_size - 1) // symbol_size)
+        return min(generation_size, total_symbols - gen * generation_size)
+
+    def _decode(self):
+        if self.metadata is None:
+            return
+        symbol_size, generation_size, size, crc = self.metadata
+        num_generations = max(1, (size + symbol_size * generation_size - 1) // (symbol_size * generation_size))
+        for gen in list(self.symbols):
+            k = self._generation_k(gen)
+            if len(self.symbols[gen]) >= k:
+                code = ErasureCode(k, symbol_size)
+                self.decoded[gen] = code.decode(self.symbols.pop(gen))
+
+        # Write whatever is now in order.
+        while self.next_generation in self.decoded:
+            for symbol in self.decoded.pop(self.next_generation):
+                symbol = symbol[:size - self.written]
+                self.file_io.write(symbol)
+                self.crc = zlib.crc32(symbol, self.crc)
+                self.written += len(symbol)
+            self.next_generation += 1
+
+        if self.next_generation >= num_generations:
+            ok = self.crc & 0xffffffff == crc
+            if not ok:
+                self.transfer.log.error("CRC mismatch on received file")
+            self.done.set_result(ok)
+            self._schedule_ack()
+
+    def _schedule_ack(self):
+        ''' Acknowledge once no frames have arrived for ack_delay seconds. '''
+        if self._stopped:
+            return
+        if self._ack_timer is not None:
+            self._ack_timer.cancel()
+        self._ack_timer = self.transfer.micromodem.clock.call_later(self.transfer.ack_delay, self._send_ack)
+
+    def _send_ack(self):
+        self._ack_timer = None
+        if self._stopped:
+            return
+        transfer = self.transfer
+        modem = transfer.micromodem
+        payload = HEADER.pack(self.transfer_id, CONTROL_GENERATION, ACK_INDEX) + ACK_PAYLOAD
+        frame = DataFrame(modem.id, transfer.target_id, False, 1, payload)
+        modem.send_packet_frames(transfer.target_id, transfer.rate.number, [frame])
+
+    def stop(self):
+        self._stopped = True
+        if self._ack_timer is not None:
+            self._ack_timer.cancel()
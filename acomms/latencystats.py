@@ -0,0 +1,73 @@
+'''
+Running latency statistics with a logarithmic histogram.
+'''
+
+from bisect import bisect_left
+import threading
+
+
+class LatencyStats(object):
+    ''' Count, mean, min/max and a histogram of latencies (in seconds).
+
+    Histogram bucket i counts latencies less than or equal to bucket_edges[i], and greater than the previous edge.
+    The final bucket counts everything larger than the last edge.
+    '''
+
+    # 10 us, 20 us, 40 us ... ~84 s
+    bucket_edges = tuple(1e-5 * 2 ** i for i in range(24))
+
+    def __init__(self, name=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.total = 0.0
+            self.min = None
+            self.max = None
+            self.last = None
+            self.histogram = [0] * (len(self.bucket_edges) + 1)
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.last = seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+            self.histogram[bisect_left(self.bucket_edges, seconds)] += 1
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        ''' Upper bound of the histogram bucket that contains the given fraction (0-1) of the samples. '''
+        with self._lock:
+            if not self.count:
+                return None
+            target = fraction * self.count
+            seen = 0
+            for (i, bucket_count) in enumerate(self.histogram):
+                seen += bucket_count
+                if seen >= target and bucket_count:
+                    if i < len(self.bucket_edges):
+                        return self.bucket_edges[i]
+                    return self.max
+            return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99)}
+
+    def __str__(self):
+        if not self.count:
+            return "{0}: no samples".format(self.name)
+        return "{0}: n={1} mean={2:.3f} ms min={3:.3f} ms max={4:.3f} ms p99<={5:.3f} ms".format(
+            self.name, self.count, self.mean * 1e3, self.min * 1e3, self.max * 1e3, self.percentile(0.99) * 1e3)
@@ -0,0 +1,185 @@
+'''
+Execution policies for modem listener callbacks.
+
+By default, listeners (nmea_listeners, cst_listeners, etc.) run on the connection's read thread, so a slow one holds
+up reading from the modem.  An executor decides where they run instead, and keeps statistics for each listener
+(run time, time spent waiting to run, queue depth) so that a slow listener is easy to find.  Statistics are kept by
+listener name (its qualified name), so that bound methods of objects that come and go add up under one entry instead of
+each keeping its object alive.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+from time import monotonic
+
+from .latencystats import LatencyStats
+
+
+def listener_name(listener):
+    # Callable objects are named after their type: a repr would give each instance its own entry.
+    name = (getattr(listener, '__qualname__', None) or getattr(listener, '__name__', None) or
+            type(listener).__qualname__)
+    return name
+
+
+class ListenerStats(object):
+    ''' Statistics for a single listener. '''
+
+    def __init__(self, name):
+        self.name = name
+        self.run_time = LatencyStats("{0}.run".format(name))
+        self.queue_wait = LatencyStats("{0}.wait".format(name))
+        self.depth = 0
+        self.high_water = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def as_dict(self):
+        return {'name': self.name, 'run_time': self.run_time.as_dict(), 'queue_wait': self.queue_wait.as_dict(),
+                'depth': self.depth, 'high_water': self.high_water, 'errors': self.errors, 'dropped': self.dropped}
+
+
+class InlineExecutor(object):
+    ''' Run each listener immediately, on the thread that received the event. '''
+
+    def __init__(self, log=None):
+        self._log = log
+        self._stats = {}
+        self._stats_lock = Lock()
+
+    def stats_for(self, listener):
+        name = listener_name(listener)
+        stats = self._stats.get(name)
+        if stats is None:
+            with self._stats_lock:
+                stats = self._stats.setdefault(name, ListenerStats(name))
+        return stats
+
+    def listener_stats(self):
+        ''' Statistics for every listener this executor has run, slowest (by mean run time) first. '''
+        with self._stats_lock:
+            stats = list(self._stats.values())
+        stats.sort(key=lambda s: s.run_time.mean or 0, reverse=True)
+        return stats
+
+    def submit(self, listener, *args):
+        stats = self.stats_for(listener)
+        self._run(listener, args, stats, monotonic())
+
+    def _enqueued(self, stats):
+        with self._stats_lock:
+            stats.depth += 1
+            if stats.depth > stats.high_water:
+                stats.high_water = stats.depth
+
+    def _run(self, listener, args, stats, submitted_at):
+        started_at = monotonic()
+        stats.queue_wait.record(started_at - submitted_at)
+        try:
+            listener(*args)
+        except Exception:
+            stats.errors += 1
+            if self._log is not None:
+                self._log.exception("Error in listener {0}".format(stats.name))
+        finally:
+            stats.run_time.record(monotonic() - started_at)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class SerialWorkerExecutor(InlineExecutor):
+    ''' Give each listener its own worker thread and queue, so that listeners run in the order their events arrived,
+    and a slow listener only delays itself.
+    Events for a listener whose queue already holds maxsize events are dropped (and counted).
+    A worker that has had nothing to do for idle_timeout seconds stops, and lets go of its listener (a listener that
+    has been removed gets no more events); the next event for the listener starts a new one.
+    '''
+
+    def __init__(self, log=None, maxsize=10000, idle_timeout=60.0):
+        super(SerialWorkerExecutor, self).__init__(log)
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._queues = {}
+        self._workers_lock = Lock()
+
+    def submit(self, listener, *args):
+        stats = self.stats_for(listener)
+        # Under the lock, so that an idle worker can't stop between finding its queue and putting the event on it.
+        with self._workers_lock:
+            work_queue = self._queues.get(listener)
+            if work_queue is None:
+                work_queue = self._start_worker(listener, stats)
+            try:
+                work_queue.put_nowait((args, monotonic()))
+            except Full:
+                stats.dropped += 1
+                return
+        self._enqueued(stats)
+
+    def _start_worker(self, listener, stats):
+        work_queue = Queue(self.maxsize)
+        worker = Thread(target=self._work, args=(listener, work_queue, stats),
+                        name="listener-{0}".format(stats.name))
+        worker.setDaemon(True)
+        worker.start()
+        self._queues[listener] = work_queue
+        return work_queue
+
+    def _work(self, listener, work_queue, stats):
+        while True:
+            try:
+                item = work_queue.get(timeout=self.idle_timeout)
+            except Empty:
+                with self._workers_lock:
+                    if not work_queue.empty():
+                        continue
+                    if self._queues.get(listener) is work_queue:
+                        del self._queues[listener]
+                return
+            if item is None:
+                return
+            args, submitted_at = item
+            with self._stats_lock:
+                stats.depth -= 1
+            self._run(listener, args, stats, submitted_at)
+
+    def shutdown(self, wait=True):
+        with self._workers_lock:
+            queues = list(self._queues.values())
+            self._queues = {}
+        for work_queue in queues:
+            work_queue.put(None)
+
+
+class ThreadPoolListenerExecutor(InlineExecutor):
+    ''' Run listeners on a shared pool of threads.  Events for the same listener may be handled out of order. '''
+
+    def __init__(self, log=None, max_workers=4):
+        super(ThreadPoolListenerExecutor, self).__init__(log)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="listener")
+
+    def submit(self, listener, *args):
+        stats = self.stats_for(listener)
+        self._enqueued(stats)
+        self._pool.submit(self._run_pooled, listener, args, stats, monotonic())
+
+    def _run_pooled(self, listener, args, stats, submitted_at):
+        with self._stats_lock:
+            stats.depth -= 1
+        self._run(listener, args, stats, submitted_at)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+def make_executor(policy, log=None, **kwargs):
+    ''' Build an executor from a policy name: 'inline', 'serial' (a worker per listener) or 'pool'. '''
+    if policy == 'inline':
+        return InlineExecutor(log)
+    if policy == 'serial':
+        return SerialWorkerExecutor(log, **kwargs)
+    if policy == 'pool':
+        return ThreadPoolListenerExecutor(log, **kwargs)
+    raise ValueError("Unknown listener policy: {0}".format(policy))
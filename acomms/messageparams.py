@@ -1,18 +1,17 @@
-from binascii import hexlify, unhexlify
-# import exceptions
+from binascii import hexlify, unhexlify, Error as BinasciiError
 
 def data_from_hexstring(hexstring):
     databytes = bytearray()
     try:
-        databytes.extend([ord(c) for c in unhexlify(hexstring)])
+        databytes.extend(unhexlify(hexstring))
     #Catch Odd-length String Error
-    except exceptions.TypeError:
+    except (BinasciiError, TypeError):
         pass
     
     return databytes
 
 def hexstring_from_data(databytes):
-    return hexlify(bytes(databytes))
+    return hexlify(bytes(databytes)).decode('ascii')
 
 class CycleInfo(object):
     def __init__(self, src, dest, rate_num, ack=False, num_frames=None):
@@ -93,6 +92,9 @@ class Packet(object):
             self.frames = frames
         else:
             self.frames = []
+
+        # Encoded CCTXD sentence (bytes) for each frame, filled in when the packet is queued for transmission.
+        self.rendered_frames = None
             
     def append_framedata(self, framedata):
         #TODO: Make sure we have room for another frame, and that the data fits in the frame.
@@ -102,29 +104,44 @@ class Packet(object):
             
         
 class PacketRate(object):
-    def __init__(self, name, number, framesize, numframes):
+    def __init__(self, name, number, framesize, numframes, bitrate=None, overhead=0.0):
         self.name = name
         self.number = number
         self.framesize = framesize
         self.numframes = numframes
+        # Approximate information rate (bits/s) and fixed time on the air (probe, cycle init, gaps) in seconds.
+        # Used by the simulators to decide how long a packet takes to send.
+        self.bitrate = bitrate
+        self.overhead = overhead
     
     def getpacketsize(self):
         return self.framesize * self.numframes
         
     maxpacketsize = property(getpacketsize)
 
-Rates = {0:PacketRate('FH-FSK', 0, 32, 1),
-         1:PacketRate('BCH 128:8', 1, 64, 3),
-         2:PacketRate('DSS 1/15 (64B frames)', 2, 64, 3),
-         3:PacketRate('DSS 1/7', 3, 256, 2),
-         4:PacketRate('BCH 64:10', 4, 256, 2),
-         5:PacketRate('Hamming 14:9', 5, 256, 8),
-         6:PacketRate('DSS 1/15 (32B frames)', 6, 32, 6)}
-
-FDPMiniRates = {1:PacketRate('BCH 128:8', 1, 64, 1),
-            3:PacketRate('BCH 64:10', 3, 60, 1),
-            5:PacketRate('Hamming 14:9', 5, 55, 1)}
-FDPDataRates = {1:PacketRate('BCH 128:8', 1, 64, 3),
-                3:PacketRate('BCH 64:10', 3, 100, 1),
-                5:PacketRate('Hamming 14:9', 5, 256, 8)}
+    def packet_duration(self, num_frames=None):
+        ''' Approximate seconds on the air for a packet of num_frames full frames (default: a full packet).
+        Raises ValueError for rates without timing figures (LDRRates).
+        '''
+        if self.bitrate is None:
+            raise ValueError("No bitrate for rate {0} ({1}), so its packet duration is unknown".format(
+                self.number, self.name))
+        if num_frames is None:
+            num_frames = self.numframes
+        return self.overhead + (num_frames * self.framesize * 8.0) / self.bitrate
+
+Rates = {0:PacketRate('FH-FSK', 0, 32, 1, bitrate=80, overhead=0.5),
+         1:PacketRate('BCH 128:8', 1, 64, 3, bitrate=250, overhead=2.5),
+         2:PacketRate('DSS 1/15 (64B frames)', 2, 64, 3, bitrate=300, overhead=2.5),
+         3:PacketRate('DSS 1/7', 3, 256, 2, bitrate=700, overhead=2.5),
+         4:PacketRate('BCH 64:10', 4, 256, 2, bitrate=1300, overhead=2.5),
+         5:PacketRate('Hamming 14:9', 5, 256, 8, bitrate=5300, overhead=2.5),
+         6:PacketRate('DSS 1/15 (32B frames)', 6, 32, 6, bitrate=300, overhead=2.5)}
+
+FDPMiniRates = {1:PacketRate('BCH 128:8', 1, 64, 1, bitrate=400, overhead=0.2),
+            3:PacketRate('BCH 64:10', 3, 60, 1, bitrate=1000, overhead=0.2),
+            5:PacketRate('Hamming 14:9', 5, 55, 1, bitrate=3000, overhead=0.2)}
+FDPDataRates = {1:PacketRate('BCH 128:8', 1, 64, 3, bitrate=400, overhead=0.5),
+                3:PacketRate('BCH 64:10', 3, 100, 1, bitrate=1000, overhead=0.5),
+                5:PacketRate('Hamming 14:9', 5, 256, 8, bitrate=3000, overhead=0.5)}
 LDRRates = {7:PacketRate('BCH 64:10', 1, 260, 1)}
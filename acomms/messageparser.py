@@ -5,29 +5,60 @@ from .timeutil import *
 from . import commstate
 from binascii import hexlify, unhexlify
 import datetime
+from collections import Counter
 import sys
-import traceback
 import os
 
 class MessageParser:
     def __init__(self, modem):
-        self.modem = modem    
-    
-    # This method gets called when the object is called as a function, and
-    # tries to find a matching attribute for that message type.
-    # This is a pythonic(?) way of implementing a switch case.
+        self.modem = modem
+
+        # Number of sentences seen of each type (recognized or not), sentences with no handler, and handler errors.
+        self.type_counts = Counter()
+        self.unknown_counts = Counter()
+        self.error_counts = Counter()
+
+        # Dispatch table of sentence type to handler, built once from the upper-case methods on this class.
+        # Applications can add or replace handlers with register_handler.
+        self._handlers = {}
+        for name in dir(type(self)):
+            if name.isupper():
+                handler = getattr(self, name)
+                if callable(handler):
+                    self._handlers[name] = handler
+
+    def register_handler(self, msg_type, handler):
+        ''' Register a function to be called with each message of type msg_type (for example 'CACFG').
+        This replaces any existing handler for that type.
+        '''
+        if not callable(handler):
+            raise TypeError("Handler for {0} isn't callable".format(msg_type))
+        self._handlers[str(msg_type)] = handler
+
+    def unregister_handler(self, msg_type):
+        ''' Remove the handler for msg_type.  Messages of that type will be counted as unrecognized. '''
+        self._handlers.pop(str(msg_type), None)
+
+    def handled_types(self):
+        return sorted(self._handlers)
+
     def parse(self, msg):
+        msg_type = msg['type']
+        self.type_counts[msg_type] += 1
+
+        func = self._handlers.get(msg_type)
+        if func is None:
+            # Only warn the first time we see each unknown type; after that, just count it.
+            if msg_type not in self.unknown_counts:
+                self.modem._daemon_log.warn('Unrecognized message: ' + str(msg_type))
+            self.unknown_counts[msg_type] += 1
+            return None
+
         try:
-            func = getattr(self, msg['type'])
-        except AttributeError as e:
-            self.modem._daemon_log.warn('Unrecognized message: ' + str(msg['type']))
-            func = None
-        try:
-            if func != None:
-                return func(msg)
-        except Exception as e:
-            self.modem._daemon_log.error("Exception when parsing: " + str(sys.exc_info()[0]))
-            traceback.print_exc()
+            return func(msg)
+        except Exception:
+            self.error_counts[msg_type] += 1
+            self.modem._daemon_log.exception("Exception when parsing " + str(msg_type))
 
     def GPRMC(self,msg):
         pass
@@ -70,10 +101,13 @@ class MessageParser:
         cycleinfo = CycleInfo(src, dest, rate, ack, num_frames)
         
         # Pass this to the comms state machine.
-        self.modem.state.got_cacyc(cycleinfo)
+        with self.modem.state_lock:
+            self.modem.state.got_cacyc(cycleinfo)
+        self.modem.packet_assembler.got_cacyc(cycleinfo)
         
     def CATXF(self, msg):
-        self.modem.state.got_catxf()
+        with self.modem.state_lock:
+            self.modem.state.got_catxf()
         
     def CADRQ(self, msg):
         src = int(msg["params"][1])
@@ -84,7 +118,8 @@ class MessageParser:
         
         drqparams = DrqParams(src, dest, ack, num_bytes, frame_num)
         
-        self.modem.state.got_cadrq(drqparams)
+        with self.modem.state_lock:
+            self.modem.state.got_cadrq(drqparams)
         
     def CARXD(self, msg):
         src = int(msg["params"][0])
@@ -95,21 +130,32 @@ class MessageParser:
         
         dataframe = DataFrame(src, dest, ack, frame_num, data)
         
-        self.modem.state.got_carx(dataframe)
+        with self.modem.state_lock:
+            self.modem.state.got_carx(dataframe)
+        self.modem.packet_assembler.got_rxframe(dataframe)
         self.modem.on_rxframe(dataframe)
         
     def CAMSG(self, msg):
         # CAMSG sucks.  We need to parse it to figure out what's going on.
         # This doesn't account for all of the possible CAMSG messages.
         if msg["params"][0] == "BAD_CRC":
-            self.modem.state.got_badcrc()
+            with self.modem.state_lock:
+                self.modem.state.got_badcrc()
+            try:
+                frame_num = int(msg["params"][1])
+            except (IndexError, ValueError):
+                frame_num = None
+            self.modem.packet_assembler.got_badcrc(frame_num)
         elif msg["params"][0] == "PACKET_TIMEOUT":
-            self.modem.state.got_packettimeout()
+            with self.modem.state_lock:
+                self.modem.state.got_packettimeout()
+            self.modem.packet_assembler.got_packettimeout()
         else:
             try:
                 msg_type = msg["params"][0]
                 number = int(msg["params"][1])
-                self.modem.state.got_camsg(msg_type,number)
+                with self.modem.state_lock:
+                    self.modem.state.got_camsg(msg_type,number)
             except ValueError:
                 pass
         #TODO: Add PSK errors here
@@ -119,17 +165,20 @@ class MessageParser:
         # This doesn't account for most of the CAERR messages.
         if msg["params"][1] == "DATA_TIMEOUT":
             frame_num = msg["params"][2]
-            self.modem.state.got_datatimeout(frame_num)
+            with self.modem.state_lock:
+                self.modem.state.got_datatimeout(frame_num)
         else:
             hhmmss = msg["params"][0]
             module = msg["params"][1]
             err_num = int(msg["params"][2])
             message = msg["params"][3]
-            self.modem.state.got_caerr(hhmmss,module,err_num,message)
+            with self.modem.state_lock:
+                self.modem.state.got_caerr(hhmmss,module,err_num,message)
     
     def CAREV(self, msg):
         '''Revision Message'''
-        self.modem.state.got_carev(msg)
+        with self.modem.state_lock:
+            self.modem.state.got_carev(msg)
         
     def CATXP(self, msg):
         '''Start of Packet Transmission Acoustically'''
@@ -139,14 +188,16 @@ class MessageParser:
         '''Ping Received Acoustically'''
         src = int(msg["params"][0])
         dest = int(msg["params"][1])
-        self.modem.state.got_campa(src,dest)
+        with self.modem.state_lock:
+            self.modem.state.got_campa(src,dest)
         pass
 
     def CADQF(self,msg):
         '''Data Quality Factor Message'''
         dqf= int(msg["params"][0])
         p = int(msg["params"][1])        
-        self.modem.state.got_cadqf(dqf,p)
+        with self.modem.state_lock:
+            self.modem.state.got_cadqf(dqf,p)
         pass
     
     def CARSP(self, msg):
@@ -265,6 +316,7 @@ class MessageParser:
 
             # Raise the event
             self.modem.on_cst(cst, msg)
+            self.modem.packet_assembler.got_cst(cst)
         except Exception as ex:
             self.modem._daemon_log.error("Error parsing CST: " + str(sys.exc_info()[0]))
             raise
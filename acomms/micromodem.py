@@ -1,81 +1,53 @@
 #!/usr/bin/env python
 import os
-from time import sleep, time
+from time import time, monotonic
 from datetime import datetime, date
 from . import timeutil
 import re
 from queue import Empty, Full
 from queue import Queue
+from weakref import WeakSet
 import logging
 import struct
 from collections import namedtuple
 from bitstring import BitArray
 import hashlib
+import threading
 from binascii import hexlify
 from serial import Serial
 import binascii
-import ctypes
 
 from . import commstate
 from .messageparser import MessageParser
+from .clock import REAL_CLOCK
+from .waiterregistry import WaiterRegistry, params_predicate, ANY
+from .correlator import CommandCorrelator
+from .subscription import Subscription, DROP_OLDEST
+from .listenerexecutor import InlineExecutor, make_executor
+from .txscheduler import TxScheduler, PRIORITY_NORMAL
+from .ratecontrol import RateController, AUTO
+from .packetassembler import PacketAssembler
+from . import compression
 from .messageparams import Packet, CycleInfo, hexstring_from_data, Rates, DataFrame, FDPMiniRates, FDPDataRates,LDRRates
 from acomms.modem_connections import SerialConnection
 from acomms.modem_connections import IridiumConnection
 from acomms.modem_connections import SBDEmailConnection
 from .unifiedlog import UnifiedLog
-from functools import reduce
+from .nmeachecksum import nmea_checksum, nmea_checksum32
+from .latencystats import LatencyStats
 
 # Convert a string to a byte listing
 toBytes = lambda inpStr: list(map(ord, inpStr))
 # Convert a list to a hex string (each byte == 2 hex chars)
 toHexStr = lambda inpLst: "".join(["%02X" % x for x in inpLst])
 # Calculate hex-encoded, XOR checksum for input string per NMEA 0183.
-nmeaChecksum = lambda inpStr: toHexStr([reduce(lambda x, y: x ^ y, toBytes(inpStr))])
+nmeaChecksum = nmea_checksum
+# Calculate hex-encoded, 32-bit CRC checksum for input string.
+nmeaChecksum32 = nmea_checksum32
 # Convert boolean to C / CCL / Modem representation (0,1)
 bool2int = lambda inbool: inbool and 1 or 0
 
 
-def nmeaChecksum32(inpStr):
-    crc32tabr = [
-        0x00000000, 0x8c8cd047, 0xb5dec035, 0x39521072, 0xc77ae0d1, 0x4bf63096, 0x72a420e4, 0xfe28f0a3,
-        0x2232a119, 0xaebe715e, 0x97ec612c, 0x1b60b16b, 0xe54841c8, 0x69c4918f, 0x509681fd, 0xdc1a51ba,
-        0x44654232, 0xc8e99275, 0xf1bb8207, 0x7d375240, 0x831fa2e3, 0x0f9372a4, 0x36c162d6, 0xba4db291,
-        0x6657e32b, 0xeadb336c, 0xd389231e, 0x5f05f359, 0xa12d03fa, 0x2da1d3bd, 0x14f3c3cf, 0x987f1388,
-        0x88ca8464, 0x04465423, 0x3d144451, 0xb1989416, 0x4fb064b5, 0xc33cb4f2, 0xfa6ea480, 0x76e274c7,
-        0xaaf8257d, 0x2674f53a, 0x1f26e548, 0x93aa350f, 0x6d82c5ac, 0xe10e15eb, 0xd85c0599, 0x54d0d5de,
-        0xccafc656, 0x40231611, 0x79710663, 0xf5fdd624, 0x0bd52687, 0x8759f6c0, 0xbe0be6b2, 0x328736f5,
-        0xee9d674f, 0x6211b708, 0x5b43a77a, 0xd7cf773d, 0x29e7879e, 0xa56b57d9, 0x9c3947ab, 0x10b597ec,
-        0xbd526873, 0x31deb834, 0x088ca846, 0x84007801, 0x7a2888a2, 0xf6a458e5, 0xcff64897, 0x437a98d0,
-        0x9f60c96a, 0x13ec192d, 0x2abe095f, 0xa632d918, 0x581a29bb, 0xd496f9fc, 0xedc4e98e, 0x614839c9,
-        0xf9372a41, 0x75bbfa06, 0x4ce9ea74, 0xc0653a33, 0x3e4dca90, 0xb2c11ad7, 0x8b930aa5, 0x071fdae2,
-        0xdb058b58, 0x57895b1f, 0x6edb4b6d, 0xe2579b2a, 0x1c7f6b89, 0x90f3bbce, 0xa9a1abbc, 0x252d7bfb,
-        0x3598ec17, 0xb9143c50, 0x80462c22, 0x0ccafc65, 0xf2e20cc6, 0x7e6edc81, 0x473cccf3, 0xcbb01cb4,
-        0x17aa4d0e, 0x9b269d49, 0xa2748d3b, 0x2ef85d7c, 0xd0d0addf, 0x5c5c7d98, 0x650e6dea, 0xe982bdad,
-        0x71fdae25, 0xfd717e62, 0xc4236e10, 0x48afbe57, 0xb6874ef4, 0x3a0b9eb3, 0x03598ec1, 0x8fd55e86,
-        0x53cf0f3c, 0xdf43df7b, 0xe611cf09, 0x6a9d1f4e, 0x94b5efed, 0x18393faa, 0x216b2fd8, 0xade7ff9f,
-        0xd663b05d, 0x5aef601a, 0x63bd7068, 0xef31a02f, 0x1119508c, 0x9d9580cb, 0xa4c790b9, 0x284b40fe,
-        0xf4511144, 0x78ddc103, 0x418fd171, 0xcd030136, 0x332bf195, 0xbfa721d2, 0x86f531a0, 0x0a79e1e7,
-        0x9206f26f, 0x1e8a2228, 0x27d8325a, 0xab54e21d, 0x557c12be, 0xd9f0c2f9, 0xe0a2d28b, 0x6c2e02cc,
-        0xb0345376, 0x3cb88331, 0x05ea9343, 0x89664304, 0x774eb3a7, 0xfbc263e0, 0xc2907392, 0x4e1ca3d5,
-        0x5ea93439, 0xd225e47e, 0xeb77f40c, 0x67fb244b, 0x99d3d4e8, 0x155f04af, 0x2c0d14dd, 0xa081c49a,
-        0x7c9b9520, 0xf0174567, 0xc9455515, 0x45c98552, 0xbbe175f1, 0x376da5b6, 0x0e3fb5c4, 0x82b36583,
-        0x1acc760b, 0x9640a64c, 0xaf12b63e, 0x239e6679, 0xddb696da, 0x513a469d, 0x686856ef, 0xe4e486a8,
-        0x38fed712, 0xb4720755, 0x8d201727, 0x01acc760, 0xff8437c3, 0x7308e784, 0x4a5af7f6, 0xc6d627b1,
-        0x6b31d82e, 0xe7bd0869, 0xdeef181b, 0x5263c85c, 0xac4b38ff, 0x20c7e8b8, 0x1995f8ca, 0x9519288d,
-        0x49037937, 0xc58fa970, 0xfcddb902, 0x70516945, 0x8e7999e6, 0x02f549a1, 0x3ba759d3, 0xb72b8994,
-        0x2f549a1c, 0xa3d84a5b, 0x9a8a5a29, 0x16068a6e, 0xe82e7acd, 0x64a2aa8a, 0x5df0baf8, 0xd17c6abf,
-        0x0d663b05, 0x81eaeb42, 0xb8b8fb30, 0x34342b77, 0xca1cdbd4, 0x46900b93, 0x7fc21be1, 0xf34ecba6,
-        0xe3fb5c4a, 0x6f778c0d, 0x56259c7f, 0xdaa94c38, 0x2481bc9b, 0xa80d6cdc, 0x915f7cae, 0x1dd3ace9,
-        0xc1c9fd53, 0x4d452d14, 0x74173d66, 0xf89bed21, 0x06b31d82, 0x8a3fcdc5, 0xb36dddb7, 0x3fe10df0,
-        0xa79e1e78, 0x2b12ce3f, 0x1240de4d, 0x9ecc0e0a, 0x60e4fea9, 0xec682eee, 0xd53a3e9c, 0x59b6eedb,
-        0x85acbf61, 0x09206f26, 0x30727f54, 0xbcfeaf13, 0x42d65fb0, 0xce5a8ff7, 0xf7089f85, 0x7b844fc2]
-    crc = 0xffffffff
-    bytestring = bytearray(inpStr.encode("iso-8859-1"))
-    for i in range(len(bytestring)):
-        crc = (crc >> 8) ^ crc32tabr[0xff & (crc ^ bytestring[i])]
-    return hex(ctypes.c_uint32(~crc).value)[2:-1].upper()
-
-
 class ChecksumException(Exception):
     pass
 
@@ -93,7 +65,8 @@ class ModemResponseError(Exception):
 
 
 class Micromodem(object):
-    def __init__(self, name='modem', unified_log=None, log_path=None, log_level='INFO'):
+    def __init__(self, name='modem', unified_log=None, log_path=None, log_level='INFO', lazy_messages=False,
+                 clock=None):
 
         name = str(name)
         # Strip non-alphanumeric characters from name
@@ -101,20 +74,46 @@ class Micromodem(object):
 
         self.connection = None
 
+        # All timeouts and sleeps go through this clock (see clock.py).  Pass a VirtualClock to run on simulated time.
+        self.clock = clock if clock is not None else REAL_CLOCK
+
         self.nmea_listeners = []
 
         self.parser = MessageParser(self)
+        # Timeout timer of the current state, and the number of state timeouts that have fired.
+        self.state_timer = None
+        self.state_timeouts = 0
+        # Held for every state transition: the reader thread, the state timers and the tx scheduler all make them.
+        self.state_lock = threading.RLock()
         self.state = commstate.Idle(modem=self)
 
+        # Builds a ReceivedPacket from each receive cycle's CACYC, CARXDs and CACST.  See on_packet.
+        self.packet_assembler = PacketAssembler(self)
+
+        # Link estimates from CACST, used to choose the rate for rate_num='auto'.
+        self.rate_controller = RateController(self)
+
         self.rxframe_listeners = []
+        self.packet_listeners = []
         self.cst_listeners = []
         self.xst_listeners = []
         self.ack_listeners = []
+        self.log_listeners = []
 
         self.incoming_dataframe_queues = []
         self.incoming_cst_queues = []
         self.incoming_xst_queues = []
         self.incoming_msg_queues = []
+        self.incoming_log_queues = []
+
+        # Bounded subscriptions (see subscribe()), held weakly so that abandoned ones detach themselves.
+        self._subscriptions = {'msg': WeakSet(), 'dataframe': WeakSet(), 'packet': WeakSet(), 'cst': WeakSet(),
+                               'xst': WeakSet(), 'log': WeakSet()}
+
+        # Threads blocked in wait_for_* calls register here, keyed by sentence type (or 'cst'/'xst').
+        self.waiters = WaiterRegistry(self.clock)
+        # Matches CA* responses to the commands that asked for them, so that several commands can be in flight.
+        self.correlator = CommandCorrelator(self)
 
         self._api_level = 1
         self.default_nmea_timeout = 1
@@ -131,7 +130,20 @@ class Micromodem(object):
         self.current_rxpacket = None
         self.set_host_clock_flag = False
 
+        # Items are (string, time queued).  Connections drain this as soon as something is put on it.
         self.serial_tx_queue = Queue()
+        # Time from write_nmea/write_string to the write on the connection, for each message.
+        self.tx_latency = LatencyStats("tx")
+        # Connections that don't block on serial_tx_queue set this to be told when something is queued.
+        self.tx_notify = None
+        # Serializes writes to the connection, since CCTXD replies to CADRQ bypass serial_tx_queue.
+        self._write_lock = threading.Lock()
+        # Time from the start of processing a CADRQ to the write of its CCTXD.
+        self.drq_latency = LatencyStats("drq to txd")
+        self._rx_started_at = monotonic()
+
+        # LazyMessage only splits the parameters of sentences that somebody actually looks at.
+        self._message_class = LazyMessage if lazy_messages else Message
 
         self.get_uplink_data_function = None
 
@@ -150,6 +162,12 @@ class Micromodem(object):
         self.unified_log = unified_log
         self.config_data = {}
 
+        # Runs the *_listeners callbacks.  See set_listener_policy.
+        self.listener_executor = InlineExecutor(self._daemon_log)
+
+        # Packets waiting for the state machine to be Idle.  See send_packet.
+        self.tx_scheduler = TxScheduler(self)
+
     @property
     def api_level(self):
         return self._api_level
@@ -162,16 +180,19 @@ class Micromodem(object):
         '''
         self.connect_serial(serialport, baudrate)
 
-    def connect_serial(self, port, baudrate=19200):
-        self.connection = SerialConnection(self, port, baudrate)
+    def connect_serial(self, port, baudrate=19200, hub=None):
+        # Close any previous connection, so that its threads don't compete with the new one's for the queue.
+        self.disconnect()
+        self.connection = SerialConnection(self, port, baudrate, hub=hub)
         self._daemon_log.info("Connected to {0} ({1} bps)".format(port, baudrate))
-        sleep(0.05)
+        self.clock.sleep(0.05)
         self.get_config('SRC')
         # self.query_modem_info()
         # self.query_nmea_api_level()
 
-    def connect_iridium(self, number, port, baudrate=19200):
-        self.connection = IridiumConnection(modem=self, port=port, baudrate=baudrate, number=number)
+    def connect_iridium(self, number, port, baudrate=19200, hub=None):
+        self.disconnect()
+        self.connection = IridiumConnection(modem=self, port=port, baudrate=baudrate, number=number, hub=hub)
         self._daemon_log.info("Connected to Iridium #:{0} on Serial {1}({2} bps)".format(number, port, baudrate))
 
     def connect_sbd_email(self, IMEI, email_account='acomms-sbd@whoi.edu',
@@ -179,6 +200,7 @@ class Micromodem(object):
                           check_rate_sec=30,
                           imap_srv="imap.whoi.edu", imap_port=143,
                           smtp_svr="outbox.whoi.edu", smtp_port=25, DoD=False):
+        self.disconnect()
         self.connection = SBDEmailConnection(modem=self,
                                              IMEI=IMEI,
                                              email_account=email_account,
@@ -197,9 +219,9 @@ class Micromodem(object):
             self.connection = None
 
     def query_modem_info(self):
-        sleep(0.05)
+        self.clock.sleep(0.05)
         self.get_config_param("SRC")
-        sleep(0.05)
+        self.clock.sleep(0.05)
         # All of the salient properties on this object are populated automatically by the NMEA config handler.
 
     def query_nmea_api_level(self):
@@ -262,45 +284,110 @@ class Micromodem(object):
 
         self._daemon_log.debug("Started new NMEA log")
 
-    def _process_outgoing_nmea(self):
-        # Now, transmit anything we have in the outgoing queue.
+    def _process_outgoing_nmea(self, block=False, timeout=None):
+        ''' Transmit everything in the outgoing queue in a single write.
+        If block is set, wait (up to timeout seconds) for something to be queued first.
+        Returns the number of messages written.
+        '''
         try:
-            txstring = self.serial_tx_queue.get_nowait()
-            self.connection.write(txstring)
-            self._nmea_out_log.info(txstring.rstrip('\r\n'))
-        # If the queue is empty, then pass, otherwise log error
+            batch = [self.serial_tx_queue.get(block, timeout)]
         except Empty:
-            pass
+            return 0
+        # Pick up anything else that was queued while we were waiting, so that bursts go out together.
+        while True:
+            try:
+                batch.append(self.serial_tx_queue.get_nowait())
+            except Empty:
+                break
+
+        try:
+            with self._write_lock:
+                self.connection.write("".join([txstring for txstring, enqueued_at in batch]).encode('iso-8859-1'))
         except:
             self._daemon_log.exception("NMEA Output Error")
+            return 0
+
+        written_at = monotonic()
+        for txstring, enqueued_at in batch:
+            self.tx_latency.record(written_at - enqueued_at)
+            self._nmea_out_log.info(txstring.rstrip('\r\n'))
+        self._daemon_log.debug("Wrote {0} queued message(s), oldest waited {1:.1f} ms".format(
+            len(batch), (written_at - batch[0][1]) * 1e3))
+        return len(batch)
 
     def _process_incoming_nmea(self, msg):
+        self._rx_started_at = monotonic()
         if msg is not None:
+            # Connections hand us raw bytes from the wire.
+            if isinstance(msg, (bytes, bytearray)):
+                msg = msg.decode('iso-8859-1')
             try:
                 # self.nmealog.info("< " + msg.rstrip('\r\n'))
                 self._nmea_in_log.info(msg.rstrip('\r\n'))
 
-                msg = Message(msg)
+                msg = self._message_class(msg)
 
                 self.parser.parse(msg)
 
-                try:
-                    for func in self.nmea_listeners:
-                        func(msg)  # Pass the message to any custom listeners.
-                except Exception as e:
-                    self._daemon_log.warn("Error in custom listener: ")
-                    self._daemon_log.warn(repr(e))
+                self.waiters.dispatch(msg['type'], msg)
+
+                for func in self.nmea_listeners:
+                    self.listener_executor.submit(func, msg)  # Pass the message to any custom listeners.
 
                 # Append this message to all listening queues
-                for q in self.incoming_msg_queues:
-                    try:
-                        q.put_nowait(msg)
-                    except:
-                        self._daemon_log.warn("Error appending to incoming message queue")
+                self._publish('msg', self.incoming_msg_queues, msg)
             except ChecksumException:
                 self._daemon_log.warn("NMEA Checksum Error: %s" % (msg.rstrip('\r\n')))
-            except:
-                self._daemon_log.warn("NMEA Input Error")
+            except Exception:
+                self._daemon_log.exception("NMEA Input Error")
+
+    def set_listener_policy(self, policy, **kwargs):
+        ''' Choose where listener callbacks run.
+        :param policy: 'inline' (on the connection's read thread, the default), 'serial' (a worker thread per listener,
+            which keeps each listener's events in order; pass idle_timeout) or 'pool' (a shared thread pool; pass max_workers), or an
+            executor object from acomms.listenerexecutor.
+        '''
+        if isinstance(policy, str):
+            executor = make_executor(policy, self._daemon_log, **kwargs)
+        else:
+            executor = policy
+        old_executor = self.listener_executor
+        self.listener_executor = executor
+        old_executor.shutdown(wait=False)
+
+    def listener_stats(self):
+        ''' Per-listener run time, queue wait and queue depth statistics, slowest listener first. '''
+        return self.listener_executor.listener_stats()
+
+    def _publish(self, kind, queues, item):
+        ''' Put item on the attached queues and subscriptions of the given kind. '''
+        for q in queues:
+            try:
+                q.put_nowait(item)
+            except Full:
+                self._daemon_log.warn("Incoming {0} queue is full, dropping {1}".format(kind, item))
+            except Exception:
+                self._daemon_log.exception("Error appending to incoming {0} queue".format(kind))
+        for subscription in list(self._subscriptions[kind]):
+            subscription.offer(item)
+
+    def subscribe(self, kind, maxsize=1000, policy=DROP_OLDEST, block_timeout=1.0):
+        ''' Return a new bounded Subscription to incoming events.
+        :param kind: 'msg' (every NMEA message), 'dataframe', 'packet' (ReceivedPackets), 'cst', 'xst' or 'log'.
+        :param maxsize: Maximum number of undelivered events (0 for unbounded).
+        :param policy: subscription.DROP_OLDEST, DROP_NEWEST or BLOCK, applied when the subscription is full.
+        The subscription is detached when it is closed or garbage-collected.
+        '''
+        subscriptions = self._subscriptions[kind]
+        subscription = Subscription(maxsize=maxsize, policy=policy, block_timeout=block_timeout,
+                                    name="{0}.{1}".format(self.name, kind), on_close=subscriptions.discard)
+        subscriptions.add(subscription)
+        return subscription
+
+    def subscription_stats(self):
+        ''' Statistics for every attached subscription, by kind. '''
+        return dict((kind, [sub.stats() for sub in list(subscriptions)])
+                    for kind, subscriptions in self._subscriptions.items())
 
     def _message_waiting(self):
         return not self.serial_tx_queue.empty()
@@ -325,6 +412,9 @@ class Micromodem(object):
         self.state = newstate(modem=self)
         self._daemon_log.debug("Changed state to " + str(self.state))
         self.state.entering()
+        if newstate is commstate.Idle:
+            # Start the next queued packet, if there is one.
+            self.tx_scheduler.on_idle()
 
     def write_nmea(self, msg):
         """Call with the message to send, as an NMEA message.  Correct checksum will be computed."""
@@ -342,7 +432,9 @@ class Micromodem(object):
         # Queue this message for transmit in the serial thread
         self._daemon_log.debug("Writing NMEA to output queue: %s" % (message.rstrip('\r\n')))
         try:
-            self.serial_tx_queue.put(message, block=False)
+            self.serial_tx_queue.put((message, monotonic()), block=False)
+            if self.tx_notify is not None:
+                self.tx_notify()
         # If queue full, then ignore
         except Full:
             self._daemon_log.debug("write_nmea: Serial TX Queue Full")
@@ -350,7 +442,9 @@ class Micromodem(object):
     def write_string(self, string):
         self._daemon_log.debug("Writing string to output queue: %s" % (string.rstrip('\r\n')))
         try:
-            self.serial_tx_queue.put(string, block=False)
+            self.serial_tx_queue.put((string, monotonic()), block=False)
+            if self.tx_notify is not None:
+                self.tx_notify()
         # If queue full, then ignore
         except Full:
             self._daemon_log.debug("write_string: Serial TX Queue Full")
@@ -361,13 +455,16 @@ class Micromodem(object):
 
     def get_config(self, param, response_timeout=2):
         msg = {'type': "CCCFQ", 'params': [param]}
+        # Register before sending, so that a fast response can't slip past us.
+        waiter = self.waiters.add('CACFG')
         self.write_nmea(msg)
 
         config_dict = {}
 
         if response_timeout:
             while True:
-                msg = self.wait_for_nmea_type('CACFG', timeout=response_timeout)
+                msg = waiter.wait(response_timeout)
+                waiter = self.waiters.add('CACFG')
                 if msg:
                     param_name = msg['params'][0]
                     param_value = msg['params'][1]
@@ -383,13 +480,28 @@ class Micromodem(object):
                 else:
                     break
 
+            waiter.cancel()
             if config_dict:
                 return config_dict
             else:
                 return None
         else:
+            waiter.cancel()
             return None
 
+    def get_config_many(self, params, response_timeout=2):
+        ''' Query several configuration parameters at once, without waiting for each response before sending the next
+        query.  Returns a dictionary of parameter name to value (None if the modem didn't respond).
+        Configuration groups (like ALL) return more than one response, so use get_config for those.
+        '''
+        futures = [(param, self.correlator.submit({'type': "CCCFQ", 'params': [param]}, 'CACFG', [param],
+                                                  timeout=response_timeout)) for param in params]
+        config_dict = {}
+        for param, future in futures:
+            msg = self.correlator.wait(future)
+            config_dict[param] = msg['params'][1] if msg is not None else None
+        return config_dict
+
     def raw_readline(self):
         """Returns a raw message from the modem."""
         rl = Serial.readline(self)
@@ -411,22 +523,28 @@ class Micromodem(object):
     def on_rxframe(self, dataframe):
         self._daemon_log.debug("I got a frame!  Yay!")
         for func in self.rxframe_listeners:
-            func(dataframe)
+            self.listener_executor.submit(func, dataframe)
         # Append this message to all listening queues
-        for q in self.incoming_dataframe_queues:
-            try:
-                q.put_nowait(dataframe)
-            except:
-                self._daemon_log.warn("Error appending to incoming dataframe queue")
+        self._publish('dataframe', self.incoming_dataframe_queues, dataframe)
+
+    def on_packet(self, packet):
+        ''' A receive cycle is over.  packet is a ReceivedPacket (see packetassembler). '''
+        self._daemon_log.debug("Assembled {0}".format(packet))
+        self.waiters.dispatch('packet', packet, broadcast=False)
+        for func in self.packet_listeners:
+            self.listener_executor.submit(func, packet)
+        self._publish('packet', [], packet)
 
     def on_minipacket_tx_failed(self):
         self._daemon_log.warn("Minipacket transmit failed.")
 
     def on_packettx_failed(self):
         self._daemon_log.warn("Packet transmit failed.")
+        self.tx_scheduler.tx_result(False)
 
     def on_packettx_success(self):
         self._daemon_log.info("Packet transmitted successfully")
+        self.tx_scheduler.tx_result(True)
 
     def on_packetrx_failed(self):
         self._daemon_log.warn("Packet RX failed")
@@ -434,65 +552,85 @@ class Micromodem(object):
     def on_packetrx_success(self):
         self._daemon_log.info("Packet RX succeeded")
 
+    def on_uplink_failed(self):
+        self._daemon_log.warn("Uplink request failed")
+
     def on_ack(self, ack, msg):
         self._daemon_log.debug("Got ACK message")
         for func in self.ack_listeners:
-            func(ack, msg)  # Pass on the ACK message.
+            self.listener_executor.submit(func, ack, msg)  # Pass on the ACK message.
 
     def on_cst(self, cst, msg):
         self._daemon_log.debug("Got CST message")
 
+        self.waiters.dispatch('cst', cst, broadcast=False)
+        self.rate_controller.on_cst(cst, msg)
+
         for func in self.cst_listeners:
-            func(cst, msg)  # Pass on the CST message.
+            self.listener_executor.submit(func, cst, msg)  # Pass on the CST message.
 
         # Append this message to all listening queues
-        for q in self.incoming_cst_queues:
-            try:
-                q.put_nowait(cst)
-            except:
-                self._daemon_log.warn("Error appending to incoming CST queue")
+        self._publish('cst', self.incoming_cst_queues, cst)
 
     def on_xst(self, xst, msg):
         self._daemon_log.debug("Got XST message")
 
+        self.waiters.dispatch('xst', xst, broadcast=False)
+
         for func in self.xst_listeners:
-            func(xst, msg)  # Pass on the CST message.
+            self.listener_executor.submit(func, xst, msg)  # Pass on the CST message.
 
         # Append this message to all listening queues
-        for q in self.incoming_xst_queues:
-            try:
-                q.put_nowait(xst)
-            except:
-                self._daemon_log.warn("Error appending to incoming XST queue")
+        self._publish('xst', self.incoming_xst_queues, xst)
 
     def on_log_msg(self, log, msg):
         self._daemon_log.debug("Got Logged message")
 
         for func in self.log_listeners:
-            func(log, msg)  # Pass on the Log message.
+            self.listener_executor.submit(func, log, msg)  # Pass on the Log message.
 
         # Append this message to all listening queues
-        for q in self.incoming_log_queues:
-            try:
-                q.put_nowait(log)
-            except:
-                self._daemon_log.warn("Error appending to incoming modem log queue")
+        self._publish('log', self.incoming_log_queues, log)
 
-    def send_packet(self, packet):
-        # FIXME this is a hack
-        self.state.send_packet(packet)
+    def send_packet(self, packet, priority=PRIORITY_NORMAL, deadline=None):
+        ''' Queue packet for transmission.  It is sent as soon as the modem is Idle and no packet with a higher priority
+        (lower number) is waiting.  If deadline is set and the packet hasn't started by then (in seconds), it is
+        dropped.  Returns a future whose result is 'sent', 'failed' or 'expired' (see txscheduler).
+        '''
+        # Encode the frames now, so that each CADRQ can be answered without any work.
+        packet.rendered_frames = [self._render_frame(frame) for frame in packet.frames]
+        return self.tx_scheduler.submit(packet, priority, deadline)
 
-    def send_packet_frames(self, dest, rate_num, frames):
+    def send_packet_frames(self, dest, rate_num, frames, priority=PRIORITY_NORMAL, deadline=None):
+        if rate_num == AUTO:
+            rate_num = self.rate_controller.select_rate_for_frames(dest, frames)
         cycleinfo = CycleInfo(self.id, dest, rate_num, False, len(frames))
         packet = Packet(cycleinfo, frames)
 
-        self.send_packet(packet)
+        return self.send_packet(packet, priority, deadline)
+
+    def send_packet_data(self, dest, databytes, rate_num=1, ack=False, priority=PRIORITY_NORMAL, deadline=None,
+                         compress=None):
+        ''' Send databytes (truncated to what fits in one packet) to dest.
+        compress is a compression Codec, a CodecSelector, or True for the default selector; the receiver gets the data
+        back with wait_for_data_packet(decompress=True) or compression.decompress().  Compressed data is never
+        truncated: if it doesn't fit, this raises ValueError (use a segmentation.TransportSender for larger payloads).
+        '''
+        compressed = compress is not None and compress is not False
+        if compressed:
+            databytes = compression.compress(databytes, compress)
 
-    def send_packet_data(self, dest, databytes, rate_num=1, ack=False):
         # When life gives you data, make frames.
+        if rate_num == AUTO:
+            rate_num = self.rate_controller.select_rate(dest, len(databytes))
         rate = Rates[rate_num]
         src = self.id
 
+        # Truncated compressed data can't be decompressed, so don't send it.
+        if compressed and len(databytes) > rate.maxpacketsize:
+            raise ValueError("Compressed data ({0} bytes) doesn't fit in a rate {1} packet ({2} bytes)".format(
+                len(databytes), rate_num, rate.maxpacketsize))
+
         # For now, truncate the data to fit in this packet
         databytes = databytes[0:(rate.maxpacketsize)]
 
@@ -507,9 +645,11 @@ class Micromodem(object):
                 thisframe = DataFrame(src, dest, ack, framenum, thisdata)
                 frames.append(thisframe)
 
-        self.send_packet_frames(dest, rate_num, frames)
+        return self.send_packet_frames(dest, rate_num, frames, priority, deadline)
 
     def send_test_packet(self, dest, rate_num=1, num_frames=None, ack=False): #**LOOK HERE FOR ADDING TESTS
+        if rate_num == AUTO:
+            rate_num = self.rate_controller.select_rate(dest)
         rate = Rates[rate_num]
         src = self.id
 
@@ -534,7 +674,28 @@ class Micromodem(object):
         if frame_num == None:
             frame_num = self.current_tx_frame_num
 
-        self.send_frame(self.current_txpacket.frames[frame_num - 1])
+        rendered = self.current_txpacket.rendered_frames
+        if rendered is not None and frame_num <= len(rendered):
+            self._write_drq_reply(rendered[frame_num - 1])
+        else:
+            self.send_frame(self.current_txpacket.frames[frame_num - 1])
+
+    def _render_frame(self, dataframe):
+        ''' Encode the CCTXD sentence for dataframe, ready to write. '''
+        message = "CCTXD,{0},{1},{2},{3}".format(dataframe.src, dataframe.dest, int(dataframe.ack),
+                                                 hexstring_from_data(dataframe.data))
+        return "${0}*{1}\r\n".format(message, nmeaChecksum(message)).encode('iso-8859-1')
+
+    def _write_drq_reply(self, line):
+        ''' Write an encoded CCTXD straight to the connection, ahead of anything waiting in serial_tx_queue. '''
+        try:
+            with self._write_lock:
+                self.connection.write(line)
+        except Exception:
+            self._daemon_log.exception("NMEA Output Error")
+            return
+        self.drq_latency.record(monotonic() - self._rx_started_at)
+        self._nmea_out_log.info(line.decode('iso-8859-1').rstrip('\r\n'))
 
     def send_frame(self, dataframe):
         # Build the corresponding CCTXD message
@@ -567,9 +728,10 @@ class Micromodem(object):
         else:
             data = bytearray(struct.pack('!BBBBi', 0, 0, 1, 0, int(time())))
 
-        self.send_frame(
+        # We're answering a CADRQ, so don't wait behind the transmit queue.
+        self._write_drq_reply(self._render_frame(
             DataFrame(src=drqparams.src, dest=drqparams.dest, ack=drqparams.ack, frame_num=drqparams.frame_num,
-                      data=data))
+                      data=data)))
 
     def send_ping(self, dest_id):
         # Build the CCMPC message
@@ -652,17 +814,30 @@ class Micromodem(object):
     def set_config(self, name, value, response_timeout=2):
         params = [str(name), str(value)]
         msg = {'type': 'CCCFG', 'params': params}
-        self.write_nmea(msg)
 
         if not response_timeout:
+            self.write_nmea(msg)
             return
 
-        response = self.wait_for_nmea_type('CACFG', timeout=response_timeout, params=params)
+        response = self.correlator.request(msg, 'CACFG', params, timeout=response_timeout)
         if not response:
             return None
         else:
             return {str(name), str(value)}
 
+    def set_config_many(self, config, response_timeout=2):
+        ''' Set several configuration parameters at once, without waiting for each response before sending the next
+        command.  config is a dictionary of parameter name to value.
+        Returns a dictionary of parameter name to the value the modem reported (None if it didn't respond).
+        '''
+        futures = [(name, self.correlator.submit({'type': 'CCCFG', 'params': [str(name), str(value)]}, 'CACFG',
+                                                 [str(name)], timeout=response_timeout))
+                   for name, value in config.items()]
+        results = {}
+        for name, future in futures:
+            msg = self.correlator.wait(future)
+            results[name] = msg['params'][1] if msg is not None else None
+        return results
 
     def set_slot(self, value, response_timeout=2):
         #changes from recovery (0), slot 1 or slot 2
@@ -752,8 +927,7 @@ class Micromodem(object):
                 mode = 3
 
         message = "$CCMEC,{0},{0},{1},{2},{3}".format(self.config_data["SRC"], MECValue, mode, arg)
-        self.write_nmea(message)
-        response = self.wait_for_nmea_type("CAMEC", timeout=self.default_nmea_timeout)
+        response = self.correlator.request(message, "CAMEC", timeout=self.default_nmea_timeout)
         return int(response['params'][4])
 
     def send_passthrough(self, msg):
@@ -808,7 +982,7 @@ class Micromodem(object):
             else:
                 # We need to get a duration in minutes to hibernate.
                 if wake_at is not None:
-                    sleep_delta = wake_at - datetime.utcnow()
+                    sleep_delta = wake_at - self.clock.now()
                 else:
                     sleep_delta = wake_in
 
@@ -833,7 +1007,7 @@ class Micromodem(object):
             else:  # API level 6-9
                 # We need to get a duration in seconds to delay hibernate.
                 if hibernate_at is not None:
-                    delay_delta = hibernate_at - datetime.utcnow()
+                    delay_delta = hibernate_at - self.clock.now()
                     hibernate_delay_secs = delay_delta.days * 84000 + delay_delta.seconds
                 elif hibernate_in is not None:
                     hibernate_delay_secs = hibernate_in.days * 84000 + hibernate_in.seconds
@@ -864,10 +1038,9 @@ class Micromodem(object):
                 wake_time = 0
 
             msg = {'type': 'CCHIB', 'params': [hibernate_time, wake_time]}
-            self.write_nmea(msg)
 
             if not ignore_response:
-                response = self.wait_for_nmea_type("CAHIB", timeout=self.default_nmea_timeout)
+                response = self.correlator.request(msg, "CAHIB", timeout=self.default_nmea_timeout)
                 if response is None:
                     return None
                 # parse the response.
@@ -878,6 +1051,7 @@ class Micromodem(object):
                 ret.wake_time = timeutil.convert_to_datetime(response['params'][3])
                 return ret
 
+            self.write_nmea(msg)
             return None
 
     def set_host_clock_from_modem(self):
@@ -896,7 +1070,7 @@ class Micromodem(object):
             raise UnavailableInApiLevelError
 
         if time_to_set is None:
-            time_to_set = datetime.utcnow()
+            time_to_set = self.clock.now()
 
         if mode is None:
             mode = 0
@@ -904,7 +1078,11 @@ class Micromodem(object):
         # Generate the command
         cmd = {'type': "CCTMS", 'params': ["{0}Z".format(timeutil.to_utc_iso8601(time_to_set, True)), mode]}
         # Send it.
-        self.write_nmea(cmd)
+        if ignore_response:
+            self.write_nmea(cmd)
+        else:
+            # CCTMS may take up to 3 seconds to time out in mode 1.
+            response_future = self.correlator.submit(cmd, 'CATMS', timeout=4)
 
         # If the user has specified a function to call to control the EXTPPS line in mode 1, call it.
         if (mode == 1) and (extpps_drive_fxn is not None):
@@ -912,8 +1090,7 @@ class Micromodem(object):
 
         # If timeout is not None, check the response.
         if not ignore_response:
-            # CCTMS may take up to 3 seconds to time out in mode 1.
-            response = self.wait_for_nmea_type('CATMS', timeout=4)
+            response = self.correlator.wait(response_future)
             if response is None:
                 # We timed out... this could be an error condition
                 return None
@@ -933,9 +1110,7 @@ class Micromodem(object):
         if self._api_level < 11:
             raise UnavailableInApiLevelError
 
-        self.write_nmea("$CCTMQ,0")
-
-        response = self.wait_for_nmea_type("CATMQ", timeout=timeout)
+        response = self.correlator.request("$CCTMQ,0", "CATMQ", timeout=timeout)
         if response is None:
             return None
 
@@ -962,46 +1137,41 @@ class Micromodem(object):
     def detach_incoming_dataframe_queue(self, queue_to_detach):
         self.incoming_dataframe_queues.remove(queue_to_detach)
 
-    def wait_for_data_packet(self, fsk=False, timeout=30):
-        data_frame_queue = Queue()
-        self._daemon_log.debug("wait_for_data_packet: Waiting for CARXP")
-        self.wait_for_nmea_type(type_string='CARXP', timeout=timeout)
-        self.attach_incoming_dataframe_queue(data_frame_queue)
-        self._daemon_log.debug("wait_for_data_packet: Got CARXP")
-        # If FSK packet, wait for secondary CACYC
-        if fsk:
-            # Wait for CST for CACYC
-            self._daemon_log.debug("wait_for_data_packet: Waiting for CACYC CST")
-            cst = self.wait_for_cst(timeout=timeout)
-        # Wait for CST for Data packet.
-        cst = self.wait_for_cst(timeout=timeout)
-        self.detach_incoming_dataframe_queue(data_frame_queue)
-
-        self._daemon_log.debug("wait_for_data_packet: Processing Data Packets Received.")
-        data = bytearray()
-        # Reject packet if some of the data didn't make it or if the message received wasn't for me.
-        if cst is None or cst['bad_frames_num'] > 0 or cst['dest'] != self.id:
-            self._daemon_log.warn("CST not valid. {}".format(cst))
+    def expect_packet(self, predicate=None):
+        ''' Return a future for the next ReceivedPacket that predicate accepts (default: any).
+        Register it before starting whatever will cause the packet to be sent, so that it can't be missed.  Call
+        its wait(timeout) method to block for it; it returns None on timeout.
+        '''
+        return self.waiters.add('packet', predicate=predicate)
+
+    def wait_for_packet(self, timeout=None, predicate=None):
+        return self.expect_packet(predicate).wait(timeout)
+
+    def wait_for_data_packet(self, fsk=False, timeout=30, decompress=False):
+        ''' Wait for a packet addressed to this modem and return its data, or None if it had bad frames or none came.
+        fsk is no longer needed (the assembler sorts out the extra CACST for FSK cycle inits), and is ignored.
+        With decompress, the data is expected to have been sent with send_packet_data(compress=...).
+        '''
+        self._daemon_log.debug("wait_for_data_packet: Waiting for packet")
+        packet = self.wait_for_packet(timeout=timeout, predicate=self._is_data_packet_for_me)
+        return self._data_packet_payload(packet, decompress)
+
+    def _is_data_packet_for_me(self, packet):
+        return packet.dest == self.id
+
+    def _data_packet_payload(self, packet, decompress):
+        ''' The data wait_for_data_packet returns for packet (which may be None, on timeout). '''
+        # Reject packet if some of the data didn't make it.
+        if packet is None or not packet.ok:
+            self._daemon_log.warn("Packet not valid. {}".format(packet))
             return None
-        frame_count = cst['num_frames']
-        self._daemon_log.debug("wait_for_data_packet: Number of Data Frames expected: {}".format(frame_count))
-        while frame_count > 0:
+        data = packet.data
+        if decompress:
             try:
-                data_frame = data_frame_queue.get(block=True, timeout=timeout)
-            except Empty:
-                # Reject packet if not enough data frames were received.
-                self._daemon_log.debug(
-                    "wait_for_data_packet: Empty Dataframe Queue before total frames received. Frames Left:{}".format(
-                        frame_count))
+                data = bytearray(compression.decompress(data))
+            except (KeyError, ValueError) as e:
+                self._daemon_log.warn("Can't decompress packet data: {}".format(e))
                 return None
-            # Reject data_frames not destined for me.
-            if data_frame.dest != self.id:
-                self._daemon_log.debug("wait_for_data_packet: Skipping data frame not destined for {}".format(self.id))
-                continue
-            data.extend(data_frame.data)
-            self._daemon_log.debug("wait_for_data_packet: Processed Frame #{}.".format(frame_count))
-            frame_count = frame_count - 1
-
         self._daemon_log.info("wait_for_data_packet: Returning Data ({}).".format(repr(data)))
         return data
 
@@ -1012,17 +1182,7 @@ class Micromodem(object):
         self.incoming_cst_queues.remove(queue_to_detach)
 
     def wait_for_cst(self, timeout=None):
-        incoming_cst_queue = Queue()
-        self.attach_incoming_cst_queue(incoming_cst_queue)
-
-        try:
-            cst = incoming_cst_queue.get(block=True, timeout=timeout)
-        except Empty:
-            cst = None
-
-        self.detach_incoming_cst_queue(incoming_cst_queue)
-
-        return cst
+        return self.waiters.add('cst').wait(timeout)
 
     def attach_incoming_xst_queue(self, queue_to_attach):
         self.incoming_xst_queues.append(queue_to_attach)
@@ -1031,17 +1191,7 @@ class Micromodem(object):
         self.incoming_xst_queues.remove(queue_to_detach)
 
     def wait_for_xst(self, timeout=None):
-        incoming_xst_queue = Queue()
-        self.attach_incoming_xst_queue(incoming_xst_queue)
-
-        try:
-            xst = incoming_xst_queue.get(block=True, timeout=timeout)
-        except Empty:
-            xst = None
-
-        self.detach_incoming_xst_queue(incoming_xst_queue)
-
-        return xst
+        return self.waiters.add('xst').wait(timeout)
 
     def attach_incoming_msg_queue(self, queue_to_attach):
         self.incoming_msg_queues.append(queue_to_attach)
@@ -1056,98 +1206,16 @@ class Micromodem(object):
         self.incoming_log_queues.remove(queue_to_detach)
 
     def wait_for_regex(self, regex_pattern, timeout=None):
-        incoming_msg_queue = Queue()
-        self.attach_incoming_msg_queue(incoming_msg_queue)
-
         regex = re.compile(regex_pattern)
-        matching_msg = None
-
-        remaining_time = timeout
-        if remaining_time is not None:
-            # If this program is ported to Python 3, this should be changed to use time.steady().
-            end_time = time() + timeout
-
-        while (remaining_time is None) or (remaining_time > 0):
-            try:
-                new_msg = incoming_msg_queue.get(timeout=remaining_time)
-                matchobj = regex.search(new_msg['raw'])
-                if matchobj is not None:
-                    matching_msg = new_msg
-                    break
-                else:
-                    if remaining_time is not None:
-                        remaining_time = end_time - time()
-                    continue
-            except Empty:
-                break
-
-        self.detach_incoming_msg_queue(incoming_msg_queue)
-
-        return matching_msg
+        waiter = self.waiters.add(ANY, predicate=lambda msg: regex.search(msg['raw']) is not None)
+        return waiter.wait(timeout)
 
     def wait_for_nmea_type(self, type_string, timeout=None, params=None):
-        incoming_msg_queue = Queue()
-        self.attach_incoming_msg_queue(incoming_msg_queue)
-
-        matching_msg = None
-
-        remaining_time = timeout
-        if remaining_time is not None:
-            # If this program is ported to Python 3, this should be changed to use time.steady().
-            end_time = time() + timeout
-
-        while (remaining_time is None) or (remaining_time > 0):
-            try:
-                new_msg = incoming_msg_queue.get(timeout=remaining_time)
-                if new_msg['type'] == type_string:
-                    if params:
-                        if len(new_msg['params']) != len(params):
-                            continue
-                        for (n, p) in zip(new_msg['params'], params):
-                            # make sure that any non-None parameter matches.
-                            if p and (n != p):
-                                continue
-
-                    matching_msg = new_msg
-                    break
-                else:
-                    if remaining_time is not None:
-                        remaining_time = end_time - time()
-                    continue
-            except Empty:
-                break
-
-        self.detach_incoming_msg_queue(incoming_msg_queue)
-
-        return matching_msg
+        predicate = params_predicate(params) if params else None
+        return self.waiters.add(type_string, predicate=predicate).wait(timeout)
 
     def wait_for_nmea_types(self, type_string_list, timeout=None):
-        incoming_msg_queue = Queue()
-        self.attach_incoming_msg_queue(incoming_msg_queue)
-
-        matching_msg = None
-
-        remaining_time = timeout
-        if remaining_time is not None:
-            # If this program is ported to Python 3, this should be changed to use time.steady().
-            end_time = time() + timeout
-
-        while (remaining_time is None) or (remaining_time > 0):
-            try:
-                new_msg = incoming_msg_queue.get(timeout=remaining_time)
-                if new_msg['type'] in type_string_list:
-                    matching_msg = new_msg
-                    break
-                else:
-                    if remaining_time is not None:
-                        remaining_time = end_time - time()
-                    continue
-            except Empty:
-                break
-
-        self.detach_incoming_msg_queue(incoming_msg_queue)
-
-        return matching_msg
+        return self.waiters.add(type_string_list).wait(timeout)
 
     def set_uplink_data_function(self, func):
         if hasattr(func, '__call__'):
@@ -1284,3 +1352,103 @@ class Message(dict):
         self['raw'] = raw
 
 
+class LazyMessage(object):
+    ''' Compact alternative to Message.
+    Only the checksum and the sentence type are processed up front.  The parameters are split the first time they are
+    accessed.  msg['type'], msg['params'] and msg['raw'] work as they do for Message, so existing listeners don't need
+    to change.
+    '''
+    __slots__ = ('raw', 'type', '_params_start', '_params_end', '_params')
+
+    _keys = ('type', 'params', 'raw')
+
+    def __init__(self, raw):
+        """Strips off NMEA checksum and leading $, and reads the sentence type
+        (or throws an exception if the checksum is invalid)."""
+        self.raw = raw
+        self._params = None
+
+        start = 1 if raw.startswith('$') else 0
+        end = len(raw.rstrip('\r\n'))
+
+        star = raw.find('*', start, end)
+        if star >= 0:
+            if raw.find('*', star + 1, end) < 0:
+                chksum = raw[star + 1:end]
+                if len(chksum) == 2:
+                    correctChksum = nmea_checksum(raw[start:star])
+                elif len(chksum) == 8:
+                    correctChksum = nmea_checksum32(raw[start:star])
+                else:
+                    correctChksum = chksum
+                if chksum and (chksum != correctChksum):
+                    raise ChecksumException("Checksum Error. Rec'd: %s, Exp'd: %s\n" % (chksum, correctChksum))
+            end = star
+
+        comma = raw.find(',', start, end)
+        if comma < 0:
+            # No parameters at all.
+            self.type = raw[start:end].strip()
+            self._params = []
+        else:
+            self.type = raw[start:comma].strip()
+        self._params_start = comma + 1
+        self._params_end = end
+
+    @property
+    def params(self):
+        if self._params is None:
+            self._params = [part.strip() for part in self.raw[self._params_start:self._params_end].split(',')]
+        return self._params
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return self.type
+        elif key == 'params':
+            return self.params
+        elif key == 'raw':
+            return self.raw
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'type':
+            self.type = value
+        elif key == 'params':
+            self._params = value
+        elif key == 'raw':
+            self.raw = value
+        else:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self[key] for key in self._keys]
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys]
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr(dict(self.items()))
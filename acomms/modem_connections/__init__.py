@@ -1,6 +1,8 @@
 #__author__ = 'Eric'
 
 from .modem_connection import ModemConnection
+from .nmea_framer import NmeaFramer
+from .io_hub import IoHub
 from .iridium_connection import IridiumConnection
 from .serial_connection import SerialConnection
 from .sbd_connection import SBDEmailConnection
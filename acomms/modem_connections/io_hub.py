@@ -0,0 +1,228 @@
+'''
+A single thread that services the connections of many modems.
+
+Instead of each connection running its own listen thread (and waking every read timeout whether or not anything
+arrived), connections that are given a hub register their file descriptor with it.  The hub waits on all of them at
+once with the selectors module (epoll on Linux), reads whatever is available, and writes queued NMEA as soon as it is
+queued.  Timers (call_later) cover the periodic work that used to be done on read timeouts.
+
+Serial ports can only be selected on POSIX systems.
+'''
+
+from collections import deque
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Lock, current_thread
+from time import monotonic
+import logging
+import os
+import selectors
+
+from acomms.clock import TimerHandle
+
+
+class _Reader(object):
+    ''' Selector data for a plain descriptor registered with add_reader. '''
+    __slots__ = ('callback',)
+
+    def __init__(self, callback):
+        self.callback = callback
+
+
+class IoHub(object):
+    ''' Selector-based event loop for modem connections.
+
+    Connections that use a hub provide:
+        fileno() -- the descriptor to wait on for reads
+        _hub_readable() -- called on the hub thread when the descriptor is readable
+        _hub_send(data) -- send as much of data as possible without blocking, and return the number of bytes sent
+        _hub_can_send() -- False to hold queued NMEA in the modem's transmit queue (e.g. Iridium without carrier)
+    '''
+
+    def __init__(self, name='iohub'):
+        self.name = name
+        self._log = logging.getLogger(name)
+
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+        self._callbacks = deque()
+        self._timers = []
+        self._timer_seq = count()
+        self._timer_lock = Lock()
+
+        # Bytes that the connection couldn't take yet, by connection.
+        self._tx_buffers = {}
+        self._tx_lock = Lock()
+
+        self._running = True
+        self._thread = Thread(target=self._run, name=name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @property
+    def connections(self):
+        return list(self._tx_buffers.keys())
+
+    def time(self):
+        ''' The clock that call_later delays are measured on. '''
+        return monotonic()
+
+    def in_hub_thread(self):
+        return current_thread() is self._thread
+
+    def call_soon(self, callback, *args):
+        ''' Run callback(*args) on the hub thread.  Safe to call from any thread. '''
+        self._callbacks.append(partial(callback, *args))
+        self._wake()
+
+    def call_later(self, delay, callback, *args):
+        ''' Run callback(*args) on the hub thread after delay seconds.  Returns a TimerHandle. '''
+        handle = TimerHandle(monotonic() + delay, partial(callback, *args))
+        with self._timer_lock:
+            heappush(self._timers, (handle.when, next(self._timer_seq), handle))
+        if not self.in_hub_thread():
+            self._wake()
+        return handle
+
+    def add(self, connection):
+        ''' Start servicing connection. '''
+        with self._tx_lock:
+            self._tx_buffers[connection] = bytearray()
+        self.call_soon(self._selector.register, connection.fileno(), selectors.EVENT_READ, connection)
+
+    def add_reader(self, fileobj, callback, *args):
+        ''' Call callback(*args) on the hub thread whenever fileobj (a descriptor or object with fileno()) is readable.
+        '''
+        self.call_soon(self._selector.register, fileobj, selectors.EVENT_READ, _Reader(partial(callback, *args)))
+
+    def remove_reader(self, fileobj):
+        self.call_soon(self._unregister, fileobj)
+
+    def remove(self, connection):
+        ''' Stop servicing connection.  Anything it hasn't sent yet is dropped. '''
+        with self._tx_lock:
+            self._tx_buffers.pop(connection, None)
+        self.call_soon(self._unregister, connection.fileno())
+
+    def notify_tx(self, connection):
+        ''' Tell the hub that connection.modem has queued NMEA to send. '''
+        self.call_soon(self._flush_queue, connection)
+
+    def write(self, connection, data):
+        ''' Send data on connection, buffering whatever can't be sent right away. '''
+        with self._tx_lock:
+            buf = self._tx_buffers.get(connection)
+            if buf is None:
+                return
+            buf.extend(data)
+        if self.in_hub_thread():
+            self._send_buffered(connection)
+        else:
+            self.call_soon(self._send_buffered, connection)
+
+    def stop(self):
+        self._running = False
+        self._wake()
+        self._thread.join()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the hub is going to wake up anyway.
+            pass
+
+    def _unregister(self, fd):
+        try:
+            self._selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def _flush_queue(self, connection):
+        if connection in self._tx_buffers and connection._hub_can_send():
+            connection.modem._process_outgoing_nmea()
+
+    def _send_buffered(self, connection):
+        with self._tx_lock:
+            buf = self._tx_buffers.get(connection)
+            if buf is None:
+                return
+            try:
+                while buf:
+                    sent = connection._hub_send(buf)
+                    if not sent:
+                        break
+                    del buf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except Exception:
+                connection.modem._daemon_log.exception("Error writing to connection")
+                del buf[:]
+            events = selectors.EVENT_READ
+            if buf:
+                # Wait for the descriptor to drain before sending the rest.
+                events |= selectors.EVENT_WRITE
+        try:
+            self._selector.modify(connection.fileno(), events, connection)
+        except (KeyError, ValueError):
+            pass
+
+    def _next_timeout(self):
+        if self._callbacks:
+            return 0
+        with self._timer_lock:
+            if not self._timers:
+                return None
+            return max(0, self._timers[0][0] - monotonic())
+
+    def _run_timers(self):
+        now = monotonic()
+        due = []
+        with self._timer_lock:
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heappop(self._timers)[2])
+        for handle in due:
+            if not handle.cancelled:
+                self._run_callback(handle.callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback()
+        except Exception:
+            self._log.exception("Error in hub callback")
+
+    def _run(self):
+        while self._running:
+            for key, mask in self._selector.select(self._next_timeout()):
+                if key.data is None:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                connection = key.data
+                if isinstance(connection, _Reader):
+                    self._run_callback(connection.callback)
+                    continue
+                if mask & selectors.EVENT_READ:
+                    try:
+                        connection._hub_readable()
+                    except Exception:
+                        connection.modem._daemon_log.exception("Error reading from connection")
+                if mask & selectors.EVENT_WRITE:
+                    self._send_buffered(connection)
+
+            self._run_timers()
+
+            # Only run the callbacks that are here now; new ones will get their turn after the next select.
+            for i in range(len(self._callbacks)):
+                self._run_callback(self._callbacks.popleft())
@@ -5,10 +5,11 @@ Created on Jul 13, 2012
 '''
 
 from threading import Thread
-from time import sleep
+import os
 
 from serial import Serial
 from acomms.modem_connections.serial_connection import SerialConnection
+from acomms.modem_connections.nmea_framer import NmeaFramer
 from queue import Empty
 
 
@@ -18,11 +19,12 @@ class IridiumConnection(SerialConnection):
     '''
 
 
-    def __init__(self, modem, port, baudrate, number, timeout=0.1):
+    def __init__(self, modem, port, baudrate, number, timeout=0.1, hub=None):
         '''
         Constructor
         '''
-        self._incoming_line_buffer = ""
+        # The Iridium modem's AT responses don't start with $, so frame on newlines only.
+        self._framer = NmeaFramer(start_bytes=None)
 
         self.connection_type = "direct_iridium"
 
@@ -33,15 +35,20 @@ class IridiumConnection(SerialConnection):
 
         self._serialport = Serial(port, baudrate, timeout=self.timeout)
 
-        self._thread = Thread(target=self._listen)
-        self._thread.setDaemon(True)
-        self._thread.start()
-
         self.state = 'DISCONNECTED'
         self.modem = modem
         self.number = str(number)
         self.counter = 0
 
+        if hub is not None:
+            self._attach_hub(hub)
+            # Stands in for the read timeout that drives the dialer in _listen.
+            self._tick_timer = hub.call_later(self.timeout, self._hub_tick)
+        else:
+            self._thread = Thread(target=self._listen)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
     @property
     def is_connected(self):
         return self._serialport.getCD()
@@ -57,17 +64,47 @@ class IridiumConnection(SerialConnection):
     def _listen(self):
         while True:
             if self._serialport.isOpen():
-                msg = self.readline()
+                lines = self.readlines()
                 if not self._serialport.getCD():
                     # Not connected via Iridium
-                    # Processing I/O with Iridium dialer.
-                    self.process_io(msg)
+                    # Processing I/O with Iridium dialer.  Call it once per timeout even if we got nothing.
+                    if not lines:
+                        self.process_io(None)
+                    for msg in lines:
+                        self.process_io(msg.decode('iso-8859-1'))
                 else:
                     # We are connected, so pass through to NMEA
-                    self.modem._process_incoming_nmea(msg)
+                    for msg in lines:
+                        self.modem._process_incoming_nmea(msg)
                     self.modem._process_outgoing_nmea()
             else:  # not connected
-                sleep(0.5) # Wait half a second, try again.
+                self.modem.clock.sleep(0.5) # Wait half a second, try again.
+
+    def _hub_can_send(self):
+        return self._serialport.getCD()
+
+    def _hub_readable(self):
+        try:
+            rl = os.read(self.fileno(), 4096)
+        except BlockingIOError:
+            return
+        lines = self._framer.feed(rl)
+        if not self._serialport.getCD():
+            for msg in lines:
+                self.process_io(msg.decode('iso-8859-1'))
+        else:
+            for msg in lines:
+                self.modem._process_incoming_nmea(msg)
+
+    def _hub_tick(self):
+        if not self._serialport.isOpen():
+            return
+        if not self._serialport.getCD():
+            self.process_io(None)
+        else:
+            # Send anything that was queued while we were waiting for carrier.
+            self.modem._process_outgoing_nmea()
+        self._tick_timer = self._hub.call_later(self.timeout, self._hub_tick)
 
     def process_io(self, msg):
         # This is called by the primary serial processing loop.
@@ -93,6 +130,9 @@ class IridiumConnection(SerialConnection):
         elif self.state == 'DISCONNECTED':
             self.counter = 0
             self.do_dial()
+        elif self.state == "PREDIAL":
+            # The dialing sequence is running on hub timers.
+            pass
         elif self.state == "CONNECTED":
             # In theory, we shouldn't be here, because if we are connected, traffic is passed through to the umodem module.
             # So, give us a 1 message margin of error (basically, ignore this input) and try dialing on the next timeout/message.
@@ -106,25 +146,45 @@ class IridiumConnection(SerialConnection):
     def do_dial(self):
         # Toggle DTR
         self.modem._daemon_log.info("$IRIDIUM,{0},Dialing {1}".format(self.modem.name, self.number))
-        sleep(2)
-        self._serialport.setDTR(False)
-        sleep(0.1)
-        self._serialport.setDTR(True)
-        sleep(0.1)
-        self._serialport.write("AT+CREG?\r\n")
-        sleep(1)
-        self._serialport.write("AT+CEER\r\n")
-        sleep(1)
-        self._serialport.write("AT+CSQ?\r\n")
-        sleep(5)
-        self._serialport.write("ATD{0}\r\n".format(self.number))
+        # (delay before the step, step)
+        steps = [(2, lambda: self._serialport.setDTR(False)),
+                 (0.1, lambda: self._serialport.setDTR(True)),
+                 (0.1, lambda: self._serialport.write(b"AT+CREG?\r\n")),
+                 (1, lambda: self._serialport.write(b"AT+CEER\r\n")),
+                 (1, lambda: self._serialport.write(b"AT+CSQ?\r\n")),
+                 (5, self._send_dial_command)]
+        if self._hub is None:
+            for delay, step in steps:
+                self.modem.clock.sleep(delay)
+                step()
+        else:
+            # Don't hold up every other connection on the hub for ten seconds.
+            self.state = "PREDIAL"
+            self._run_dial_steps(steps)
+
+    def _run_dial_steps(self, steps):
+        delay, step = steps[0]
+
+        def run_step():
+            step()
+            if len(steps) > 1:
+                self._run_dial_steps(steps[1:])
+
+        self._hub.call_later(delay, run_step)
+
+    def _send_dial_command(self):
+        self._serialport.write("ATD{0}\r\n".format(self.number).encode('ascii'))
         self.state = "DIALING"
 
     def close(self):
+        if self._hub is not None:
+            self._tick_timer.cancel()
+            self._hub.remove(self)
+        self._stop_writer()
         self._serialport.setDTR(False)
-        sleep(0.2)
+        self.modem.clock.sleep(0.2)
         self._serialport.close()
 
     def wait_for_connect(self):
         while self.state != "CONNECTED":
-            sleep(1)
\ No newline at end of file
+            self.modem.clock.sleep(1)
\ No newline at end of file
@@ -1,4 +1,6 @@
 import abc
+from functools import partial
+from threading import Thread, Event, current_thread
 
 class ModemConnection(object):
     ''' Abstract class for connecting to a Micromodem via some protocol (such as serial, TCP, etc).
@@ -6,6 +8,15 @@ class ModemConnection(object):
 
     metaclass__ = abc.ABCMeta
 
+    # The IoHub servicing this connection, or None if it runs its own threads.
+    _hub = None
+
+    # The threads started by _start_reader and _start_writer, and the events that stop them.
+    _reader_thread = None
+    _reader_stop = None
+    _writer_thread = None
+    _writer_stop = None
+
     @abc.abstractproperty
     def is_connected(self):
         pass
@@ -28,4 +39,57 @@ class ModemConnection(object):
 
     @abc.abstractmethod
     def write(self,data):
-        pass
\ No newline at end of file
+        pass
+
+    def _start_reader(self):
+        ''' Start a thread that runs _listen.  _listen should return soon after _reader_stop is set.
+        '''
+        self._reader_stop = Event()
+        self._reader_thread = Thread(target=self._listen)
+        self._reader_thread.setDaemon(True)
+        self._reader_thread.start()
+
+    def _stop_reader(self):
+        ''' Stop the reader thread, if there is one, and wait for it to finish.  This takes up to one read timeout.
+        '''
+        if self._reader_thread is None:
+            return
+        self._reader_stop.set()
+        if self._reader_thread is not current_thread():
+            self._reader_thread.join()
+        self._reader_thread = None
+
+    def _start_writer(self):
+        ''' Start a thread that writes queued NMEA to the connection as soon as it is queued.
+        '''
+        self._writer_stop = Event()
+        self._writer_thread = Thread(target=self._write_loop)
+        self._writer_thread.setDaemon(True)
+        self._writer_thread.start()
+
+    def _write_loop(self):
+        while not self._writer_stop.is_set():
+            # Wakes as soon as write_nmea queues something, and then sends everything that is waiting.  The timeout
+            # bounds how long a stop takes.
+            self.modem._process_outgoing_nmea(block=True, timeout=1.0)
+
+    def _stop_writer(self):
+        ''' Stop the writer thread, if there is one, and wait for it to finish.  Every close() calls this.
+        Anything still queued is left for the next connection to send.
+        '''
+        if self._writer_thread is None:
+            return
+        self._writer_stop.set()
+        if self._writer_thread is not current_thread():
+            self._writer_thread.join()
+        self._writer_thread = None
+
+    def _attach_hub(self, hub):
+        ''' Let a shared IoHub service this connection instead of starting listen and writer threads.
+        '''
+        self._hub = hub
+        self.modem.tx_notify = partial(hub.notify_tx, self)
+        hub.add(self)
+
+    def _hub_can_send(self):
+        return True
\ No newline at end of file
@@ -0,0 +1,105 @@
+'''
+Incremental framing of NMEA sentences from a byte stream.
+
+Connections feed whatever chunk of bytes they just read (a partial line, many lines, or garbage from a noisy link)
+and get back the complete sentences in that chunk.  Partial sentences are kept until the rest arrives.
+'''
+
+
+class NmeaFramer(object):
+    ''' Split a byte stream into complete NMEA sentences ($...*hh\\r\\n).
+
+    :param max_sentence_length: Sentences longer than this (including $ and CR/LF) are discarded.
+    :param start_bytes: Bytes that start a sentence.  Data before a start byte is discarded, which lets the framer
+        resynchronize after line noise.  If None, every newline-terminated line is returned (for AT command
+        responses, which don't start with $).
+    '''
+
+    def __init__(self, max_sentence_length=8192, start_bytes=b'$'):
+        self.max_sentence_length = max_sentence_length
+        self.start_bytes = start_bytes
+
+        self._buffer = bytearray()
+        # How much of the partial sentence at the front of the buffer has already been searched for a newline.
+        self._scanned = 0
+
+        # Statistics
+        self.sentence_count = 0
+        self.discarded_bytes = 0
+        self.overlong_count = 0
+
+    def reset(self):
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    @property
+    def pending_bytes(self):
+        return len(self._buffer)
+
+    def feed(self, chunk):
+        ''' Add chunk to the buffer, and return a list of the complete sentences (as bytes) that are now available. '''
+        buf = self._buffer
+        if chunk:
+            buf.extend(chunk)
+
+        sentences = []
+        pos = 0
+        end = len(buf)
+        start_bytes = self.start_bytes
+        max_length = self.max_sentence_length
+        scanned = self._scanned
+        self._scanned = 0
+
+        with memoryview(buf) as view:
+            while pos < end:
+                if start_bytes is not None:
+                    start = buf.find(start_bytes, pos)
+                    if start < 0:
+                        # No start of sentence anywhere in the buffer, so it's all garbage.
+                        self.discarded_bytes += end - pos
+                        pos = end
+                        break
+                    if start > pos:
+                        self.discarded_bytes += start - pos
+                else:
+                    start = pos
+
+                newline = buf.find(b'\n', max(start, scanned))
+                scanned = 0
+                if newline < 0:
+                    if end - start > max_length:
+                        # This sentence is already too long.  Drop it and look for the next one.
+                        self.overlong_count += 1
+                        pos = self._resync(buf, start, end)
+                        continue
+                    pos = start
+                    self._scanned = end - start
+                    break
+
+                if start_bytes is not None:
+                    # A start byte inside the line means the sentence before it was cut off.
+                    restart = buf.rfind(start_bytes, start + 1, newline)
+                    if restart >= 0:
+                        self.discarded_bytes += restart - start
+                        start = restart
+
+                if newline + 1 - start > max_length:
+                    self.overlong_count += 1
+                    self.discarded_bytes += newline + 1 - start
+                else:
+                    sentences.append(bytes(view[start:newline + 1]))
+                pos = newline + 1
+
+        if pos:
+            del buf[:pos]
+        self.sentence_count += len(sentences)
+        return sentences
+
+    def _resync(self, buf, start, end):
+        if self.start_bytes is not None:
+            next_start = buf.find(self.start_bytes, start + 1, end)
+            if next_start >= 0:
+                self.discarded_bytes += next_start - start
+                return next_start
+        self.discarded_bytes += end - start
+        return end
@@ -1,13 +1,13 @@
 #__author__ = 'andrew'
 
 from acomms.modem_connections import ModemConnection
+from acomms.modem_connections.nmea_framer import NmeaFramer
 from threading import Thread
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
 import email, os
-from time import sleep
 import imaplib
 import datetime
 
@@ -32,6 +32,7 @@ class SBDEmailConnection(ModemConnection):
         self.last_read = datetime.datetime.now()
         self.UseDoDEmail = DoD
         self.Alive = True
+        self._framer = NmeaFramer()
         self._threadL = Thread(target=self._listen)
         self._threadL.setDaemon(True)
         self._threadL.start()
@@ -54,7 +55,7 @@ class SBDEmailConnection(ModemConnection):
     def _talk(self):
         while self.Alive:
             self.modem._process_outgoing_nmea()
-            sleep(self.email_check_rate)
+            self.modem.clock.sleep(self.email_check_rate)
 
     def _listen(self):
         if self.UseDoDEmail:
@@ -91,12 +92,12 @@ class SBDEmailConnection(ModemConnection):
                     if fileext != '.sbd':
                         continue
                     msg = part.get_payload(decode=True)
-                    for line in msg.splitlines(True):
+                    for line in self._framer.feed(msg):
                         self.modem._process_incoming_nmea(line)
                     temp = M.store(emailid,'+FLAGS', '\\Seen')
             M.close()
             M.logout()
-            sleep(self.email_check_rate * 60) # Wait a minute and try again.
+            self.modem.clock.sleep(self.email_check_rate * 60) # Wait a minute and try again.
 
     def write(self,msg):
         email_msg = MIMEMultipart()
@@ -107,7 +108,7 @@ class SBDEmailConnection(ModemConnection):
             email_msg['To'] = 'data@sbd.iridium.com'
         email_msg['From'] = "{0}".format(self.FROM)
 
-        part = MIMEText(msg)
+        part = MIMEText(msg.decode('iso-8859-1'))
         email_msg.attach(part)
 
         attachment = MIMEApplication(msg)
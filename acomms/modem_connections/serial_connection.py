@@ -1,14 +1,14 @@
 
 from acomms.modem_connections import ModemConnection
+from acomms.modem_connections.nmea_framer import NmeaFramer
 from serial import Serial
-from time import sleep
-from threading import Thread
+import os
 
 
 class SerialConnection(ModemConnection):
 
-    def __init__(self, modem, port, baudrate, timeout=0.1):
-        self._incoming_line_buffer = ""
+    def __init__(self, modem, port, baudrate, timeout=0.1, hub=None):
+        self._framer = NmeaFramer()
 
         self.connection_type = "serial"
 
@@ -19,9 +19,11 @@ class SerialConnection(ModemConnection):
 
         self._serialport = Serial(port, baudrate, timeout=self.timeout)
 
-        self._thread = Thread(target=self._listen)
-        self._thread.setDaemon(True)
-        self._thread.start()
+        if hub is not None:
+            self._attach_hub(hub)
+        else:
+            self._start_reader()
+            self._start_writer()
 
     @property
     def is_connected(self):
@@ -38,35 +40,50 @@ class SerialConnection(ModemConnection):
 
 
     def close(self):
-        #self._listen.stop()
+        if self._hub is not None:
+            self._hub.remove(self)
+        self._stop_reader()
+        self._stop_writer()
         self._serialport.close()
 
     def _listen(self):
-        while True:
+        while not self._reader_stop.is_set():
             if self._serialport.isOpen():
-                msg = self.readline()
-                # We are connected, so pass through to NMEA
-                self.modem._process_incoming_nmea(msg)
-                self.modem._process_outgoing_nmea()
+                for msg in self.readlines():
+                    # We are connected, so pass through to NMEA
+                    self.modem._process_incoming_nmea(msg)
             else: # not connected
-                sleep(0.5) # Wait half a second, try again.
-
-    def readline(self):
-        """Returns a \n terminated line from the modem.  Only returns complete lines (or None on timeout)"""
-        rl = self._serialport.readline()
+                self.modem.clock.sleep(0.5) # Wait half a second, try again.
 
-        if rl == "":
-            return None
-
-        # Make sure we got a complete line.  Serial.readline may return data on timeout.
-        if rl[-1] != '\n':
-            self._incoming_line_buffer += rl
-            return None
-        else:
-            if self._incoming_line_buffer != "":
-                rl = self._incoming_line_buffer + rl
-            self._incoming_line_buffer = ""
-            return rl
+    def readlines(self):
+        """Returns a list of the complete lines (as bytes) received from the modem.  May be empty on timeout."""
+        # Block for up to one timeout waiting for the first byte, then take everything that has arrived.
+        rl = self._serialport.read(max(1, self._serialport.inWaiting()))
+        if not rl:
+            return []
+        return self._framer.feed(rl)
 
     def write(self, data):
-        self._serialport.write(data)
+        if self._hub is not None:
+            self._hub.write(self, data)
+        else:
+            self._serialport.write(data)
+
+    def fileno(self):
+        return self._serialport.fileno()
+
+    def _hub_readable(self):
+        try:
+            rl = os.read(self.fileno(), 4096)
+        except BlockingIOError:
+            return
+        if not rl:
+            # Readable with nothing to read means the port went away (e.g. a USB adapter was unplugged).
+            self.modem._daemon_log.error("Serial port {0} closed".format(self.port))
+            self._hub.remove(self)
+            return
+        for msg in self._framer.feed(rl):
+            self.modem._process_incoming_nmea(msg)
+
+    def _hub_send(self, data):
+        return os.write(self.fileno(), data)
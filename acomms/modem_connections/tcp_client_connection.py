@@ -1,14 +1,13 @@
 
 from acomms.modem_connections import ModemConnection
-from time import sleep
-from threading import Thread
+from acomms.modem_connections.nmea_framer import NmeaFramer
 
 import socket
 
 class TcpClientConnection(ModemConnection):
 
-    def __init__(self, modem, remote_host, remote_port, local_host=None, local_port=None, timeout=0.1):
-        self._incoming_line_buffer = ""
+    def __init__(self, modem, remote_host, remote_port, local_host=None, local_port=None, timeout=0.1, hub=None):
+        self._framer = NmeaFramer()
 
         self.connection_type = "udp"
 
@@ -30,10 +29,14 @@ class TcpClientConnection(ModemConnection):
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.connect((self._remote_host, self._remote_port))
-
-        self._thread = Thread(target=self._listen)
-        self._thread.setDaemon(True)
-        self._thread.start()
+        if hub is not None:
+            self._socket.setblocking(False)
+            self._attach_hub(hub)
+        else:
+            # Don't block forever in recv, so that the listen loop turns over.
+            self._socket.settimeout(self.timeout)
+            self._start_reader()
+            self._start_writer()
 
     @property
     def is_connected(self):
@@ -48,41 +51,55 @@ class TcpClientConnection(ModemConnection):
 
 
     def close(self):
-        self._thread.stop()
+        self._stop_writer()
+        if self._hub is not None:
+            self._hub.remove(self)
+        else:
+            self._stop_reader()
         self._socket.close()
 
     def _listen(self):
-        while True:
+        while not self._reader_stop.is_set():
             msg_lines = self.readlines()
             # We are connected, so pass through to NMEA
-            if msg_lines is not None:
-                for line in msg_lines:
-                    self.modem._process_incoming_nmea(line)
-            self.modem._process_outgoing_nmea()
+            for line in msg_lines:
+                self.modem._process_incoming_nmea(line)
 
     def readlines(self):
-        """Returns a \n terminated line from the modem.  Only returns complete lines (or None on timeout)"""
-        rl = self._socket.recv(1024)
+        """Returns a list of the complete lines (as bytes) received from the modem.  May be empty on timeout."""
+        try:
+            rl = self._socket.recv(4096)
+        except socket.timeout:
+            return []
 
-        if rl == "":
-            return None
+        if not rl:
+            # The other end closed the connection.  Wait a bit rather than spinning on recv.
+            self.modem.clock.sleep(self.timeout)
+            return []
 
-        self._incoming_line_buffer += rl
-
-        # Make sure we got a complete line.  Serial.readline may return data on timeout.
-        if '\n' in self._incoming_line_buffer:
-            # is there a newline at the end?
-            lines = self._incoming_line_buffer.splitlines(True)
-            # See if the last line has a newline at the end.
-            if lines[-1][-1] != '\n':
-                self._incoming_line_buffer = lines[-1]
-                lines.pop() # remove it from the list to passed on
-
-            # return the list of complete lines
-            return lines
-        else:
-            return None
+        return self._framer.feed(rl)
 
 
     def write(self, data):
-        self._socket.send(data)
+        if self._hub is not None:
+            self._hub.write(self, data)
+        else:
+            self._socket.send(data)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def _hub_readable(self):
+        try:
+            rl = self._socket.recv(4096)
+        except BlockingIOError:
+            return
+        if not rl:
+            self.modem._daemon_log.error("Connection to {0}:{1} closed".format(self._remote_host, self._remote_port))
+            self._hub.remove(self)
+            return
+        for line in self._framer.feed(rl):
+            self.modem._process_incoming_nmea(line)
+
+    def _hub_send(self, data):
+        return self._socket.send(data)
@@ -1,6 +1,7 @@
 #__author__ = 'andrew'
 
 from .modem_connection import ModemConnection
+from .nmea_framer import NmeaFramer
 import asyncore
 from socket import AF_INET, SOCK_STREAM
 from threading import Thread
@@ -15,7 +16,7 @@ class TcpConnection(ModemConnection, asyncore.dispatcher_with_send):
         asyncore.dispatcher_with_send.__init__(self)
         self.create_socket(AF_INET, SOCK_STREAM)
         self.connect((remote_host, remote_port))
-        self.io_file = self.socket.makefile()
+        self._framer = NmeaFramer()
         self.modem = modem
 
         self._thread = Thread(target=self._listen)
@@ -41,15 +42,14 @@ class TcpConnection(ModemConnection, asyncore.dispatcher_with_send):
         return 9600
 
     def handle_close(self):
-        self.io_file.close()
         asyncore.dispatcher_with_send.close(self)
 
     def writable(self):
         return self.modem._message_waiting()
 
     def handle_read(self):
-        msg = self.io_file.readline()
-        self.modem._process_incoming_nmea(msg)
+        for msg in self._framer.feed(self.recv(4096)):
+            self.modem._process_incoming_nmea(msg)
 
 
     def handle_write(self):
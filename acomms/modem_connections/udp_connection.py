@@ -1,14 +1,13 @@
 
 from acomms.modem_connections import ModemConnection
-from time import sleep
-from threading import Thread
+from acomms.modem_connections.nmea_framer import NmeaFramer
 
 import socket
 
 class UdpConnection(ModemConnection):
 
-    def __init__(self, modem, remote_host, remote_port, local_host=None, local_port=None, timeout=0.1):
-        self._incoming_line_buffer = ""
+    def __init__(self, modem, remote_host, remote_port, local_host=None, local_port=None, timeout=0.1, hub=None):
+        self._framer = NmeaFramer()
 
         self.connection_type = "udp"
 
@@ -30,12 +29,17 @@ class UdpConnection(ModemConnection):
 
         self._receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._receive_socket.bind((self._local_host, self._local_port))
-
         self._transmit_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-        self._thread = Thread(target=self._listen)
-        self._thread.setDaemon(True)
-        self._thread.start()
+        if hub is not None:
+            self._receive_socket.setblocking(False)
+            self._transmit_socket.setblocking(False)
+            self._attach_hub(hub)
+        else:
+            # Don't block forever in recv, so that the listen loop turns over.
+            self._receive_socket.settimeout(self.timeout)
+            self._start_reader()
+            self._start_writer()
 
     @property
     def is_connected(self):
@@ -50,40 +54,48 @@ class UdpConnection(ModemConnection):
 
 
     def close(self):
-        self._thread.stop()
+        self._stop_writer()
+        if self._hub is not None:
+            self._hub.remove(self)
+        else:
+            self._stop_reader()
+        self._receive_socket.close()
+        self._transmit_socket.close()
 
     def _listen(self):
-        while True:
+        while not self._reader_stop.is_set():
             msg_lines = self.readlines()
             # We are connected, so pass through to NMEA
             for line in msg_lines:
                 self.modem._process_incoming_nmea(line)
-            self.modem._process_outgoing_nmea()
 
     def readlines(self):
-        """Returns a \n terminated line from the modem.  Only returns complete lines (or None on timeout)"""
-        rl = self._receive_socket.recv(1024)
-
-        if rl == "":
-            return None
-
-        self._incoming_line_buffer += rl
-
-        # Make sure we got a complete line.  Serial.readline may return data on timeout.
-        if '\n' in self._incoming_line_buffer:
-            # is there a newline at the end?
-            lines = self._incoming_line_buffer.splitlines(True)
-            # See if the last line has a newline at the end.
-            if lines[-1][-1] != '\n':
-                self._incoming_line_buffer = lines[-1]
-                lines.pop() # remove it from the list to passed on
-            else:
-                self._incoming_line_buffer = ''
-            # return the list of complete lines
-            return lines
-        else:
-            return None
+        """Returns a list of the complete lines (as bytes) received from the modem.  May be empty on timeout."""
+        try:
+            rl = self._receive_socket.recv(65535)
+        except socket.timeout:
+            return []
+
+        return self._framer.feed(rl)
 
 
     def write(self, data):
-        self._transmit_socket.sendto(data, (self._remote_host, self._remote_port))
+        if self._hub is not None:
+            self._hub.write(self, data)
+        else:
+            self._transmit_socket.sendto(data, (self._remote_host, self._remote_port))
+
+    def fileno(self):
+        return self._receive_socket.fileno()
+
+    def _hub_readable(self):
+        try:
+            rl = self._receive_socket.recv(65535)
+        except BlockingIOError:
+            return
+        for line in self._framer.feed(rl):
+            self.modem._process_incoming_nmea(line)
+
+    def _hub_send(self, data):
+        # Datagrams go whole or not at all.
+        return self._transmit_socket.sendto(data, (self._remote_host, self._remote_port))
@@ -0,0 +1,97 @@
+'''
+Table-driven NMEA checksum engine.
+
+All tables are built once at import time.  The functions accept str, bytes, bytearray or memoryview, and work directly
+on the underlying bytes (str is encoded as ISO-8859-1, which maps each character to a single byte).
+'''
+
+from functools import reduce
+from operator import xor
+import crcmod
+
+# Two-character, upper-case hex strings for every byte value.
+_HEX_BYTE = tuple('{:02X}'.format(i) for i in range(256))
+
+# Below this length, a plain reduce is faster than folding a big integer.
+_FOLD_THRESHOLD = 48
+
+# The 32-bit checksum used by the Micromodem is a reflected CRC-32 with this (reflected) polynomial,
+# initial value 0xFFFFFFFF and a final inversion.
+CRC32_POLY_REFLECTED = 0xD663B05D
+_crc32 = crcmod.mkCrcFun(0x1BA0DC66B, initCrc=0, rev=True, xorOut=0xFFFFFFFF)
+
+
+def _as_bytes(data):
+    if isinstance(data, str):
+        return data.encode('iso-8859-1')
+    return data
+
+
+def xor_checksum(data):
+    ''' Return the NMEA 0183 XOR checksum of data as an integer. '''
+    data = _as_bytes(data)
+    num_bytes = len(data)
+    if num_bytes < _FOLD_THRESHOLD:
+        return reduce(xor, data, 0)
+    # For longer sentences, XOR the bytes in parallel by folding one big integer in half until 8 bits remain.
+    value = int.from_bytes(data, 'little')
+    width = 8
+    while width < num_bytes * 8:
+        width <<= 1
+    while width > 8:
+        width >>= 1
+        value = (value >> width) ^ (value & ((1 << width) - 1))
+    return value
+
+
+def nmea_checksum(data):
+    ''' Return the two-character, hex-encoded XOR checksum of data (the part between $ and *). '''
+    return _HEX_BYTE[xor_checksum(data)]
+
+
+def crc32_checksum(data):
+    ''' Return the 32-bit Micromodem checksum of data as an integer. '''
+    return _crc32(_as_bytes(data))
+
+
+def nmea_checksum32(data):
+    ''' Return the eight-character, hex-encoded 32-bit checksum of data (the part between $ and *). '''
+    return '{:08X}'.format(_crc32(_as_bytes(data)))
+
+
+def split_sentence(line):
+    ''' Split an NMEA line into (body, checksum).
+    The leading $ and trailing CR/LF are removed.  body is a memoryview of the bytes between $ and *; checksum is the
+    checksum text as a str, or None if the sentence doesn't carry a checksum.
+    '''
+    line = _as_bytes(line)
+    if isinstance(line, memoryview):
+        line = line.tobytes()
+    view = memoryview(line)
+    start = 1 if line[:1] == b'$' else 0
+    end = len(line)
+    while end > start and line[end - 1] in (10, 13):
+        end -= 1
+    star = line.rfind(b'*', start, end)
+    if star < 0:
+        return view[start:end], None
+    return view[start:star], bytes(view[star + 1:end]).decode('iso-8859-1')
+
+
+def validate(line, require_checksum=False):
+    ''' Returns True if the checksum on line is correct.
+    Sentences without a checksum are accepted unless require_checksum is set.
+    '''
+    body, checksum = split_sentence(line)
+    if checksum is None:
+        return not require_checksum
+    if len(checksum) == 2:
+        return _HEX_BYTE[xor_checksum(body)] == checksum.upper()
+    if len(checksum) == 8:
+        return '{:08X}'.format(_crc32(body)) == checksum.upper()
+    return False
+
+
+def validate_many(lines, require_checksum=False):
+    ''' Validate an iterable of NMEA lines (for example, a log being replayed).  Returns a list of booleans. '''
+    return [validate(line, require_checksum) for line in lines]
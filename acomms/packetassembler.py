@@ -0,0 +1,175 @@
+'''
+Assembly of received packets.
+
+The modem reports a received packet piecewise: CACYC for the cycle, a CARXD (or a CAMSG BAD_CRC) for each frame, and
+then a CACST with the receive statistics.  The parser feeds those to the modem's PacketAssembler as they arrive, and it
+keeps one packet per cycle.  When the CACST arrives (or the cycle is cut short) the packet is handed to
+Micromodem.on_packet as a single ReceivedPacket, with its frames, which of them were good, and the CST attached.
+Because nothing has to attach a queue after the CARXP, no frames are missed however quickly they arrive.
+'''
+
+import threading
+
+from .messageparams import DataFrame, Rates
+
+
+class ReceivedPacket(object):
+    ''' A packet as received.
+
+    frames is a list of DataFrames in frame number order; frames that failed their CRC have bad_crc set and no data.
+    frame_map maps each frame number in the cycle to True (good) or False (bad, or never arrived).  cst is the
+    CycleStats for the packet, or None if the modem didn't report one.  complete is False if the cycle ended before its
+    CACST (a PACKET_TIMEOUT, another CACYC or a timeout).
+    '''
+
+    def __init__(self, cycleinfo, received_at):
+        self.cycleinfo = cycleinfo
+        self.received_at = received_at
+        self.frames = []
+        self.cst = None
+        self.complete = False
+
+    @property
+    def src(self):
+        return self.cycleinfo.src
+
+    @property
+    def dest(self):
+        return self.cycleinfo.dest
+
+    @property
+    def rate_num(self):
+        return self.cycleinfo.rate_num
+
+    @property
+    def num_frames(self):
+        return self.cycleinfo.num_frames
+
+    @property
+    def frame_map(self):
+        frame_map = dict((frame_num, False) for frame_num in range(1, self.cycleinfo.num_frames + 1))
+        for frame in self.frames:
+            frame_map[frame.frame_num] = not frame.bad_crc
+        return frame_map
+
+    @property
+    def good_frames(self):
+        return [frame for frame in self.frames if not frame.bad_crc]
+
+    @property
+    def bad_frame_nums(self):
+        return [frame_num for (frame_num, good) in sorted(self.frame_map.items()) if not good]
+
+    @property
+    def ok(self):
+        ''' True if the packet is complete and every frame is good. '''
+        return self.complete and not self.bad_frame_nums
+
+    @property
+    def data(self):
+        ''' Data from the good frames, in order. '''
+        data = bytearray()
+        for frame in self.good_frames:
+            data.extend(frame.data)
+        return data
+
+    def __repr__(self):
+        return "ReceivedPacket(SRC: {0} DST: {1} RATE: {2} FRAMES: {3}/{4} COMPLETE: {5})".format(
+            self.src, self.dest, self.rate_num, len(self.good_frames), self.num_frames, self.complete)
+
+
+class PacketAssembler(object):
+    ''' Builds ReceivedPackets from the receive sentences of one modem.
+
+    :param cst_timeout: Seconds to wait for the next frame or the CACST before giving up on a packet.  After the
+        CACYC, the time the packet takes on the air is added.
+    '''
+
+    def __init__(self, modem, cst_timeout=5.0):
+        self.modem = modem
+        self.cst_timeout = cst_timeout
+        self._lock = threading.Lock()
+        self._current = None
+        self._timer = None
+
+        # Statistics
+        self.packets = 0
+        self.incomplete = 0
+
+    def got_cacyc(self, cycleinfo):
+        if cycleinfo.src == self.modem.id:
+            # Our own cycle (a transmit, or a request for somebody else to send to us), not a received packet.
+            return
+        with self._lock:
+            previous = self._current
+            self._current = ReceivedPacket(cycleinfo, self.modem.clock.time())
+            rate = Rates.get(cycleinfo.rate_num)
+            airtime = rate.packet_duration(cycleinfo.num_frames) if rate is not None and rate.bitrate else 0.0
+            self._arm_timer(self.cst_timeout + airtime)
+        if previous is not None and (previous.frames or previous.cst is not None):
+            self._finish(previous)
+
+    def got_rxframe(self, dataframe):
+        with self._lock:
+            packet = self._current
+            if packet is None or dataframe.src != packet.src or dataframe.dest != packet.dest:
+                return
+            packet.frames.append(dataframe)
+            self._arm_timer()
+
+    def got_badcrc(self, frame_num=None):
+        with self._lock:
+            packet = self._current
+            if packet is None:
+                return
+            if frame_num is None:
+                frame_num = packet.frames[-1].frame_num + 1 if packet.frames else 1
+            packet.frames.append(DataFrame(packet.src, packet.dest, packet.cycleinfo.ack, frame_num, None,
+                                           bad_crc=True))
+            self._arm_timer()
+
+    def got_cst(self, cst):
+        with self._lock:
+            packet = self._current
+            if packet is None or cst is None or cst['src'] != packet.src or cst['dest'] != packet.dest:
+                return
+            if not packet.frames and (cst['num_frames'] or 0) > (cst['bad_frames_num'] or 0):
+                # Reports good frames that we haven't seen, so it is for the cycle init (FSK), not the data.
+                return
+            packet.cst = cst
+            packet.complete = True
+            self._current = None
+        self._finish(packet)
+
+    def got_packettimeout(self):
+        with self._lock:
+            packet = self._current
+            self._current = None
+        if packet is not None:
+            self._finish(packet)
+
+    def _arm_timer(self, timeout=None):
+        ''' (Re)start the timer that gives up on the current packet.  Called with the lock held. '''
+        if self._timer is not None:
+            self._timer.cancel()
+        if timeout is None:
+            timeout = self.cst_timeout
+        self._timer = self.modem.clock.call_later(timeout, self._timed_out, self._current)
+
+    def _timed_out(self, packet):
+        with self._lock:
+            if self._current is not packet:
+                return
+            self._current = None
+        self._finish(packet)
+
+    def _finish(self, packet):
+        with self._lock:
+            if self._timer is not None and self._current is None:
+                self._timer.cancel()
+                self._timer = None
+        packet.frames.sort(key=lambda frame: frame.frame_num)
+        self.packets += 1
+        if not packet.complete:
+            self.incomplete += 1
+        self.modem.on_packet(packet)
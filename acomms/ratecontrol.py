@@ -0,0 +1,211 @@
+'''
+Adaptive rate selection.
+
+A RateController watches the CycleStats (CACST) stream and keeps an estimate of each link's quality: smoothed input
+SNR, equalizer MSE and Doppler, and the fraction of frames that arrived intact at each rate that has been heard.  For
+each rate in Rates it predicts the probability that a frame gets through, from the frames actually seen at that rate
+where there are enough of them and from the SNR margin over the rate's threshold otherwise, and multiplies by the
+rate's throughput to get the expected goodput (delivered bytes per second on the air).  select_rate picks the rate
+with the best goodput.
+
+Micromodem feeds its own RateController (modem.rate_controller), and the send methods accept rate_num='auto'.
+
+The modem only reports statistics for packets it receives, so the estimate for sending to a node comes from the
+packets we have heard from it, on the assumption that the channel is roughly reciprocal.
+'''
+
+from math import ceil, exp
+import threading
+
+from .messageparams import Rates
+
+
+AUTO = 'auto'
+
+# Input SNR (dB) at which about half of the frames at each rate are lost.  These are rough figures; the frame error
+# rates measured on the link take over as soon as there are enough of them.
+SNR_THRESHOLDS = {0: 5.0, 1: -2.0, 2: -6.0, 3: 0.0, 4: 3.0, 5: 9.0, 6: -6.0}
+
+# Rates that use the PSK equalizer, and so suffer from a poor MSE and from Doppler.
+COHERENT_RATES = (1, 2, 3, 4, 5, 6)
+
+
+class LinkEstimate(object):
+    ''' What we know about the link from one node to another. '''
+
+    def __init__(self, src, dest):
+        self.src = src
+        self.dest = dest
+        self.snr_in = None
+        self.snr_out = None
+        self.mse = None
+        self.dop = None
+        self.updated_at = None
+        self.packets = 0
+        self.psk_errors = 0
+        # rate number -> [good frames, total frames], decayed so that recent packets count most
+        self.frames = {}
+
+    def frame_success(self, rate_num):
+        ''' Observed fraction of good frames at rate_num and the (decayed) number of frames it is based on. '''
+        good, total = self.frames.get(rate_num, (0.0, 0.0))
+        if total == 0:
+            return None, 0.0
+        return good / total, total
+
+    def as_dict(self):
+        return {'src': self.src, 'dest': self.dest, 'snr_in': self.snr_in, 'snr_out': self.snr_out,
+                'mse': self.mse, 'dop': self.dop, 'packets': self.packets, 'psk_errors': self.psk_errors,
+                'frames': dict((rate, tuple(counts)) for rate, counts in self.frames.items())}
+
+
+class RateController(object):
+    ''' Chooses packet rates from link statistics.
+
+    :param modem: The Micromodem whose links we are estimating (for its id and clock).
+    :param rates: Rate table to choose from (default Rates).  Rates without a bitrate are never chosen.
+    :param default_rate: Used when nothing is known about the link.
+    :param alpha: Smoothing factor for SNR, MSE and Doppler (weight of the newest value).
+    :param decay: Weight kept by older frame counts at a rate when a new packet at that rate arrives.
+    :param prior_frames: Number of observed frames at which measurements and the SNR model count equally.
+    :param max_age: Seconds after which a link estimate is too old to use.
+    :param hysteresis: Fractional goodput improvement needed to move away from the rate last chosen for a node.
+    '''
+
+    def __init__(self, modem, rates=None, default_rate=1, alpha=0.3, decay=0.9, prior_frames=6.0, max_age=1800.0,
+                 hysteresis=0.1, snr_thresholds=None, snr_slope=1.5, mse_threshold=-10.0, doppler_limit=1.0):
+        self.modem = modem
+        self.rates = rates if rates is not None else Rates
+        self.default_rate = default_rate
+        self.alpha = alpha
+        self.decay = decay
+        self.prior_frames = prior_frames
+        self.max_age = max_age
+        self.hysteresis = hysteresis
+        self.snr_thresholds = dict(SNR_THRESHOLDS)
+        if snr_thresholds:
+            self.snr_thresholds.update(snr_thresholds)
+        self.snr_slope = snr_slope
+        self.mse_threshold = mse_threshold
+        self.doppler_limit = doppler_limit
+
+        self._lock = threading.Lock()
+        self._links = {}
+        self._last_choice = {}
+
+    def on_cst(self, cst, msg=None):
+        ''' Add a CycleStats to the estimates.  Has the same signature as a cst_listener. '''
+        if cst is None or cst['src'] is None or cst['rate_num'] is None:
+            return
+        src, dest, rate_num = cst['src'], cst['dest'], cst['rate_num']
+        with self._lock:
+            link = self._links.get((src, dest))
+            if link is None:
+                link = self._links[(src, dest)] = LinkEstimate(src, dest)
+            link.packets += 1
+            link.updated_at = self.modem.clock.time()
+            for name in ('snr_in', 'snr_out', 'mse', 'dop'):
+                value = cst[name]
+                if value is None:
+                    continue
+                old = getattr(link, name)
+                setattr(link, name, value if old is None else old + self.alpha * (value - old))
+
+            num_frames = cst['num_frames'] or 0
+            bad_frames = cst['bad_frames_num'] or 0
+            if cst['psk_error']:
+                # The packet couldn't be demodulated at all.
+                link.psk_errors += 1
+                bad_frames = num_frames = max(num_frames, self.rates[rate_num].numframes if rate_num in self.rates
+                                              else 1)
+            if num_frames:
+                counts = link.frames.setdefault(rate_num, [0.0, 0.0])
+                counts[0] = counts[0] * self.decay + (num_frames - bad_frames)
+                counts[1] = counts[1] * self.decay + num_frames
+
+    def link(self, dest):
+        ''' The freshest estimate for the link to dest: packets from dest to us, or any packets heard from dest. '''
+        now = self.modem.clock.time()
+        with self._lock:
+            own = self._links.get((dest, self.modem.id))
+            if own is not None and now - own.updated_at <= self.max_age:
+                return own
+            candidates = [link for link in self._links.values()
+                          if link.src == dest and now - link.updated_at <= self.max_age]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda link: link.updated_at)
+
+    def links(self):
+        with self._lock:
+            return [link.as_dict() for link in self._links.values()]
+
+    def effective_snr(self, link, rate_num):
+        ''' Link SNR less penalties for a poor equalizer MSE and for Doppler, which only hurt the coherent rates. '''
+        snr = link.snr_in
+        if rate_num in COHERENT_RATES:
+            if link.mse is not None and link.mse > self.mse_threshold:
+                snr -= link.mse - self.mse_threshold
+            if link.dop is not None and abs(link.dop) > self.doppler_limit:
+                snr -= 3.0 * (abs(link.dop) - self.doppler_limit)
+        return snr
+
+    def frame_success_probability(self, link, rate_num):
+        ''' Probability that a frame at rate_num gets through the link. '''
+        modelled = None
+        if link.snr_in is not None and rate_num in self.snr_thresholds:
+            x = (self.effective_snr(link, rate_num) - self.snr_thresholds[rate_num]) / self.snr_slope
+            modelled = 1.0 if x > 50 else 0.0 if x < -50 else 1.0 - 1.0 / (1.0 + exp(x))
+        observed, weight = link.frame_success(rate_num)
+        if modelled is None:
+            return observed if observed is not None else 0.0
+        if observed is None:
+            return modelled
+        weight = weight / (weight + self.prior_frames)
+        return weight * observed + (1.0 - weight) * modelled
+
+    def goodput(self, link, rate_num, nbytes=None):
+        ''' Expected delivered bytes per second at rate_num, for a packet carrying nbytes (default: a full packet). '''
+        rate = self.rates[rate_num]
+        if rate.bitrate is None:
+            return 0.0
+        num_frames = rate.numframes
+        payload = rate.maxpacketsize
+        if nbytes is not None:
+            num_frames = max(1, min(num_frames, int(ceil(float(nbytes) / rate.framesize))))
+            payload = min(nbytes, num_frames * rate.framesize)
+        return payload * self.frame_success_probability(link, rate_num) / rate.packet_duration(num_frames)
+
+    def select_rate(self, dest, nbytes=None, candidates=None):
+        ''' Rate number with the best expected goodput to dest.
+        :param nbytes: Size of the payload (default: a full packet at each rate).
+        :param candidates: Rate numbers to choose from (default: every rate in the table).
+        '''
+        if candidates is None:
+            candidates = list(self.rates.keys())
+        candidates = [rate_num for rate_num in candidates if self.rates[rate_num].bitrate is not None]
+        if not candidates:
+            return self.default_rate
+        link = self.link(dest)
+        if link is None:
+            return self.default_rate if self.default_rate in candidates else candidates[0]
+
+        scores = dict((rate_num, self.goodput(link, rate_num, nbytes)) for rate_num in candidates)
+        # Prefer the more robust rate on a tie.
+        best = max(candidates, key=lambda rate_num: (scores[rate_num], -self.snr_thresholds.get(rate_num, 0.0)))
+        with self._lock:
+            last = self._last_choice.get(dest)
+            if last in scores and scores[best] <= scores[last] * (1.0 + self.hysteresis):
+                best = last
+            self._last_choice[dest] = best
+        return best
+
+    def select_rate_for_frames(self, dest, frames):
+        ''' Like select_rate, but only considers rates that can carry frames (a list of DataFrames) as they are. '''
+        largest = max([len(frame.data) if frame.data else 0 for frame in frames] + [0])
+        candidates = [rate_num for rate_num, rate in self.rates.items()
+                      if rate.framesize >= largest and rate.numframes >= len(frames)]
+        nbytes = sum(len(frame.data) if frame.data else 0 for frame in frames)
+        if not candidates:
+            return self.default_rate
+        return self.select_rate(dest, nbytes, candidates)
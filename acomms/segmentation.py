@@ -0,0 +1,300 @@
+'''
+Segmentation and reassembly of payloads larger than one packet.
+
+The sender splits each message into segments and packs them into frames, several segments to a frame when they fit,
+so the tail of one message shares a frame with the start of the next instead of being padded.  Each frame starts with
+a session byte, picked at random by each Segmenter, followed by segments with a compact header:
+
+    message id (1 byte) | varint (segment index << 1 | last flag) | varint length | data
+
+Message ids start at 0 for every Segmenter, so the session byte is what lets the receiver tell a restarted sender
+from duplicates of messages it has already delivered.  Segments are parsed until the data runs out, or until a header
+with index 0 and length 0 (which is what zero padding looks like).  The receiver feeds frames from rxframe_listeners to a Reassembler, which hands each message's data to
+the caller in order as soon as it is contiguous, keeping only out-of-order segments.  Duplicate segments are dropped.
+'''
+
+from collections import deque
+import os
+
+from .messageparams import DataFrame, Rates
+from .txscheduler import PRIORITY_NORMAL
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def decode_varint(data, pos):
+    ''' Returns (value, new position).  Raises IndexError if data ends in the middle of the varint. '''
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_segment(msg_id, index, last, data):
+    header = bytearray([msg_id & 0xff])
+    header += encode_varint((index << 1) | int(last))
+    header += encode_varint(len(data))
+    return header + data
+
+
+def decode_segments(frame_data):
+    ''' Yield (msg_id, index, last, data) for each segment in frame_data. '''
+    pos = 0
+    end = len(frame_data)
+    while pos < end:
+        try:
+            msg_id = frame_data[pos]
+            field, pos = decode_varint(frame_data, pos + 1)
+            length, pos = decode_varint(frame_data, pos)
+        except IndexError:
+            return
+        if field == 0 and length == 0:
+            # Padding
+            return
+        if pos + length > end:
+            # Truncated frame
+            return
+        yield msg_id, field >> 1, bool(field & 1), bytes(frame_data[pos:pos + length])
+        pos += length
+
+
+class Segmenter(object):
+    ''' Packs messages into frames of framesize bytes.
+
+    Call add(payload) for each message, take whole frames from frames as they fill up, and call flush() to close the
+    frame in progress.  The smallest useful segment carries one byte of data; a frame with less room than that left
+    is closed.  session is the byte every frame starts with (default: random).
+    '''
+
+    def __init__(self, framesize, session=None):
+        self.framesize = framesize
+        self.session = ord(os.urandom(1)) if session is None else session
+        self.frames = deque()
+        self._frame = bytearray([self.session])
+        self._next_msg_id = 0
+
+    def add(self, payload):
+        ''' Split payload into segments.  Returns its message id. '''
+        msg_id = self._next_msg_id
+        self._next_msg_id = (self._next_msg_id + 1) & 0xff
+
+        payload = memoryview(bytes(payload))
+        index = 0
+        pos = 0
+        while True:
+            room = self.framesize - len(self._frame)
+            header_size = 1 + len(encode_varint(index << 1 | 1)) + len(encode_varint(room))
+            if room - header_size < 1 and (pos < len(payload) or room < header_size):
+                # Not enough room for a useful segment; start a new frame.
+                self._close_frame()
+                continue
+            take = min(room - header_size, len(payload) - pos)
+            last = pos + take >= len(payload)
+            self._frame += encode_segment(msg_id, index, last, payload[pos:pos + take])
+            pos += take
+            index += 1
+            if len(self._frame) >= self.framesize:
+                self._close_frame()
+            if last:
+                return msg_id
+
+    def flush(self):
+        ''' Close the frame in progress, if it has anything in it. '''
+        if len(self._frame) > 1:
+            self._close_frame()
+
+    def _close_frame(self):
+        self.frames.append(bytes(self._frame))
+        self._frame = bytearray([self.session])
+
+
+class TransportSender(object):
+    ''' Sends arbitrarily large payloads to dest as a series of packets.
+
+        sender = TransportSender(modem, dest=2, rate_num=5)
+        sender.send(payload)
+
+    write() queues a message without sending a partial packet, so that the next message can fill it; send() and
+    flush() send everything that is queued.  Packets go through the modem's transmit queue (see Micromodem.send_packet)
+    with the given priority.
+    '''
+
+    def __init__(self, modem, dest, rate_num=1, priority=PRIORITY_NORMAL):
+        self.modem = modem
+        self.dest = dest
+        self.rate = Rates[rate_num]
+        self.priority = priority
+        self.segmenter = Segmenter(self.rate.framesize)
+
+    def write(self, payload):
+        ''' Queue payload, sending any packets that fill up.  Returns (message id, list of packet futures). '''
+        msg_id = self.segmenter.add(payload)
+        return msg_id, self._send_packets(full_only=True)
+
+    def flush(self):
+        ''' Send everything that is queued.  Returns a list of packet futures. '''
+        self.segmenter.flush()
+        return self._send_packets(full_only=False)
+
+    def send(self, payload):
+        ''' Queue payload and send everything.  Returns (message id, list of packet futures). '''
+        msg_id, futures = self.write(payload)
+        return msg_id, futures + self.flush()
+
+    def _send_packets(self, full_only):
+        frames = self.segmenter.frames
+        futures = []
+        while len(frames) >= self.rate.numframes or (frames and not full_only):
+            packet_frames = [frames.popleft() for i in range(min(self.rate.numframes, len(frames)))]
+            futures.append(self._send_frames(packet_frames))
+        return futures
+
+    def _send_frames(self, frame_data):
+        frames = [DataFrame(self.modem.id, self.dest, False, frame_num, bytearray(data))
+                  for frame_num, data in enumerate(frame_data, 1)]
+        return self.modem.send_packet_frames(self.dest, self.rate.number, frames, self.priority)
+
+
+class _Message(object):
+    __slots__ = ('next_index', 'pending', 'last_index')
+
+    def __init__(self):
+        self.next_index = 0
+        self.pending = {}
+        self.last_index = None
+
+
+class Reassembler(object):
+    ''' Rebuilds messages from received frames.
+
+    :param on_data: Called with (src, msg_id, data, last) as each message's data becomes available in order.  last
+        is True for the final piece.
+    :param dest: Only accept frames addressed to this id (None accepts every frame).
+    :param max_pending: Most incomplete messages to track per source; the oldest is abandoned to make room.
+    :param on_abandon: Called with (src, msg_id) when an incomplete message is given up.  Defaults to on_data's
+        abandon method, if it has one (MessageCollector does).
+
+    Attach it to a modem with modem.rxframe_listeners.append(reassembler.on_rxframe), or call feed() directly.
+
+    A frame with a new session byte means the source's sender has restarted.  Its incomplete messages are abandoned
+    and the message ids it has used are forgotten, because the new sender starts again at 0.  Frames from one source
+    arrive in the order they were sent, so a frame from the old session can't follow the new one.
+    '''
+
+    # Message ids are reused after 256 messages, so a completed id is remembered for this many messages.
+    completed_window = 128
+
+    def __init__(self, on_data, dest=None, max_pending=32, on_abandon=None):
+        self.on_data = on_data
+        self.on_abandon = on_abandon if on_abandon is not None else getattr(on_data, 'abandon', None)
+        self.dest = dest
+        self.max_pending = max_pending
+        self._sessions = {}
+        self._messages = {}
+        self._completed = {}
+
+        # Statistics
+        self.segments = 0
+        self.duplicates = 0
+        self.completed = 0
+        self.abandoned = 0
+        self.restarts = 0
+
+    def on_rxframe(self, dataframe):
+        if dataframe.bad_crc or dataframe.data is None:
+            return
+        if self.dest is not None and dataframe.dest != self.dest:
+            return
+        self.feed(dataframe.src, dataframe.data)
+
+    def feed(self, src, frame_data):
+        if not frame_data:
+            return
+        session = frame_data[0]
+        if self._sessions.get(src) != session:
+            self._new_session(src, session)
+        for msg_id, index, last, data in decode_segments(frame_data[1:]):
+            self._add_segment(src, msg_id, index, last, data)
+
+    def _new_session(self, src, session):
+        if src in self._sessions:
+            self.restarts += 1
+        self._sessions[src] = session
+        for msg_id in self._messages.pop(src, {}):
+            self._abandon(src, msg_id)
+        self._completed.pop(src, None)
+
+    def _abandon(self, src, msg_id):
+        self.abandoned += 1
+        if self.on_abandon is not None:
+            self.on_abandon(src, msg_id)
+
+    def _add_segment(self, src, msg_id, index, last, data):
+        self.segments += 1
+        completed = self._completed.setdefault(src, deque())
+        if msg_id in completed:
+            self.duplicates += 1
+            return
+
+        messages = self._messages.setdefault(src, {})
+        message = messages.get(msg_id)
+        if message is None:
+            if len(messages) >= self.max_pending:
+                # Dicts keep insertion order, so the first one is the oldest.
+                oldest = next(iter(messages))
+                del messages[oldest]
+                self._abandon(src, oldest)
+            message = messages[msg_id] = _Message()
+
+        if index < message.next_index or index in message.pending:
+            self.duplicates += 1
+            return
+        if last:
+            message.last_index = index
+        message.pending[index] = data
+
+        # Hand over everything that is now in order.
+        while message.next_index in message.pending:
+            data = message.pending.pop(message.next_index)
+            done = message.next_index == message.last_index
+            message.next_index += 1
+            self.on_data(src, msg_id, data, done)
+            if done:
+                del messages[msg_id]
+                completed.append(msg_id)
+                if len(completed) > self.completed_window:
+                    completed.popleft()
+                self.completed += 1
+                return
+
+
+class MessageCollector(object):
+    ''' on_data callback for a Reassembler that collects whole messages, for when streaming isn't needed.
+    Complete messages are passed to on_message(src, msg_id, payload).
+    '''
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self._buffers = {}
+
+    def __call__(self, src, msg_id, data, last):
+        buf = self._buffers.setdefault((src, msg_id), bytearray())
+        buf += data
+        if last:
+            del self._buffers[(src, msg_id)]
+            self.on_message(src, msg_id, bytes(buf))
+
+    def abandon(self, src, msg_id):
+        self._buffers.pop((src, msg_id), None)
@@ -0,0 +1,275 @@
+'''
+Sliding-window selective-repeat file transfer.
+
+acomms_xymodem is stop-and-wait: every block costs several acoustic round trips (STX, sequence number, data and CRC,
+each acknowledged) plus its delays.  SelectiveRepeatTransfer sends the file as numbered frames, several to a packet,
+with the modem's own acknowledgements turned on.  The receiving modem acknowledges each good frame with a CAACK, which
+reaches the sender through ack_listeners; the sender collects them into a bitmap of the frames in the packet, and only
+the frames that weren't acknowledged are sent again, alongside new ones in the next packet.  Up to window frames can
+be outstanding at once, so a lost frame never holds up the rest of the file.
+
+The modem is half duplex, so the sender leaves a short gap after each packet for its acknowledgements to come back
+(ack_timeout, shortened once the round trip time is known), and the next packet goes out as soon as they are in.
+
+Each frame starts with a 3 byte header: a transfer id (random, so that stray frames from an earlier transfer are
+ignored) and a 16 bit sequence number.  Frame 0 carries the payload size, file size and CRC-32 of the file; the data
+follows in frames 1 to N.  The receiver writes data to its stream as soon as it is contiguous.
+'''
+
+from concurrent.futures import Future
+import os
+import struct
+import zlib
+
+from .messageparams import Packet, CycleInfo, DataFrame, Rates
+from .txscheduler import SENT
+from .unifiedlog import UnifiedLog
+
+
+# transfer id, sequence number
+HEADER = struct.Struct('!BH')
+# payload bytes per frame, file size, CRC-32 of the file
+METADATA = struct.Struct('!HII')
+
+MAX_FRAMES = 0x10000
+
+
+class SelectiveRepeatTransfer(object):
+    ''' File transfer to or from dest.  Use send() on one end and recv() (or listen()) on the other, at the same rate.
+
+    :param rate: Packet rate, 0-6, or 'auto' to let the modem's RateController choose.
+    :param window: Most frames that can be sent but not yet acknowledged.
+    :param ack_timeout: Seconds to wait after each packet for its acknowledgements, until the round trip time has
+        been measured.  Should cover twice the range's travel time plus an acknowledgement.
+    '''
+
+    def __init__(self, micromodem, dest, rate=1, window=64, ack_timeout=10.0, unified_log=None, log_path=None):
+        if rate == 'auto':
+            rate = micromodem.rate_controller.select_rate(dest)
+        assert rate in range(0, 7), "Invalid Rate: %d" % rate
+        assert dest != micromodem.id, "Can't send file to self."
+
+        self.micromodem = micromodem
+        self.target_id = dest
+        self.rate = Rates[rate]
+        self.payload_size = self.rate.framesize - HEADER.size
+        self.window = window
+        self.ack_timeout = ack_timeout
+        if unified_log is None:
+            unified_log = UnifiedLog(log_path=log_path)
+        self.log = unified_log.getLogger("srtransfer.{0}".format(micromodem.name))
+
+        # Statistics for the last transfer (see _report).
+        self.stats = None
+
+        # Sender: acknowledgements for the packet in flight
+        self._tx_seqs = []
+        self._tx_acks = 0
+        self._tx_acked = None
+        self._tx_last_ack_at = None
+
+        # Receiver
+        self._rx = None
+
+    # Sender
+
+    def send(self, file_io, retry=16, timeout=None, callback=None):
+        ''' Send everything read from file_io.  Returns True if every frame was acknowledged.
+        :param retry: Most times a frame is sent again before giving up.
+        :param timeout: Give up after this many seconds (default: never).
+        :param callback: Called as callback(total_frames, acked_frames, retransmissions) after each packet.
+        '''
+        data = file_io.read()
+        if isinstance(data, str):
+            data = data.encode()
+        if (len(data) + self.payload_size - 1) // self.payload_size + 1 > MAX_FRAMES:
+            self.log.error("File is too large to send at this rate ({0} bytes)".format(len(data)))
+            return False
+
+        modem = self.micromodem
+        clock = modem.clock
+        transfer_id = ord(os.urandom(1))
+        blocks = [METADATA.pack(self.payload_size, len(data), zlib.crc32(data) & 0xffffffff)]
+        blocks.extend(data[i:i + self.payload_size] for i in range(0, len(data), self.payload_size))
+        total = len(blocks)
+
+        acked = 0
+        all_acked = (1 << total) - 1
+        base = 0
+        next_new = 0
+        lost = []
+        tries = [0] * total
+        packets = frames_sent = retransmissions = delivered = 0
+        ack_timeout = self.ack_timeout
+        start = clock.time()
+
+        modem.ack_listeners.append(self._on_ack)
+        try:
+            while acked != all_acked:
+                if timeout is not None and clock.time() - start > timeout:
+                    self.log.warn("Transfer timed out")
+                    break
+
+                # Frames that went missing first, then new ones as far as the window allows.
+                seqs = lost[:self.rate.numframes]
+                del lost[:len(seqs)]
+                while len(seqs) < self.rate.numframes and next_new < total and next_new < base + self.window:
+                    seqs.append(next_new)
+                    next_new += 1
+                retransmissions += sum(1 for seq in seqs if tries[seq])
+
+                frames = [DataFrame(modem.id, self.target_id, True, frame_num,
+                                    HEADER.pack(transfer_id, seq) + blocks[seq])
+                          for frame_num, seq in enumerate(seqs, 1)]
+                packet = Packet(CycleInfo(modem.id, self.target_id, self.rate.number, True, len(frames)), frames)
+                self._tx_seqs = seqs
+                self._tx_acks = 0
+                self._tx_acked = Future()
+                self._tx_last_ack_at = None
+                packets += 1
+                frames_sent += len(seqs)
+
+                future = modem.send_packet(packet)
+                clock.wait_future(future, self.rate.packet_duration(len(frames)) + 30)
+                sent = future.done() and future.result() == SENT
+                if sent:
+                    sent_at = clock.time()
+                    clock.wait_future(self._tx_acked, ack_timeout)
+                    if self._tx_last_ack_at is not None:
+                        # The acknowledgements all come back together, so this is a round trip time.
+                        ack_timeout = min(self.ack_timeout, 1.5 * (self._tx_last_ack_at - sent_at) + 0.5)
+                else:
+                    self.log.warn("Packet transmit failed")
+
+                for frame_num, seq in enumerate(seqs, 1):
+                    if sent and self._tx_acks & (1 << (frame_num - 1)):
+                        acked |= 1 << seq
+                        if seq:
+                            delivered += len(blocks[seq])
+                        continue
+                    tries[seq] += 1
+                    if tries[seq] > retry:
+                        self.log.error("Frame {0} was not acknowledged after {1} tries".format(seq, retry))
+                        return self._report(False, delivered, start, packets, frames_sent, retransmissions)
+                    lost.append(seq)
+                lost.sort()
+                while base < total and acked & (1 << base):
+                    base += 1
+
+                if callback is not None:
+                    callback(total, bin(acked).count('1'), retransmissions)
+        finally:
+            modem.ack_listeners.remove(self._on_ack)
+            self._tx_acked = None
+
+        return self._report(acked == all_acked, delivered, start, packets, frames_sent, retransmissions)
+
+    def _on_ack(self, ack, msg):
+        if ack.src != self.target_id or ack.dest != self.micromodem.id or self._tx_acked is None:
+            return
+        if not 1 <= ack.frame_num <= len(self._tx_seqs):
+            return
+        self._tx_acks |= 1 << (ack.frame_num - 1)
+        self._tx_last_ack_at = self.micromodem.clock.time()
+        if self._tx_acks == (1 << len(self._tx_seqs)) - 1 and not self._tx_acked.done():
+            self._tx_acked.set_result(True)
+
+    def _report(self, success, nbytes, start, packets, frames_sent, retransmissions):
+        elapsed = self.micromodem.clock.time() - start
+        raw = self.rate.bitrate / 8.0
+        goodput = nbytes / elapsed if elapsed > 0 else 0.0
+        self.stats = {'success': success, 'bytes': nbytes, 'elapsed': elapsed, 'packets': packets,
+                      'frames_sent': frames_sent, 'retransmissions': retransmissions, 'goodput': goodput,
+                      'raw_throughput': raw, 'efficiency': goodput / raw}
+        self.log.info("Transfer {0}: {1} bytes delivered in {2:.1f} s, {3:.1f} B/s ({4:.0%} of the {5:.0f} B/s raw rate), "
+                      "{6} packets, {7} frames resent".format("complete" if success else "failed", nbytes, elapsed,
+                                                              goodput, goodput / raw, raw, packets, retransmissions))
+        return success
+
+    # Receiver
+
+    def listen(self, file_io):
+        ''' Start receiving into file_io (anything with write()) without blocking.
+        Returns a future whose result is True when the whole file has arrived and its CRC matches, or False if the
+        CRC doesn't match.
+        '''
+        self._rx = _Receiver(self, file_io)
+        self.micromodem.rxframe_listeners.append(self._rx.on_rxframe)
+        return self._rx.done
+
+    def stop_listening(self):
+        if self._rx is not None:
+            try:
+                self.micromodem.rxframe_listeners.remove(self._rx.on_rxframe)
+            except ValueError:
+                pass
+
+    def recv(self, file_io, timeout=60):
+        ''' Receive a file into file_io.  Gives up if nothing arrives for timeout seconds.
+        Returns True if the file arrived intact, False if its CRC didn't match, or None if it didn't arrive.
+        '''
+        done = self.listen(file_io)
+        clock = self.micromodem.clock
+        try:
+            while not done.done():
+                frames = self._rx.frames
+                clock.wait_future(done, timeout)
+                if not done.done() and self._rx.frames == frames:
+                    self.log.warn("No frames for {0} s, giving up".format(timeout))
+                    return None
+            return done.result()
+        finally:
+            self.stop_listening()
+
+
+class _Receiver(object):
+    def __init__(self, transfer, file_io):
+        self.transfer = transfer
+        self.file_io = file_io
+        self.done = Future()
+        self.transfer_id = None
+        self.metadata = None
+        self.blocks = {}
+        self.next_seq = 1
+        self.crc = 0
+        self.frames = 0
+        self.duplicates = 0
+
+    def on_rxframe(self, dataframe):
+        modem = self.transfer.micromodem
+        if dataframe.bad_crc or dataframe.src != self.transfer.target_id or dataframe.dest != modem.id:
+            return
+        if dataframe.data is None or len(dataframe.data) < HEADER.size or self.done.done():
+            return
+        transfer_id, seq = HEADER.unpack_from(bytes(dataframe.data))
+        if self.transfer_id is None:
+            self.transfer_id = transfer_id
+        elif transfer_id != self.transfer_id:
+            return
+        self.frames += 1
+
+        payload = bytes(dataframe.data[HEADER.size:])
+        if seq == 0:
+            if self.metadata is None:
+                self.metadata = METADATA.unpack(payload[:METADATA.size])
+            else:
+                self.duplicates += 1
+        elif seq < self.next_seq or seq in self.blocks:
+            self.duplicates += 1
+        else:
+            self.blocks[seq] = payload
+
+        # Write whatever is now in order.
+        while self.next_seq in self.blocks:
+            block = self.blocks.pop(self.next_seq)
+            self.file_io.write(block)
+            self.crc = zlib.crc32(block, self.crc)
+            self.next_seq += 1
+
+        if self.metadata is not None:
+            payload_size, size, crc = self.metadata
+            if self.next_seq > (size + payload_size - 1) // payload_size:
+                ok = self.crc & 0xffffffff == crc
+                if not ok:
+                    self.transfer.log.error("CRC mismatch on received file")
+                self.done.set_result(ok)
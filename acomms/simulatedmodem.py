@@ -0,0 +1,440 @@
+'''
+Simulated Micromodem, for testing and benchmarking without hardware.
+
+SimulatedModemCore answers the host commands that pyacomms sends (CCCFQ, CCCFG, CCCYC/CCTXD, CCMPC, CCTMQ, CCTMS, ...)
+and produces the sentences that the commstate machine expects (CACYC echo, a CADRQ per frame, CATXP/CATXF,
+CAXST, and CARXP/CACYC/CARXD/CACST on the receive side).  Responses are delayed by configurable latencies, and output
+can be paced to a serial baud rate.
+
+The core doesn't do any I/O itself.  PtySimulatedModem exposes it on a pseudo-terminal that SerialConnection can open,
+and UdpSimulatedModem on a UDP socket for UdpConnection.  Linked cores hear each other's transmissions; for a shared
+acoustic medium with geometry, loss and collisions, see channelsimulator.
+'''
+
+from collections import Counter
+from datetime import datetime
+import os
+import pty
+import socket
+import tty
+
+from .messageparams import Rates, data_from_hexstring
+from .nmeachecksum import nmea_checksum, validate
+from acomms.modem_connections import IoHub, NmeaFramer
+
+
+# Seconds between a stimulus and the simulated modem's response.  Individual sentence types (for example 'CACFG')
+# can be given their own latency, which overrides the general one.
+DEFAULT_LATENCIES = {
+    'command': 0.005,       # Host command to its echo or response
+    'drq': 0.01,            # CACYC (or the previous CCTXD) to the next CADRQ
+    'transmit': 0.2,        # Acoustic transmission of a packet (CATXP to CATXF)
+    'owtt': 0.1,            # One-way acoustic travel time to linked modems
+    'turnaround': 0.05,     # Received packet to the acoustic reply (ping response or acknowledgement)
+    'frame_spacing': 0.001,  # Between the sentences that report a received packet
+}
+
+DEFAULT_CONFIG = {
+    'SRC': '1',
+    'ASD': '0',
+    'PCM': '0',
+    'AGC': '1',
+    'BND': '0',
+    'BR1': '3',
+    'CTO': '10',
+    'TAT': '50',
+    'XST': '1',
+}
+
+# Seconds on the air for an FH-FSK minipacket (cycle init, ping, ping reply, acknowledgement), when packet durations
+# come from the rate tables.
+MINIPACKET_DURATION = 0.5
+
+
+class SimulatedModemCore(object):
+    ''' NMEA state machine of a simulated Micromodem.
+
+    :param modem_id: SRC address.
+    :param loop: Provides call_later(delay, callback, *args) and time() (an IoHub, or a virtual-time scheduler).
+    :param output: Called with each sentence (as bytes) that the modem sends to the host.
+    :param baudrate: If set, output is paced as if it were going over a serial port at this rate.
+    :param latencies: Overrides for DEFAULT_LATENCIES.  Set 'transmit' to None to take packet durations from the rate
+        tables instead of using a fixed duration.
+    :param config: Overrides for DEFAULT_CONFIG.
+    :param now: Returns the modem's current time as a datetime (for timestamps in CACST, CAXST, etc.).
+    '''
+
+    api_level = 11
+
+    def __init__(self, modem_id=1, loop=None, output=None, baudrate=None, latencies=None, config=None, now=None):
+        self.id = int(modem_id)
+        self.loop = loop
+        self.output = output
+        self.baudrate = baudrate
+        self.now = now if now is not None else datetime.utcnow
+
+        self.latencies = dict(DEFAULT_LATENCIES)
+        if latencies:
+            self.latencies.update(latencies)
+        self.config = dict(DEFAULT_CONFIG)
+        self.config['SRC'] = str(self.id)
+        if config:
+            self.config.update((str(k), str(v)) for k, v in config.items())
+
+        # Modems that hear our transmissions.
+        self.peers = []
+        # If set, a shared medium (see channelsimulator.AcousticChannel) that carries our transmissions instead.
+        self.channel = None
+        # When the last CCMPC ping went out, for measuring the travel time.
+        self._ping_sent_at = None
+
+        # The downlink packet being assembled from CCTXDs: (src, dest, rate, ack, num_frames), and the frame data.
+        self._tx_cycle = None
+        self._tx_frames = []
+
+        self._wire_free_at = 0.0
+
+        # Statistics
+        self.sentences_in = Counter()
+        self.sentences_out = Counter()
+        self.packets_sent = 0
+        self.packets_received = 0
+
+        self._handlers = {
+            'CCCFQ': self._on_cccfq,
+            'CCCFG': self._on_cccfg,
+            'CCCYC': self._on_cccyc,
+            'CCTXD': self._on_cctxd,
+            'CCMPC': self._on_ccmpc,
+            'CCTMQ': self._on_cctmq,
+            'CCTMS': self._on_cctms,
+            'CCALQ': self._on_ccalq,
+            'CCMEC': self._on_ccmec,
+            'CCHIB': self._on_cchib,
+        }
+
+    def link(self, other):
+        ''' Let this modem and other hear each other's transmissions. '''
+        if other not in self.peers:
+            self.peers.append(other)
+        if self not in other.peers:
+            other.peers.append(self)
+
+    # Output
+    def latency(self, kind, sentence_type=None):
+        return self.latencies.get(sentence_type, self.latencies[kind])
+
+    def emit(self, body, delay=0.0):
+        ''' Send the sentence with the given body (without $ or checksum) to the host after delay seconds. '''
+        if delay > 0:
+            self.loop.call_later(delay, self._send, body)
+        else:
+            self._send(body)
+
+    def _send(self, body):
+        line = "${0}*{1}\r\n".format(body, nmea_checksum(body)).encode('iso-8859-1')
+        self.sentences_out[body.split(',', 1)[0]] += 1
+        if not self.baudrate:
+            self.output(line)
+            return
+        # Serial pacing: each byte is 10 bits on the wire, and sentences queue up behind each other.
+        now = self.loop.time()
+        start = max(now, self._wire_free_at)
+        self._wire_free_at = start + len(line) * 10.0 / self.baudrate
+        self.loop.call_later(self._wire_free_at - now, self.output, line)
+
+    def _respond(self, body):
+        self.emit(body, self.latency('command', body.split(',', 1)[0]))
+
+    def _timestamp(self):
+        return self.now().strftime('%H%M%S')
+
+    # Input
+    def handle_line(self, line):
+        ''' Process one sentence (str or bytes) from the host. '''
+        if isinstance(line, (bytes, bytearray)):
+            line = line.decode('iso-8859-1')
+        line = line.strip()
+        if not line.startswith('$') or not validate(line):
+            return
+        body = line[1:].split('*', 1)[0]
+        fields = body.split(',')
+        self.sentences_in[fields[0]] += 1
+        handler = self._handlers.get(fields[0])
+        if handler is not None:
+            handler(fields[1:])
+
+    def _on_cccfq(self, params):
+        name = params[0] if params else 'ALL'
+        if name == 'ALL':
+            for key in sorted(self.config):
+                self._respond("CACFG,{0},{1}".format(key, self.config[key]))
+            self._respond("CACFG,ALL,")
+        else:
+            self._respond("CACFG,{0},{1}".format(name, self.config.get(name, '0')))
+
+    def _on_cccfg(self, params):
+        self.config[params[0]] = params[1]
+        if params[0] == 'SRC':
+            self.id = int(params[1])
+        self._respond("CACFG,{0},{1}".format(params[0], params[1]))
+
+    def _on_cccyc(self, params):
+        src, dest, rate, ack, num_frames = [int(p) for p in params[1:6]]
+        self._respond("CACYC,0,{0},{1},{2},{3},{4}".format(src, dest, rate, ack, num_frames))
+        if src == self.id:
+            delay = self.latency('command')
+            if rate == 0:
+                # FSK downlinks start with a cycle init minipacket, which is reported before the data is requested.
+                delay += self.minipacket_duration()
+                self.emit("CATXF,0", delay)
+            self._start_downlink(src, dest, rate, ack, num_frames, delay + self.latency('drq'))
+        else:
+            # Uplink request: transmit the cycle init, and the addressed modem will send us its data.
+            start = self.latency('command')
+            self.emit("CATXP,0", start)
+            duration = self.minipacket_duration()
+            self.emit("CATXF,0", start + duration)
+            self._radiate(start, duration, 'uplink', (src, dest, rate, ack, num_frames))
+
+    def _start_downlink(self, src, dest, rate, ack, num_frames, delay):
+        self._tx_cycle = (src, dest, rate, ack, num_frames)
+        self._tx_frames = []
+        self._request_frame(delay)
+
+    def _request_frame(self, delay):
+        src, dest, rate, ack, num_frames = self._tx_cycle
+        frame_num = len(self._tx_frames) + 1
+        self.emit("CADRQ,{0},{1},{2},{3},{4},{5}".format(self._timestamp(), src, dest, ack,
+                                                          Rates[rate].framesize, frame_num), delay)
+
+    def _on_cctxd(self, params):
+        data = data_from_hexstring(params[3]) if len(params) > 3 else bytearray()
+        self._respond("CATXD,{0},{1},{2},{3}".format(params[0], params[1], params[2], len(data)))
+        if self._tx_cycle is None:
+            return
+        self._tx_frames.append(bytes(data))
+        if len(params) > 2 and params[2] not in ('', '0'):
+            # The ack flag can be set per frame in CCTXD as well as in CCCYC.
+            self._tx_cycle = self._tx_cycle[:3] + (1,) + self._tx_cycle[4:]
+        if len(self._tx_frames) < self._tx_cycle[4]:
+            self._request_frame(self.latency('drq'))
+        else:
+            self._transmit()
+
+    def _transmit(self):
+        src, dest, rate, ack, num_frames = self._tx_cycle
+        frames = self._tx_frames
+        self._tx_cycle = None
+        self._tx_frames = []
+
+        start = self.latency('command')
+        duration = self.packet_duration(rate, num_frames)
+        nbytes = sum(len(f) for f in frames)
+        self.emit("CATXP,{0}".format(nbytes), start)
+        self.emit("CATXF,{0}".format(nbytes), start + duration)
+        self.emit(self._xst_body(src, dest, rate, ack, num_frames, len(frames), nbytes), start + duration)
+        self.packets_sent += 1
+        self._radiate(start, duration, 'data', (src, dest, rate, ack, frames))
+
+    def _on_ccmpc(self, params):
+        src, dest = int(params[0]), int(params[1])
+        self._respond("CAMPC,{0},{1}".format(src, dest))
+        start = self.latency('command')
+        duration = self.minipacket_duration()
+        self.emit("CATXF,0", start + duration)
+        self._ping_sent_at = self.loop.time() + start
+        self._radiate(start, duration, 'ping', (src, dest))
+
+    def _on_cctmq(self, params):
+        self._respond("CATMQ,{0}Z,RTC,NONE".format(self.now().strftime('%Y-%m-%dT%H:%M:%S.%f')))
+
+    def _on_cctms(self, params):
+        self._respond("CATMS,0,{0}".format(params[0]))
+
+    def _on_ccalq(self, params):
+        self._respond("CAALQ,SimulatedModem,{0}".format(self.api_level))
+
+    def _on_ccmec(self, params):
+        self._respond("CAMEC,{0}".format(",".join(params)))
+
+    def _on_cchib(self, params):
+        now = self.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+        self._respond("CAHIB,0,{0},0,{0}".format(now))
+
+    # Acoustic transmit side
+    def packet_duration(self, rate, num_frames):
+        ''' Seconds on the air for a packet: the fixed 'transmit' latency, or (if that is None) from the rate table. '''
+        fixed = self.latencies['transmit']
+        if fixed is not None:
+            return fixed
+        return Rates[rate].packet_duration(num_frames)
+
+    def minipacket_duration(self):
+        fixed = self.latencies['transmit']
+        return fixed if fixed is not None else MINIPACKET_DURATION
+
+    def _radiate(self, start, duration, kind, args):
+        ''' Put a transmission on the air, starting start seconds from now and lasting duration seconds.
+        kind and args describe it to the modems that hear it (see hear()).
+        '''
+        if self.channel is not None:
+            self.channel.transmit(self, start, duration, kind, args)
+            return
+        for peer in self.peers:
+            self.loop.call_later(start + duration + self.latency('owtt'), peer.hear, kind, args)
+
+    # Acoustic receive side
+    def hear(self, kind, args, bad_frames=(), snr=15.0):
+        ''' Called when a transmission from another modem has been received (at the end of the transmission).
+        bad_frames and snr only apply to data packets.
+        '''
+        if kind == 'data':
+            src, dest, rate, ack, frames = args
+            self.receive_packet(src, dest, rate, ack, frames, bad_frames, snr)
+            if ack and dest == self.id:
+                good = [n for n in range(1, len(frames) + 1) if n not in bad_frames]
+                if good:
+                    start = self.latency('turnaround')
+                    duration = self.minipacket_duration()
+                    self.emit("CATXF,0", start + duration)
+                    self._radiate(start, duration, 'ack', (self.id, src, good))
+        elif kind == 'uplink':
+            if args[0] == self.id:
+                self.receive_uplink_request(*args)
+        elif kind == 'ping':
+            src, dest = args
+            if dest == self.id:
+                self.emit("CAMPA,{0},{1}".format(src, dest))
+                self._radiate(self.latency('turnaround'), self.minipacket_duration(), 'ping_reply', (self.id, src))
+        elif kind == 'ping_reply':
+            replier, dest = args
+            if dest == self.id and self._ping_sent_at is not None:
+                # Round trip, less the two minipackets and the far end's turnaround.
+                elapsed = self.loop.time() - self._ping_sent_at
+                owtt = (elapsed - 2 * self.minipacket_duration() - self.latency('turnaround')) / 2.0
+                self._ping_sent_at = None
+                self.emit("CAMPR,{0},{1},{2:.4f}".format(replier, dest, owtt))
+        elif kind == 'ack':
+            acker, dest, frame_nums = args
+            if dest == self.id:
+                for frame_num in frame_nums:
+                    self.emit("CAACK,{0},{1},{2},1".format(acker, dest, frame_num))
+
+    def receive_packet(self, src, dest, rate, ack, frames, bad_frames=(), snr=15.0):
+        ''' Report an acoustically received packet to the host.
+        frames is a list of frame data; frames whose (1-based) numbers are in bad_frames are reported as BAD_CRC.
+        '''
+        self.packets_received += 1
+        spacing = self.latency('frame_spacing')
+        delay = 0.0
+        self.emit("CARXP,{0}".format(rate), delay)
+        delay += spacing
+        self.emit("CACYC,0,{0},{1},{2},{3},{4}".format(src, dest, rate, int(ack), len(frames)), delay)
+        for frame_num, data in enumerate(frames, 1):
+            delay += spacing
+            if frame_num in bad_frames:
+                self.emit("CAMSG,BAD_CRC,{0}".format(frame_num), delay)
+            else:
+                self.emit("CARXD,{0},{1},{2},{3},{4}".format(src, dest, int(ack), frame_num,
+                                                            bytes(data).hex().upper()), delay)
+        delay += spacing
+        self.emit(self._cst_body(src, dest, rate, len(frames), len(bad_frames), snr), delay)
+
+    def receive_uplink_request(self, src, dest, rate, ack, num_frames):
+        ''' We were asked (acoustically) to send a packet, so ask our host for the data. '''
+        self.emit("CACYC,0,{0},{1},{2},{3},{4}".format(src, dest, rate, ack, num_frames))
+        self._start_downlink(src, dest, rate, ack, num_frames, self.latency('drq'))
+
+    def _cst_body(self, src, dest, rate, num_frames, bad_frames, snr, mode=0):
+        toa = self.now().strftime('%Y%m%d%H%M%S.%f')
+        packet_type = 1 if rate == 0 else 2
+        return ("CACST,6,{mode},{toa},3,250,30,10,200,0,0,0,0,0,{rate},{src},{dest},0,{packet_type},{num_frames},"
+                "{bad_frames},{rss},{snr_in:.2f},{snr_out:.2f},{snr_sym:.2f},-15.00,200,0.00,100,25000,5000").format(
+            mode=mode, toa=toa, rate=rate, src=src, dest=dest, packet_type=packet_type, num_frames=num_frames,
+            bad_frames=bad_frames, rss=int(snr + 150), snr_in=snr, snr_out=snr + 5, snr_sym=snr + 3)
+
+    def _xst_body(self, src, dest, rate, ack, num_frames, frames_sent, nbytes):
+        now = self.now()
+        packet_type = 1 if rate == 0 else 2
+        return "CAXST,6,{0},{1},3,0,200,5000,25000,{2},{3},{4},{5},{6},{7},{8},{9}".format(
+            now.strftime('%Y%m%d'), now.strftime('%H%M%S.%f'), rate, src, dest, ack, num_frames, frames_sent,
+            packet_type, nbytes)
+
+
+class PtySimulatedModem(object):
+    ''' Simulated modem on a pseudo-terminal.  Connect to it with Micromodem.connect_serial(sim.port).
+    Runs on an IoHub (a new one, unless one is given).  POSIX only.
+    '''
+
+    def __init__(self, modem_id=1, hub=None, **core_args):
+        self.hub = hub if hub is not None else IoHub(name='simulator')
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+
+        self._framer = NmeaFramer()
+        self._pending = bytearray()
+        self.core = SimulatedModemCore(modem_id, loop=self.hub, output=self._write, **core_args)
+        self.hub.add_reader(self._master, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        for line in self._framer.feed(data):
+            self.core.handle_line(line)
+
+    def _write(self, data):
+        self._pending.extend(data)
+        self._flush()
+
+    def _flush(self):
+        try:
+            while self._pending:
+                sent = os.write(self._master, self._pending)
+                del self._pending[:sent]
+        except BlockingIOError:
+            # The host isn't reading fast enough.  Try again shortly.
+            self.hub.call_later(0.01, self._flush)
+
+    def close(self):
+        self.hub.remove_reader(self._master)
+        os.close(self._master)
+        os.close(self._slave)
+
+
+class UdpSimulatedModem(object):
+    ''' Simulated modem on a UDP socket.
+    UdpConnection sends to (host, listen_port) and receives on its local port, which is host_address here.
+    '''
+
+    def __init__(self, listen_port, host_address, modem_id=1, hub=None, listen_host='127.0.0.1', **core_args):
+        self.hub = hub if hub is not None else IoHub(name='simulator')
+        self.host_address = host_address
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((listen_host, listen_port))
+        self._socket.setblocking(False)
+        self.address = self._socket.getsockname()
+
+        self._framer = NmeaFramer()
+        self.core = SimulatedModemCore(modem_id, loop=self.hub, output=self._write, **core_args)
+        self.hub.add_reader(self._socket, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self._socket.recv(65535)
+        except BlockingIOError:
+            return
+        for line in self._framer.feed(data):
+            self.core.handle_line(line)
+
+    def _write(self, data):
+        self._socket.sendto(data, self.host_address)
+
+    def close(self):
+        self.hub.remove_reader(self._socket)
+        self._socket.close()
@@ -0,0 +1,157 @@
+'''
+Bounded subscriptions to incoming modem events.
+
+A Subscription looks like a Queue to the consumer (get, get_nowait, qsize, empty), but it has a maximum depth and a
+policy that says what to do when a slow consumer lets it fill up.  The modem holds subscriptions weakly, so a
+subscription that is no longer referenced (for example, by a thread that crashed) detaches itself.
+'''
+
+from collections import deque
+from queue import Empty, Full
+from time import monotonic
+import threading
+
+
+# Overflow policies
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class Subscription(object):
+    ''' Bounded, queue-like subscription.
+
+    :param maxsize: Maximum number of undelivered items.  0 means unbounded.
+    :param policy: What to do with a new item when the subscription is full:
+        DROP_OLDEST discards the oldest undelivered item, DROP_NEWEST discards the new item, and BLOCK waits up to
+        block_timeout seconds for the consumer to make room (and then discards the new item).
+        BLOCK holds up the thread that is publishing (usually the connection's read thread), so use it with care.
+    :param block_timeout: Longest time to wait under the BLOCK policy.
+    :param on_close: Called with this subscription when it is closed (the modem uses this to detach it).
+    '''
+
+    def __init__(self, maxsize=1000, policy=DROP_OLDEST, block_timeout=1.0, name=None, on_close=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown subscription policy: {0}".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.name = name
+        self._on_close = on_close
+
+        self._items = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self.closed = False
+
+        # Statistics: accepted counts items queued, delivered counts items the consumer has taken, and dropped counts
+        # items discarded by the overflow policy (including accepted items that DROP_OLDEST evicted).
+        self.accepted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def _full(self):
+        return 0 < self.maxsize <= len(self._items)
+
+    def offer(self, item):
+        ''' Publish item to this subscription, applying the overflow policy.  Returns True if it was queued. '''
+        with self._cond:
+            if self.closed:
+                return False
+            if self._full():
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                else:
+                    deadline = monotonic() + self.block_timeout
+                    while self._full() and not self.closed:
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    if self._full() or self.closed:
+                        self.dropped += 1
+                        return False
+
+            self._items.append(item)
+            self.accepted += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._cond.notify_all()
+            return True
+
+    # Queue-compatible interface
+    def put(self, item, block=True, timeout=None):
+        ''' Queue.put semantics, ignoring the overflow policy (raises Full). '''
+        with self._cond:
+            if block:
+                deadline = None if timeout is None else monotonic() + timeout
+                while self._full():
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Full
+                    self._cond.wait(remaining)
+            elif self._full():
+                raise Full
+            self._items.append(item)
+            self.accepted += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._cond.notify_all()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self._cond:
+            if block:
+                deadline = None if timeout is None else monotonic() + timeout
+                while not self._items:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Empty
+                    self._cond.wait(remaining)
+            elif not self._items:
+                raise Empty
+            item = self._items.popleft()
+            self.delivered += 1
+            # Wake anyone blocked in offer or put.
+            self._cond.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def full(self):
+        return self._full()
+
+    def stats(self):
+        return {'name': self.name, 'depth': len(self._items), 'accepted': self.accepted, 'delivered': self.delivered,
+                'dropped': self.dropped, 'high_water': self.high_water}
+
+    def close(self):
+        ''' Detach from the modem.  Items that were already queued can still be read. '''
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
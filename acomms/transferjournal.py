@@ -0,0 +1,209 @@
+'''
+On-disk journal of the byte ranges of a transfer that have been delivered, so that an interrupted transfer can resume.
+
+The journal is append-only: a 28 byte header (magic, 16 byte session id, file size) followed by a 17 byte record for
+each range ('R', start, end).  Appends are buffered and fsynced in batches (every sync_every records or sync_interval
+seconds, and on close), so a crash can lose the last few records, which only means resending a little more.  A
+record cut short by a crash is dropped when the journal is loaded.  Journals with many small records are compacted
+when they are opened.
+
+    journal = TransferJournal(path, session_id=session_id, size=size)
+    offset = journal.committed          # resume from here
+    ...
+    journal.append(start, end)          # after each delivered range
+    ...
+    journal.discard()                   # the transfer is complete
+'''
+
+from bisect import bisect_left, bisect_right
+import os
+import struct
+import uuid
+
+from .clock import REAL_CLOCK
+
+
+MAGIC = b'ACJ1'
+HEADER = struct.Struct('!4s16sQ')
+RECORD = struct.Struct('!cQQ')
+
+
+class RangeSet(object):
+    ''' Set of byte ranges [start, end), kept merged and sorted. '''
+
+    def __init__(self, ranges=()):
+        self._starts = []
+        self._ends = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if end <= start:
+            return
+        # Ranges that overlap or touch [start, end) are merged with it.
+        lo = bisect_left(self._ends, start)
+        hi = bisect_right(self._starts, end)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+    def __contains__(self, offset):
+        i = bisect_right(self._starts, offset) - 1
+        return i >= 0 and offset < self._ends[i]
+
+    def __iter__(self):
+        return iter(zip(self._starts, self._ends))
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def total(self):
+        ''' Number of bytes covered. '''
+        return sum(end - start for start, end in self)
+
+    def prefix(self):
+        ''' End of the range that starts at 0 (0 if there isn't one). '''
+        if self._starts and self._starts[0] == 0:
+            return self._ends[0]
+        return 0
+
+    def missing(self, size):
+        ''' Ranges in [0, size) that aren't in the set. '''
+        gaps = []
+        position = 0
+        for start, end in self:
+            if start >= size:
+                break
+            if start > position:
+                gaps.append((position, start))
+            position = max(position, end)
+        if position < size:
+            gaps.append((position, size))
+        return gaps
+
+
+class TransferJournal(object):
+    ''' Journal for one transfer session, at path.
+
+    An existing journal is reused if its session id matches session_id (any session, if session_id is None) and its
+    size matches size (if given); otherwise a new session is started, with session_id or a new random id.
+
+    :param before_sync: Called before the journal is fsynced, for example to fsync the file being written, so that
+        the journal never claims data that isn't on disk.
+    '''
+
+    def __init__(self, path, session_id=None, size=None, sync_every=16, sync_interval=5.0, clock=None,
+                 before_sync=None):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.clock = clock if clock is not None else REAL_CLOCK
+        self.before_sync = before_sync
+        self.ranges = RangeSet()
+        self.session_id = None
+        self.size = None
+        self._file = None
+        self._pending = 0
+        self._last_sync = self.clock.time()
+
+        if not self._load(session_id, size):
+            self._create(session_id if session_id is not None else uuid.uuid4().hex, size or 0)
+
+    @property
+    def committed(self):
+        ''' Bytes delivered from the start of the file without a gap. '''
+        return self.ranges.prefix()
+
+    def _load(self, session_id, size):
+        try:
+            with open(self.path, 'rb') as f:
+                contents = f.read()
+        except (IOError, OSError):
+            return False
+        if len(contents) < HEADER.size:
+            return False
+        magic, raw_id, journal_size = HEADER.unpack_from(contents)
+        if magic != MAGIC:
+            return False
+        if session_id is not None and raw_id != uuid.UUID(hex=session_id).bytes:
+            return False
+        if size is not None and journal_size != size:
+            return False
+
+        records = 0
+        position = HEADER.size
+        while position + RECORD.size <= len(contents):
+            kind, start, end = RECORD.unpack_from(contents, position)
+            if kind != b'R':
+                break
+            self.ranges.add(start, end)
+            records += 1
+            position += RECORD.size
+
+        self.session_id = uuid.UUID(bytes=raw_id).hex
+        self.size = journal_size
+        if records > 4 * len(self.ranges) + 16 or position != len(contents):
+            # Compact (or drop a torn record) by rewriting the merged ranges.
+            self._rewrite()
+        else:
+            self._file = open(self.path, 'ab')
+        return True
+
+    def _create(self, session_id, size):
+        self.session_id = uuid.UUID(hex=session_id).hex
+        self.size = size
+        self.ranges = RangeSet()
+        self._rewrite()
+
+    def _rewrite(self):
+        if self._file is not None:
+            self._file.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, uuid.UUID(hex=self.session_id).bytes, self.size))
+            for start, end in self.ranges:
+                f.write(RECORD.pack(b'R', start, end))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, 'ab')
+
+    def append(self, start, end):
+        ''' Record that [start, end) has been delivered. '''
+        if end <= start:
+            return
+        self.ranges.add(start, end)
+        self._file.write(RECORD.pack(b'R', start, end))
+        self._pending += 1
+        if self._pending >= self.sync_every or self.clock.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is None:
+            return
+        if self.before_sync is not None:
+            self.before_sync()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = self.clock.time()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
+
+    def discard(self):
+        ''' The transfer is finished: close and delete the journal. '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
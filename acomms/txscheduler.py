@@ -0,0 +1,178 @@
+'''
+Prioritized transmit queue in front of the commstate machine.
+
+The modem can only start a packet from Idle.  Instead of rejecting packets that arrive while it is busy, the
+TxScheduler queues them by priority and sends the next one as soon as the state machine returns to Idle, so that
+packets go out back-to-back.  Packets can have a deadline; one that hasn't started transmitting by then is dropped.
+Cancelling the future returned by submit withdraws a packet that hasn't started transmitting.
+'''
+
+from concurrent.futures import Future
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
+import threading
+
+from . import commstate
+from .latencystats import LatencyStats
+
+
+# Priorities: lower numbers go first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+# Outcomes (the result of the future returned by submit)
+SENT = 'sent'
+FAILED = 'failed'
+EXPIRED = 'expired'
+
+# Outcome of a request whose future was cancelled before it started.  The future has no result.
+CANCELLED = 'cancelled'
+
+
+class TxRequest(object):
+    __slots__ = ('packet', 'priority', 'deadline', 'enqueued_at', 'started_at', 'future', 'outcome', 'timer')
+
+    def __init__(self, packet, priority, deadline, enqueued_at):
+        self.packet = packet
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = enqueued_at
+        self.started_at = None
+        self.future = Future()
+        self.outcome = None
+        self.timer = None
+
+
+class TxScheduler(object):
+    ''' Queue of packets waiting for the modem to be Idle.
+
+    Micromodem calls on_idle() whenever its state machine enters Idle, and tx_result() when a packet transmit
+    succeeds or fails.  Times are measured on the modem's clock.
+    '''
+
+    def __init__(self, modem):
+        self.modem = modem
+        self._lock = threading.RLock()
+        self._queue = []
+        self._seq = count()
+        self._current = None
+
+        # Statistics
+        self.queue_wait = LatencyStats("tx queue wait")
+        self.outcomes = {SENT: 0, FAILED: 0, EXPIRED: 0}
+        self._busy_time = 0.0
+        self._stats_since = modem.clock.time()
+
+    @property
+    def depth(self):
+        ''' Number of packets waiting to be sent. '''
+        with self._lock:
+            return sum(1 for (priority, seq, request) in self._queue if request.outcome is None)
+
+    @property
+    def current(self):
+        ''' The request that is being transmitted, if any. '''
+        return self._current
+
+    def submit(self, packet, priority=PRIORITY_NORMAL, deadline=None):
+        ''' Queue packet for transmission, and return a future whose result is SENT, FAILED or EXPIRED.
+        The future can be cancelled until the packet starts transmitting.
+        :param priority: Lower numbers are sent first.  Packets with the same priority are sent in order.
+        :param deadline: Seconds from now by which the packet must start transmitting, or None to wait forever.
+        '''
+        now = self.modem.clock.time()
+        request = TxRequest(packet, priority, None if deadline is None else now + deadline, now)
+        with self._lock:
+            heappush(self._queue, (priority, next(self._seq), request))
+            if deadline is not None:
+                request.timer = self.modem.clock.call_later(deadline, self._expire, request)
+        request.future.add_done_callback(partial(self._cancelled, request))
+        self._dispatch()
+        return request.future
+
+    def on_idle(self):
+        ''' The modem's state machine just entered Idle. '''
+        with self._lock:
+            request = self._current
+            if request is not None:
+                self._current = None
+                self._busy_time += self.modem.clock.time() - request.started_at
+                # Back to Idle without the modem confirming the transmission.
+                self._finish(request, FAILED)
+        self._dispatch()
+
+    def tx_result(self, success):
+        ''' The packet being transmitted succeeded or failed.  Only the first result for a packet counts. '''
+        with self._lock:
+            if self._current is not None:
+                self._finish(self._current, SENT if success else FAILED)
+
+    def stats(self):
+        now = self.modem.clock.time()
+        with self._lock:
+            busy = self._busy_time
+            if self._current is not None:
+                busy += now - self._current.started_at
+            elapsed = now - self._stats_since
+            return {'depth': self.depth, 'sent': self.outcomes[SENT], 'failed': self.outcomes[FAILED],
+                    'expired': self.outcomes[EXPIRED], 'queue_wait': self.queue_wait.as_dict(),
+                    'utilization': busy / elapsed if elapsed > 0 else 0.0}
+
+    def reset_stats(self):
+        with self._lock:
+            self.queue_wait.reset()
+            self.outcomes = {SENT: 0, FAILED: 0, EXPIRED: 0}
+            self._busy_time = 0.0
+            self._stats_since = self.modem.clock.time()
+
+    def _finish(self, request, outcome):
+        if request.outcome is not None:
+            return
+        request.outcome = outcome
+        self.outcomes[outcome] += 1
+        if request.timer is not None:
+            request.timer.cancel()
+        request.future.set_result(outcome)
+
+    def _start(self, request):
+        ''' Take request out of the cancellable state.  Returns False if it was cancelled. '''
+        if request.future.set_running_or_notify_cancel():
+            return True
+        request.outcome = CANCELLED
+        if request.timer is not None:
+            request.timer.cancel()
+        return False
+
+    def _cancelled(self, request, future):
+        if not future.cancelled():
+            return
+        with self._lock:
+            if request.outcome is None:
+                self._start(request)
+
+    def _expire(self, request):
+        with self._lock:
+            if request.started_at is None and request.outcome is None and self._start(request):
+                self._finish(request, EXPIRED)
+
+    def _dispatch(self):
+        # The state lock comes first: state transitions call on_idle (and so _dispatch) with it held.
+        with self.modem.state_lock, self._lock:
+            if self._current is not None or not isinstance(self.modem.state, commstate.Idle):
+                return
+            now = self.modem.clock.time()
+            while self._queue:
+                priority, seq, request = heappop(self._queue)
+                if request.outcome is not None or not self._start(request):
+                    # Expired or cancelled while it was queued.
+                    continue
+                if request.deadline is not None and now > request.deadline:
+                    self._finish(request, EXPIRED)
+                    continue
+                request.started_at = now
+                self.queue_wait.record(now - request.enqueued_at)
+                self._current = request
+                self.modem.state.send_packet(request.packet)
+                return
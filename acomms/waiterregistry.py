@@ -0,0 +1,144 @@
+'''
+Routing of incoming modem events to the threads that are waiting for them.
+
+Each waiter is a one-shot concurrent.futures.Future that is registered under one or more keys (NMEA sentence types
+such as 'CACFG', or event names such as 'cst' and 'xst').  When an event arrives, only the waiters registered under
+its key are examined, so sentences that nobody is waiting for cost a single dictionary lookup.  Waiters registered
+under ANY see every NMEA message, but not the other events (CycleStats, ReceivedPackets and so on), which their
+predicates couldn't make sense of.
+'''
+
+from concurrent.futures import Future, TimeoutError
+import threading
+
+from .clock import REAL_CLOCK
+
+
+# Key used for waiters that need to see every NMEA message (regular expression waiters, for example).
+ANY = None
+
+
+def params_predicate(params):
+    ''' Build a predicate that matches NMEA messages whose parameters match params.
+    The message must have the same number of parameters, and every parameter in params that isn't None or empty
+    must match the corresponding message parameter (compared as strings).
+    '''
+    expected = [(i, str(p)) for (i, p) in enumerate(params) if p is not None and p != '']
+    num_params = len(params)
+
+    def predicate(msg):
+        msg_params = msg['params']
+        if len(msg_params) != num_params:
+            return False
+        for (i, p) in expected:
+            if msg_params[i] != p:
+                return False
+        return True
+
+    return predicate
+
+
+class Waiter(Future):
+    ''' A future that is resolved with the first event that matches its keys and (optional) predicate. '''
+
+    def __init__(self, registry, keys, predicate=None):
+        super(Waiter, self).__init__()
+        self.registry = registry
+        self.keys = tuple(keys)
+        self.predicate = predicate
+
+    def wait(self, timeout=None):
+        ''' Block until this waiter is resolved or the timeout expires.
+        Returns the matching event, or None on timeout.  The waiter is always removed from the registry.
+        '''
+        try:
+            if not self.registry.clock.wait_future(self, timeout):
+                return None
+            return self.result()
+        except TimeoutError:
+            return None
+        finally:
+            self.registry.remove(self)
+
+    def cancel(self):
+        self.registry.remove(self)
+        return super(Waiter, self).cancel()
+
+
+class WaiterRegistry(object):
+    ''' Registry of pending waiters, indexed by event key.  Waits are timed on clock (real time by default). '''
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else REAL_CLOCK
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    def add(self, keys, predicate=None):
+        ''' Register and return a new Waiter.
+        :param keys: A single key or an iterable of keys.  Use ANY to see every event dispatched with broadcast.
+        :param predicate: Optional callable that is given each event with a matching key, and returns True if the
+            waiter should be resolved with it.
+        '''
+        if keys is ANY or isinstance(keys, str):
+            keys = (keys,)
+        waiter = Waiter(self, keys, predicate)
+        with self._lock:
+            for key in waiter.keys:
+                self._waiters.setdefault(key, []).append(waiter)
+        return waiter
+
+    def remove(self, waiter):
+        with self._lock:
+            self._remove_locked(waiter)
+
+    def _remove_locked(self, waiter):
+        for key in waiter.keys:
+            bucket = self._waiters.get(key)
+            if bucket is None:
+                continue
+            try:
+                bucket.remove(waiter)
+            except ValueError:
+                continue
+            if not bucket:
+                del self._waiters[key]
+
+    def dispatch(self, key, event, broadcast=True):
+        ''' Resolve every waiter registered under key (or ANY, if broadcast) whose predicate accepts event.
+        A predicate that raises is treated as not matching.  Returns the number of waiters resolved.
+        '''
+        # Fast path: nobody is waiting for this key.
+        waiters = self._waiters
+        if key not in waiters and (not broadcast or ANY not in waiters):
+            return 0
+
+        matched = []
+        with self._lock:
+            candidates = waiters.get(key, [])
+            if broadcast:
+                candidates = candidates + waiters.get(ANY, [])
+            for waiter in candidates:
+                if waiter.done():
+                    continue
+                if waiter.predicate is not None:
+                    try:
+                        if not waiter.predicate(event):
+                            continue
+                    except Exception:
+                        continue
+                matched.append(waiter)
+                self._remove_locked(waiter)
+
+        for waiter in matched:
+            # The waiter may have been cancelled after we released the lock.
+            if waiter.set_running_or_notify_cancel():
+                waiter.set_result(event)
+
+        return len(matched)
+
+    def pending_count(self, key=ANY):
+        ''' Number of waiters registered under key (or all waiters, if key is ANY). '''
+        with self._lock:
+            if key is ANY:
+                return len(set(w for bucket in self._waiters.values() for w in bucket))
+            return len(self._waiters.get(key, []))
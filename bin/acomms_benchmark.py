@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+#__author__ = 'Eric Gallimore'
+
+from acomms import compression, nmeachecksum
+from acomms.channelsimulator import ChannelSimulator
+from acomms.messageparams import Rates
+from acomms.micromodem import Micromodem, Message, LazyMessage
+from acomms.latencystats import LatencyStats
+from acomms.modem_connections import IoHub
+from acomms.simulatedmodem import PtySimulatedModem
+from acomms.unifiedlog import UnifiedLog
+from threading import Thread
+from time import monotonic, process_time
+from collections import Counter
+from functools import reduce
+from timeit import timeit
+import argparse
+import os
+import random
+import tracemalloc
+
+
+# Sample of the sentences we see most often from the modem (without the leading $ and checksum).
+sample_bodies = [
+    "CATXP,1",
+    "CAMPC,0,1",
+    "CACFG,SRC,1",
+    "CATXD,0,1,0,1",
+    "CADRQ,120000,0,1,0,64,1",
+    "CACYC,0,0,1,1,0,3",
+    "CAXST,6,20120125,120000.123456,1,0,50,5000,25000,1,0,1,0,3,3,2,192",
+    "CACST,6,0,20120125120000.123456,1,250,30,10,200,-10,0,0,0,0,1,0,1,0,2,3,0,50,10.5,12.1,9.5,-15.2,200,0.1,100,"
+    "25000,5000",
+    "CARXD,1,0,0,1," + "AB" * 64,
+]
+sample_sentences = ["${0}*{1}\r\n".format(body, nmeachecksum.nmea_checksum(body)) for body in sample_bodies]
+
+
+def legacy_nmea_checksum(inpStr):
+    ''' The checksum implementation that pyacomms used before nmeachecksum was added. '''
+    return "".join(["%02X" % x for x in [reduce(lambda x, y: x ^ y, list(map(ord, inpStr)))]])
+
+
+# The lookup table from the old micromodem.nmeaChecksum32, copied verbatim so that the comparison doesn't depend on
+# anything in nmeachecksum.
+LEGACY_CRC32_TABLE = [
+    0x00000000, 0x8c8cd047, 0xb5dec035, 0x39521072, 0xc77ae0d1, 0x4bf63096, 0x72a420e4, 0xfe28f0a3,
+    0x2232a119, 0xaebe715e, 0x97ec612c, 0x1b60b16b, 0xe54841c8, 0x69c4918f, 0x509681fd, 0xdc1a51ba,
+    0x44654232, 0xc8e99275, 0xf1bb8207, 0x7d375240, 0x831fa2e3, 0x0f9372a4, 0x36c162d6, 0xba4db291,
+    0x6657e32b, 0xeadb336c, 0xd389231e, 0x5f05f359, 0xa12d03fa, 0x2da1d3bd, 0x14f3c3cf, 0x987f1388,
+    0x88ca8464, 0x04465423, 0x3d144451, 0xb1989416, 0x4fb064b5, 0xc33cb4f2, 0xfa6ea480, 0x76e274c7,
+    0xaaf8257d, 0x2674f53a, 0x1f26e548, 0x93aa350f, 0x6d82c5ac, 0xe10e15eb, 0xd85c0599, 0x54d0d5de,
+    0xccafc656, 0x40231611, 0x79710663, 0xf5fdd624, 0x0bd52687, 0x8759f6c0, 0xbe0be6b2, 0x328736f5,
+    0xee9d674f, 0x6211b708, 0x5b43a77a, 0xd7cf773d, 0x29e7879e, 0xa56b57d9, 0x9c3947ab, 0x10b597ec,
+    0xbd526873, 0x31deb834, 0x088ca846, 0x84007801, 0x7a2888a2, 0xf6a458e5, 0xcff64897, 0x437a98d0,
+    0x9f60c96a, 0x13ec192d, 0x2abe095f, 0xa632d918, 0x581a29bb, 0xd496f9fc, 0xedc4e98e, 0x614839c9,
+    0xf9372a41, 0x75bbfa06, 0x4ce9ea74, 0xc0653a33, 0x3e4dca90, 0xb2c11ad7, 0x8b930aa5, 0x071fdae2,
+    0xdb058b58, 0x57895b1f, 0x6edb4b6d, 0xe2579b2a, 0x1c7f6b89, 0x90f3bbce, 0xa9a1abbc, 0x252d7bfb,
+    0x3598ec17, 0xb9143c50, 0x80462c22, 0x0ccafc65, 0xf2e20cc6, 0x7e6edc81, 0x473cccf3, 0xcbb01cb4,
+    0x17aa4d0e, 0x9b269d49, 0xa2748d3b, 0x2ef85d7c, 0xd0d0addf, 0x5c5c7d98, 0x650e6dea, 0xe982bdad,
+    0x71fdae25, 0xfd717e62, 0xc4236e10, 0x48afbe57, 0xb6874ef4, 0x3a0b9eb3, 0x03598ec1, 0x8fd55e86,
+    0x53cf0f3c, 0xdf43df7b, 0xe611cf09, 0x6a9d1f4e, 0x94b5efed, 0x18393faa, 0x216b2fd8, 0xade7ff9f,
+    0xd663b05d, 0x5aef601a, 0x63bd7068, 0xef31a02f, 0x1119508c, 0x9d9580cb, 0xa4c790b9, 0x284b40fe,
+    0xf4511144, 0x78ddc103, 0x418fd171, 0xcd030136, 0x332bf195, 0xbfa721d2, 0x86f531a0, 0x0a79e1e7,
+    0x9206f26f, 0x1e8a2228, 0x27d8325a, 0xab54e21d, 0x557c12be, 0xd9f0c2f9, 0xe0a2d28b, 0x6c2e02cc,
+    0xb0345376, 0x3cb88331, 0x05ea9343, 0x89664304, 0x774eb3a7, 0xfbc263e0, 0xc2907392, 0x4e1ca3d5,
+    0x5ea93439, 0xd225e47e, 0xeb77f40c, 0x67fb244b, 0x99d3d4e8, 0x155f04af, 0x2c0d14dd, 0xa081c49a,
+    0x7c9b9520, 0xf0174567, 0xc9455515, 0x45c98552, 0xbbe175f1, 0x376da5b6, 0x0e3fb5c4, 0x82b36583,
+    0x1acc760b, 0x9640a64c, 0xaf12b63e, 0x239e6679, 0xddb696da, 0x513a469d, 0x686856ef, 0xe4e486a8,
+    0x38fed712, 0xb4720755, 0x8d201727, 0x01acc760, 0xff8437c3, 0x7308e784, 0x4a5af7f6, 0xc6d627b1,
+    0x6b31d82e, 0xe7bd0869, 0xdeef181b, 0x5263c85c, 0xac4b38ff, 0x20c7e8b8, 0x1995f8ca, 0x9519288d,
+    0x49037937, 0xc58fa970, 0xfcddb902, 0x70516945, 0x8e7999e6, 0x02f549a1, 0x3ba759d3, 0xb72b8994,
+    0x2f549a1c, 0xa3d84a5b, 0x9a8a5a29, 0x16068a6e, 0xe82e7acd, 0x64a2aa8a, 0x5df0baf8, 0xd17c6abf,
+    0x0d663b05, 0x81eaeb42, 0xb8b8fb30, 0x34342b77, 0xca1cdbd4, 0x46900b93, 0x7fc21be1, 0xf34ecba6,
+    0xe3fb5c4a, 0x6f778c0d, 0x56259c7f, 0xdaa94c38, 0x2481bc9b, 0xa80d6cdc, 0x915f7cae, 0x1dd3ace9,
+    0xc1c9fd53, 0x4d452d14, 0x74173d66, 0xf89bed21, 0x06b31d82, 0x8a3fcdc5, 0xb36dddb7, 0x3fe10df0,
+    0xa79e1e78, 0x2b12ce3f, 0x1240de4d, 0x9ecc0e0a, 0x60e4fea9, 0xec682eee, 0xd53a3e9c, 0x59b6eedb,
+    0x85acbf61, 0x09206f26, 0x30727f54, 0xbcfeaf13, 0x42d65fb0, 0xce5a8ff7, 0xf7089f85, 0x7b844fc2]
+
+
+def legacy_nmea_checksum32(inpStr):
+    ''' The per-call table loop that pyacomms used before nmeachecksum was added.
+    The old version formatted its result with hex()[2:-1], which drops the last digit on Python 3, so this copy
+    formats the full eight digits to allow a direct comparison.
+    '''
+    crc = 0xffffffff
+    bytestring = bytearray(inpStr.encode("iso-8859-1"))
+    for i in range(len(bytestring)):
+        crc = (crc >> 8) ^ LEGACY_CRC32_TABLE[0xff & (crc ^ bytestring[i])]
+    return "{:08X}".format(~crc & 0xffffffff)
+
+
+def bench_checksum(args):
+    bodies = list(sample_bodies)
+    rng = random.Random(0)
+    bodies += [os.urandom(rng.randint(1, 300)).hex().upper() for i in range(200)]
+
+    # Correctness first.
+    mismatches = 0
+    for body in bodies:
+        if nmeachecksum.nmea_checksum(body) != legacy_nmea_checksum(body):
+            mismatches += 1
+        if nmeachecksum.nmea_checksum32(body) != legacy_nmea_checksum32(body):
+            mismatches += 1
+        if nmeachecksum.nmea_checksum(body.encode()) != nmeachecksum.nmea_checksum(body):
+            mismatches += 1
+    print("Checksum mismatches against legacy implementation: {0}".format(mismatches))
+
+    lines = ["${0}*{1}\r\n".format(b, nmeachecksum.nmea_checksum(b)) for b in bodies]
+    if not all(nmeachecksum.validate_many(lines)):
+        print("validate_many rejected a valid line")
+    if any(nmeachecksum.validate_many([l.replace('*', 'X*') for l in lines])):
+        print("validate_many accepted a corrupted line")
+
+    number = args.iterations
+    results = [
+        ("legacy XOR (str)", lambda: [legacy_nmea_checksum(b) for b in bodies]),
+        ("nmea_checksum (str)", lambda: [nmeachecksum.nmea_checksum(b) for b in bodies]),
+        ("legacy CRC32 (str)", lambda: [legacy_nmea_checksum32(b) for b in bodies]),
+        ("nmea_checksum32 (str)", lambda: [nmeachecksum.nmea_checksum32(b) for b in bodies]),
+    ]
+    encoded_lines = [l.encode() for l in lines]
+    results.append(("validate_many (bytes)", lambda: nmeachecksum.validate_many(encoded_lines)))
+
+    for name, fxn in results:
+        elapsed = timeit(fxn, number=number)
+        per_call_us = elapsed / (number * len(bodies)) * 1e6
+        print("{0:<28}{1:>10.2f} us/line".format(name, per_call_us))
+
+
+def bench_message(args):
+    # Our stream is dominated by echoes that nobody looks at beyond the type, so weight the mix accordingly.
+    lines = (sample_sentences[:4] * 4 + sample_sentences) * (args.count // (len(sample_sentences) * 5) + 1)
+    lines = lines[:args.count]
+
+    for message_class in (Message, LazyMessage):
+        tracemalloc.start()
+        messages = [message_class(line) for line in lines]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del messages
+
+        type_only = timeit(lambda: [message_class(line)['type'] for line in lines], number=args.iterations)
+        with_params = timeit(lambda: [message_class(line)['params'] for line in lines], number=args.iterations)
+        num_lines = float(len(lines) * args.iterations)
+        print("{0:<14}{1:>8.0f} bytes/msg{2:>10.2f} us/line (type only){3:>10.2f} us/line (params)".format(
+            message_class.__name__, float(current) / len(lines),
+            type_only / num_lines * 1e6, with_params / num_lines * 1e6))
+
+
+def bench_simulator(args):
+    hub = IoHub(name='simulator')
+    latencies = {'transmit': args.transmit_time, 'owtt': args.owtt}
+    sim_a = PtySimulatedModem(1, hub=hub, baudrate=args.baudrate, latencies=latencies)
+    sim_b = PtySimulatedModem(2, hub=hub, baudrate=args.baudrate, latencies=latencies)
+    sim_a.core.link(sim_b.core)
+
+    unified_log = UnifiedLog(log_path=args.log_path)
+    modem_a = Micromodem(name='sim1', unified_log=unified_log)
+    modem_b = Micromodem(name='sim2', unified_log=unified_log)
+    modem_a.connect_serial(sim_a.port, args.baudrate)
+    modem_b.connect_serial(sim_b.port, args.baudrate)
+
+    round_trip = LatencyStats("get_config round trip")
+    for i in range(args.iterations):
+        start = monotonic()
+        modem_a.get_config('AGC')
+        round_trip.record(monotonic() - start)
+    print(round_trip)
+
+    names = sorted(sim_a.core.config)
+    start = monotonic()
+    modem_a.get_config_many(names)
+    print("get_config_many ({0} parameters): {1:.1f} ms".format(len(names), (monotonic() - start) * 1e3))
+
+    payload = bytearray(os.urandom(Rates[args.rate].maxpacketsize))
+    received = []
+
+    def receive():
+        for i in range(args.packets):
+            received.append(modem_b.wait_for_data_packet(timeout=10))
+
+    receiver = Thread(target=receive)
+    receiver.start()
+    packet_time = LatencyStats("send_packet_data to CAXST")
+    start = monotonic()
+    for i in range(args.packets):
+        packet_start = monotonic()
+        modem_a.send_packet_data(2, payload, rate_num=args.rate)
+        if modem_a.wait_for_xst(timeout=10) is not None:
+            packet_time.record(monotonic() - packet_start)
+        # Give the receiver time to report the packet before the next one starts.
+        modem_b.wait_for_cst(timeout=10)
+    receiver.join()
+    elapsed = monotonic() - start
+    good = sum(1 for data in received if data == payload)
+    print(packet_time)
+    print("{0}/{1} packets delivered intact, {2:.0f} bytes/s (simulated transmit time {3} s)".format(
+        good, args.packets, good * len(payload) / elapsed, args.transmit_time))
+    print(modem_a.tx_latency)
+    print(modem_a.drq_latency)
+
+
+def bench_channel(args):
+    sim = ChannelSimulator(unified_log=UnifiedLog(log_path=args.log_path), seed=args.seed)
+    nodes = [sim.add_node(i + 1, (i * args.spacing, 0, 10)) for i in range(args.nodes)]
+
+    delivered = Counter()
+    for node in nodes:
+        node.modem.cst_listeners.append(lambda cst, msg, node=node: delivered.update(
+            [node.id] if cst['dest'] == node.id else []))
+
+    # Round-robin TDMA: each node sends to the next one in its own slot, with some random jitter.
+    rng = random.Random(args.seed)
+    payload = bytearray(Rates[args.rate].maxpacketsize)
+    num_slots = int(args.hours * 3600 / args.slot)
+    for slot in range(num_slots):
+        node = nodes[slot % len(nodes)]
+        dest = nodes[(slot + 1) % len(nodes)].id
+        sim.clock.call_at(slot * args.slot + rng.uniform(0, args.jitter), node.modem.send_packet_data,
+                              dest, payload, args.rate)
+
+    start = monotonic()
+    sim.run_for(args.hours * 3600)
+    elapsed = monotonic() - start
+    print("{0:.1f} simulated hours in {1:.1f} s ({2:.0f}x real time), {3} events".format(
+        args.hours, elapsed, args.hours * 3600 / elapsed, sim.clock.events_run))
+    print("{0}/{1} packets received by the addressed node, {2} commstate timeouts".format(
+        sum(delivered.values()), num_slots, sum(node.modem.state_timeouts for node in nodes)))
+    for key, value in sorted(sim.channel.stats.items()):
+        print("  {0:<24}{1:>10}".format(key, value))
+
+
+def sample_payloads(rng, size):
+    ''' Payloads like the ones we send: a CSV sensor log, a modem log and (incompressible) binary data. '''
+    csv_lines = ["time,lat,lon,depth,temp,status\n"]
+    t = 1700000000
+    while sum(len(l) for l in csv_lines) < size:
+        t += rng.choice((1, 1, 2))
+        csv_lines.append("{0},{1:.5f},{2:.5f},{3:.1f},{4:.2f},{5}\n".format(
+            t, 41.52 + rng.gauss(0, 0.001), -70.67 + rng.gauss(0, 0.001), 20 + rng.gauss(0, 0.5),
+            12 + rng.gauss(0, 0.1), rng.choice(("OK", "OK", "OK", "LOWBATT"))))
+    log_lines = []
+    while sum(len(l) for l in log_lines) < size:
+        log_lines.append("2023-11-14 22:{0:02d}:{1:02d},{2:03d} {3}".format(
+            rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999), rng.choice(sample_sentences)))
+    return [("csv", "".join(csv_lines).encode()[:size]),
+            ("modem log", "".join(log_lines).encode()[:size]),
+            ("binary", bytes(rng.getrandbits(8) for i in range(size)))]
+
+
+def bench_compression(args):
+    rng = random.Random(args.seed)
+    packet_size = Rates[args.rate].maxpacketsize
+
+    # Train the dictionary on packets from one set of payloads and measure on another.
+    training = [data[i:i + packet_size] for name, data in sample_payloads(rng, args.size)[:2]
+                for i in range(0, len(data), packet_size)]
+    start = process_time()
+    dictionary = compression.train_dictionary(training, size=args.dictionary_size)
+    print("Trained {0!r} on {1} samples in {2:.2f} s CPU".format(dictionary, len(training), process_time() - start))
+    codecs = [compression.ZlibCodec(), compression.LzmaCodec(), compression.DictionaryCodec(dictionary)]
+    selector = compression.CodecSelector(codecs)
+
+    print("{0:<20}{1:<9}{2:>8}{3:>8}{4:>14}{5:>14}  {6}".format(
+        "payload", "codec", "bytes", "ratio", "compress", "decompress", "selected"))
+    for name, data in sample_payloads(rng, args.size):
+        for unit, chunks in (("file", [data]),
+                             ("packet", [data[i:i + packet_size] for i in range(0, len(data), packet_size)])):
+            start = process_time()
+            selected = [selector.select(chunk) for chunk in chunks]
+            select_time = process_time() - start
+            selected_names = sorted(set(compression.describe(codec).split('-')[0] for codec in selected))
+            for codec in codecs:
+                start = process_time()
+                for i in range(args.iterations):
+                    compressed = [codec.compress(chunk) for chunk in chunks]
+                compress_time = (process_time() - start) / args.iterations
+                start = process_time()
+                for i in range(args.iterations):
+                    for chunk in compressed:
+                        codec.decompress(chunk)
+                decompress_time = (process_time() - start) / args.iterations
+                compressed_size = sum(len(chunk) for chunk in compressed)
+                print("{0:<20}{1:<9}{2:>8}{3:>8.2f}{4:>9.1f} us/KB{5:>9.1f} us/KB  {6}".format(
+                    "{0} ({1})".format(name, unit) if codec is codecs[0] else "", codec.name, compressed_size,
+                    float(len(data)) / compressed_size, compress_time / len(data) * 1024 * 1e6,
+                    decompress_time / len(data) * 1024 * 1e6,
+                    "" if codec is not codecs[0] else "{0} ({1:.1f} us/KB to choose)".format(
+                        "/".join(selected_names), select_time / len(data) * 1024 * 1e6)))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Benchmarks for the pyacomms host-side processing')
+    subparsers = ap.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    checksum_parser = subparsers.add_parser('checksum', help='NMEA checksum engine against the legacy functions')
+    checksum_parser.add_argument("-n", "--iterations", type=int, default=200, help="Passes over the sample lines")
+    checksum_parser.set_defaults(func=bench_checksum)
+
+    message_parser = subparsers.add_parser('message', help='Memory and parse time of Message against LazyMessage')
+    message_parser.add_argument("-c", "--count", type=int, default=20000, help="Number of messages to hold")
+    message_parser.add_argument("-n", "--iterations", type=int, default=5, help="Passes over the messages")
+    message_parser.set_defaults(func=bench_message)
+
+    simulator_parser = subparsers.add_parser('simulator', help='End-to-end latency and throughput against two '
+                                                                'simulated modems on ptys')
+    simulator_parser.add_argument("-n", "--iterations", type=int, default=50, help="get_config round trips")
+    simulator_parser.add_argument("-p", "--packets", type=int, default=10, help="Packets to send")
+    simulator_parser.add_argument("-r", "--rate", type=int, default=1, help="Packet rate number")
+    simulator_parser.add_argument("-b", "--baudrate", type=int, default=19200, help="Simulated serial baud rate")
+    simulator_parser.add_argument("--transmit-time", type=float, default=0.05, help="Seconds on the air per packet")
+    simulator_parser.add_argument("--owtt", type=float, default=0.01, help="One-way acoustic travel time")
+    simulator_parser.add_argument("--log-path", default='/tmp/acomms_benchmark', help="Directory for modem logs")
+    simulator_parser.set_defaults(func=bench_simulator)
+
+    channel_parser = subparsers.add_parser('channel', help='Simulated multi-node network on a virtual clock')
+    channel_parser.add_argument("-n", "--nodes", type=int, default=4, help="Number of nodes")
+    channel_parser.add_argument("--hours", type=float, default=12, help="Simulated hours")
+    channel_parser.add_argument("--spacing", type=float, default=1500, help="Meters between nodes")
+    channel_parser.add_argument("-r", "--rate", type=int, default=1, help="Packet rate number")
+    channel_parser.add_argument("--slot", type=float, default=20, help="TDMA slot length (s)")
+    channel_parser.add_argument("--jitter", type=float, default=2, help="Random delay at the start of each slot (s)")
+    channel_parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    channel_parser.add_argument("--log-path", default='/tmp/acomms_benchmark', help="Directory for modem logs")
+    channel_parser.set_defaults(func=bench_channel)
+
+    compression_parser = subparsers.add_parser('compression', help='Compression ratio against CPU time for each codec, '
+                                                                   'per file and per packet')
+    compression_parser.add_argument("-s", "--size", type=int, default=65536, help="Bytes of each sample payload")
+    compression_parser.add_argument("-r", "--rate", type=int, default=1, help="Packet rate number (sets packet size)")
+    compression_parser.add_argument("-d", "--dictionary-size", type=int, default=4096, help="Dictionary bytes")
+    compression_parser.add_argument("-n", "--iterations", type=int, default=3, help="Passes over the payloads")
+    compression_parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    compression_parser.set_defaults(func=bench_compression)
+
+    args = ap.parse_args()
+    args.func(args)
@@ -37,6 +37,10 @@ setup(
         "apscheduler>=2.1.1",
         "crcmod>=1.7"
     ],
+    extras_require={
+        # Vectorized erasure coding for fectransfer
+        "fec": ["numpy"],
+    },
     py_modules=['ez_setup'],
     classifiers=[
         "Development Status :: 4 - Beta",
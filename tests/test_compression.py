@@ -0,0 +1,78 @@
+'''
+Every codec has to give back exactly what it was handed, with or without the pad bytes the modem appends to a short
+final frame, and compressed data has to name the codec and dictionary it needs.  Corrupt data must fail with
+ValueError and an unknown codec or dictionary with KeyError, never with a half-decoded payload.  The sample data is
+the kind of short CSV log line a vehicle reports, which is what the trained dictionary is for.
+'''
+
+import os
+import unittest
+
+from acomms import compression
+from acomms.compression import (NullCodec, ZlibCodec, LzmaCodec, DictionaryCodec, CodecSelector, Dictionary,
+                                train_dictionary)
+
+
+LINE = b"%d,2024-05-01T12:%02d:%02d,41.52%03d,-70.67%02d,%d\n"
+
+
+class CompressionTest(unittest.TestCase):
+
+    @staticmethod
+    def csv_lines(count, start=0):
+        return b''.join(LINE % (i, i // 60 % 60, i % 60, i % 1000, i % 97, i % 37) for i in range(start, start + count))
+
+    def setUp(self):
+        self.dictionary = train_dictionary([self.csv_lines(4, start) for start in range(0, 4000, 40)], size=1024)
+        self.known = {self.dictionary.id: self.dictionary}
+
+    def codecs(self):
+        return [NullCodec(), ZlibCodec(), LzmaCodec(), DictionaryCodec(self.dictionary)]
+
+    def test_codec_round_trip(self):
+        for data in (b'', b'x', self.csv_lines(200), os.urandom(3000)):
+            for codec in self.codecs():
+                self.assertEqual(codec.decompress(codec.compress(data)), data, codec.name)
+
+    def test_compress_round_trip(self):
+        for data in (b'', self.csv_lines(3), self.csv_lines(500), os.urandom(500)):
+            for codec in self.codecs() + [CodecSelector(dictionaries=[self.dictionary])]:
+                packed = compression.compress(data, codec)
+                self.assertEqual(compression.decompress(packed, self.known), data)
+
+    def test_padding_is_ignored(self):
+        data = self.csv_lines(50)
+        for codec in (ZlibCodec(), LzmaCodec(), DictionaryCodec(self.dictionary)):
+            packed = compression.compress(data, codec) + b'\x1a' * 20
+            self.assertEqual(compression.decompress(packed, self.known), data)
+
+    def test_dictionary_helps_small_payloads(self):
+        data = self.csv_lines(2, 5000)
+        self.assertLess(len(DictionaryCodec(self.dictionary).compress(data)), len(ZlibCodec().compress(data)))
+        self.assertLessEqual(len(self.dictionary.data), 1024)
+
+    def test_selector_falls_back_to_no_compression(self):
+        self.assertIsInstance(CodecSelector().select(os.urandom(2000)), NullCodec)
+        self.assertNotIsInstance(CodecSelector().select(self.csv_lines(200)), NullCodec)
+
+    def test_describe_round_trip(self):
+        for codec in self.codecs():
+            described = compression.describe(codec)
+            restored = compression.codec_from_description(described, self.known)
+            self.assertEqual((restored.id, restored.dictionary), (codec.id, codec.dictionary))
+        self.assertRaises(KeyError, compression.codec_from_description, 'brotli')
+
+    def test_dictionary_id_is_stable(self):
+        self.assertEqual(Dictionary(self.dictionary.data).id, self.dictionary.id)
+
+    def test_corrupt_data(self):
+        packed = compression.compress(self.csv_lines(100), ZlibCodec())
+        for data in (b'', b'\x03\x01', b'\x03', packed[:len(packed) // 2], b'\x01\xff\xff\xff'):
+            self.assertRaises(ValueError, compression.decompress, data, self.known)
+        self.assertRaises(KeyError, compression.decompress, b'\x09abc')
+        unknown = compression.compress(self.csv_lines(3), DictionaryCodec(Dictionary(b'some other dictionary')))
+        self.assertRaises(KeyError, compression.decompress, unknown, self.known)
+
+
+if __name__ == '__main__':
+    unittest.main()
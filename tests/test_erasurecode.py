@@ -0,0 +1,69 @@
+'''
+ErasureCode has to rebuild a generation from any k distinct symbols, source or repair, for every generation size up
+to MAX_SYMBOLS - 1, and the NumPy and pure Python paths have to produce the same symbols.  Asking for too few symbols
+or an index past MAX_SYMBOLS is a ValueError.
+'''
+
+import os
+import random
+import unittest
+
+from acomms import erasurecode
+from acomms.erasurecode import ErasureCode, MAX_SYMBOLS
+
+
+class ErasureCodeTest(unittest.TestCase):
+
+    def make_source(self, k, symbol_size):
+        return [os.urandom(symbol_size) for _ in range(k)]
+
+    def round_trip(self, k, symbol_size, indices, use_numpy=True):
+        code = ErasureCode(k, symbol_size, use_numpy=use_numpy)
+        source = self.make_source(k, symbol_size)
+        symbols = dict(zip(indices, code.encode(source, indices)))
+        self.assertEqual(code.decode(symbols), source)
+
+    def test_source_symbols_only(self):
+        self.round_trip(8, 16, list(range(8)))
+
+    def test_repair_symbols_only(self):
+        self.round_trip(8, 16, list(range(8, 16)))
+
+    def test_any_k_symbols(self):
+        rng = random.Random(1)
+        for k in (1, 2, 7, 32, 128):
+            indices = rng.sample(range(MAX_SYMBOLS), k)
+            self.round_trip(k, 24, indices)
+
+    def test_largest_generation(self):
+        k = MAX_SYMBOLS - 1
+        self.round_trip(k, 4, [0] + list(range(2, MAX_SYMBOLS)))
+
+    def test_pure_python(self):
+        rng = random.Random(2)
+        self.round_trip(16, 32, rng.sample(range(MAX_SYMBOLS), 16), use_numpy=False)
+
+    @unittest.skipIf(erasurecode.numpy is None, "NumPy isn't installed")
+    def test_numpy_matches_pure_python(self):
+        source = self.make_source(10, 20)
+        indices = list(range(10, 30))
+        self.assertEqual(ErasureCode(10, 20).encode(source, indices),
+                         ErasureCode(10, 20, use_numpy=False).encode(source, indices))
+
+    def test_too_few_symbols(self):
+        code = ErasureCode(4, 8)
+        source = self.make_source(4, 8)
+        symbols = dict(zip([0, 5, 6], code.encode(source, [0, 5, 6])))
+        self.assertRaises(ValueError, code.decode, symbols)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, ErasureCode, 0, 8)
+        self.assertRaises(ValueError, ErasureCode, MAX_SYMBOLS, 8)
+        code = ErasureCode(4, 8)
+        source = self.make_source(4, 8)
+        self.assertRaises(ValueError, code.encode, source[:3], [0])
+        self.assertRaises(ValueError, code.encode, source, [MAX_SYMBOLS])
+
+
+if __name__ == '__main__':
+    unittest.main()
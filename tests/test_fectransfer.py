@@ -0,0 +1,104 @@
+'''
+FecTransfer over the channel simulator.
+
+A generation larger than half the 256 symbol indices runs out of repair symbols within a round, and the sender must
+stop there rather than wrap around and send the same symbols twice.  A receiver that first hears the tail of an
+earlier transfer must give it up for the next transfer's metadata, and not write any of the old file.
+'''
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from collections import Counter
+from unittest import mock
+
+from acomms.channelsimulator import ChannelSimulator
+from acomms.fectransfer import FecTransfer, HEADER, METADATA, CONTROL_GENERATION, METADATA_INDEX
+from acomms.messageparams import DataFrame, Rates
+from acomms.unifiedlog import UnifiedLog
+
+
+class FecTransferTest(unittest.TestCase):
+
+    def setUp(self):
+        log_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_path)
+        self.unified_log = UnifiedLog(log_path=log_path, rootname='test_fectransfer')
+        self.addCleanup(self.unified_log._log.removeHandler, self.unified_log._file_handler)
+        self.addCleanup(self.unified_log._file_handler.close)
+        self.sim = ChannelSimulator(unified_log=self.unified_log, seed=4)
+        self.sender = self.sim.add_node(1, (0, 0, 10))
+        self.receiver = self.sim.add_node(2, (1000, 0, 10))
+
+    def transfers(self, **kwargs):
+        rx = FecTransfer(self.receiver.modem, 1, unified_log=self.unified_log, **kwargs)
+        tx = FecTransfer(self.sender.modem, 2, unified_log=self.unified_log, **kwargs)
+        return rx, tx
+
+    def test_large_generation_sends_each_symbol_once(self):
+        rx, tx = self.transfers(rate=5, generation_size=220, redundancy=0.5)
+        data = os.urandom(70000)
+        received = io.BytesIO()
+        done = rx.listen(received)
+
+        # (generation, index) of every data frame the sender queues.
+        sent = []
+        send_frames = tx._send_frames
+
+        def record(payloads):
+            for payload in payloads:
+                transfer_id, gen, index = HEADER.unpack_from(payload)
+                if gen != CONTROL_GENERATION:
+                    sent.append((gen, index))
+            return send_frames(payloads)
+        tx._send_frames = record
+
+        self.assertTrue(tx.send(io.BytesIO(data)))
+        self.sim.run_for(60)
+        rx.stop_listening()
+        self.assertTrue(done.result())
+        self.assertEqual(received.getvalue(), data)
+
+        # Two generations: 220 source and 36 repair symbols in the first, and the rest of the file, 58 source and 29
+        # repair symbols, in the second.
+        self.assertEqual([count for count in Counter(sent).values() if count > 1], [])
+        self.assertEqual(Counter(gen for gen, index in sent), {0: 256, 1: 87})
+        self.assertEqual(max(index for gen, index in sent), 255)
+
+    def test_newer_transfer_replaces_stale_one(self):
+        rx, tx = self.transfers(rate=1)
+        received = io.BytesIO()
+        done = rx.listen(received)
+
+        # The end of an earlier two generation transfer, whose sender is still repeating itself: its metadata and the
+        # first generation, which the receiver decodes and writes.  The second generation never comes.
+        symbol_size = Rates[1].framesize - HEADER.size
+        old = os.urandom(2 * symbol_size)
+        payloads = [HEADER.pack(0x01, CONTROL_GENERATION, METADATA_INDEX) +
+                    METADATA.pack(symbol_size, 1, len(old), zlib.crc32(old) & 0xffffffff),
+                    HEADER.pack(0x01, 0, 0) + old[:symbol_size]]
+        frames = [DataFrame(1, 2, False, num, payload) for num, payload in enumerate(payloads, 1)]
+        self.sender.modem.send_packet_frames(2, 1, frames)
+        self.sim.run_for(30)
+        self.assertEqual(received.getvalue(), old[:symbol_size])
+
+        data = os.urandom(1000)
+        with mock.patch('acomms.fectransfer.os.urandom', return_value=b'\x02'):
+            self.assertTrue(tx.send(io.BytesIO(data)))
+        self.sim.run_for(60)
+        rx.stop_listening()
+        self.assertTrue(done.result())
+        self.assertEqual(received.getvalue(), data)
+        self.assertEqual((rx._rx.transfer_id, rx._rx.restarts), (0x02, 1))
+
+        # The old transfer's frames no longer count.
+        self.sender.modem.send_packet_frames(2, 1, frames)
+        self.sim.run_for(30)
+        self.assertEqual(received.getvalue(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+'''
+Known-answer checks for acomms.nmeachecksum.
+
+The expected values were worked out once, outside the module: the XOR checksums by hand-rolled byte XOR, and the
+32-bit ones with the lookup table from the old micromodem.nmeaChecksum32.  The CACST body is long enough to take the
+folded-integer XOR path.  The rest checks that validate and validate_many accept exactly the lines they should.
+'''
+
+import unittest
+
+from acomms import nmeachecksum
+
+
+# (body, XOR checksum, 32-bit checksum)
+VECTORS = [
+    ("", "00", "00000000"),
+    ("CCCFQ,ALL", "39", "A362DCB8"),
+    ("CCCYC,0,1,2,0,0,1", "5B", "41F98B51"),
+    ("CAMPR,2,1,1.2345", "7D", "D102B6DE"),
+    ("CAREV,000042,AUV,0.93.0.52", "08", "84F07E02"),
+    ("CCTXD,1,2,0,48656C6C6F20776F726C64", "04", "A82434E3"),
+    ("CARXD,2,1,0,1,48656C6C6F20776F726C64", "1D", "5D88C839"),
+    ("CACST,6,0,20120125120000.123456,1,250,30,10,200,-10,0,0,0,0,1,0,1,0,2,3,0,50,10.5,12.1,9.5,-15.2,200,0.1,100,"
+     "25000,5000", "4C", "8083B78F"),
+]
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def test_xor(self):
+        for body, xor, crc in VECTORS:
+            self.assertEqual(nmeachecksum.nmea_checksum(body), xor, body)
+            self.assertEqual(nmeachecksum.xor_checksum(body), int(xor, 16), body)
+
+    def test_crc32(self):
+        for body, xor, crc in VECTORS:
+            self.assertEqual(nmeachecksum.nmea_checksum32(body), crc, body)
+            self.assertEqual(nmeachecksum.crc32_checksum(body), int(crc, 16), body)
+
+    def test_input_types(self):
+        for body, xor, crc in VECTORS:
+            raw = body.encode('iso-8859-1')
+            for data in (raw, bytearray(raw), memoryview(raw)):
+                self.assertEqual(nmeachecksum.nmea_checksum(data), xor)
+                self.assertEqual(nmeachecksum.nmea_checksum32(data), crc)
+
+    def test_every_length_around_fold_threshold(self):
+        body = VECTORS[-1][0].encode()
+        for length in range(len(body)):
+            expected = 0
+            for byte in body[:length]:
+                expected ^= byte
+            self.assertEqual(nmeachecksum.xor_checksum(body[:length]), expected, length)
+
+
+class ValidateTest(unittest.TestCase):
+
+    def test_split_sentence(self):
+        body, checksum = nmeachecksum.split_sentence(b"$CCCFQ,ALL*39\r\n")
+        self.assertEqual((bytes(body), checksum), (b"CCCFQ,ALL", "39"))
+        body, checksum = nmeachecksum.split_sentence("$CATXF,1\r\n")
+        self.assertEqual((bytes(body), checksum), (b"CATXF,1", None))
+
+    def test_validate_many(self):
+        lines = ["${0}*{1}\r\n".format(body, xor) for body, xor, crc in VECTORS]
+        lines += ["${0}*{1}\r\n".format(body, crc) for body, xor, crc in VECTORS]
+        lines = [line.encode() for line in lines[:4]] + lines[4:]
+        self.assertEqual(nmeachecksum.validate_many(lines), [True] * len(lines))
+
+    def test_validate_many_rejects(self):
+        lines = [
+            "$CCCFQ,ALL*38\r\n",            # wrong XOR checksum
+            "$CCCFQ,ALL*A362DCB9\r\n",      # wrong 32-bit checksum
+            "$CCCFQ,ALX*39\r\n",            # corrupted body
+            "$CCCFQ,ALL*039\r\n",           # neither length
+            "$CCCFQ,ALL*39",                # no line ending is fine
+            "$CCCFQ,ALL*a362dcb8",          # lower case hex is fine
+            "$CATXF,1\r\n",                 # no checksum
+        ]
+        self.assertEqual(nmeachecksum.validate_many(lines), [False, False, False, False, True, True, True])
+        self.assertEqual(nmeachecksum.validate_many(lines[-1:], require_checksum=True), [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+'''
+PacketAssembler, driven by the sentences a Micromodem prints while it receives a packet.
+
+The sentences go in through Micromodem._process_incoming_nmea, so they are parsed and reach the commstate machine too,
+as they would from a connection.  A packet must come out once, when its CACST arrives, with a frame map that marks
+BAD_CRC and missing frames.  The extra CACST that an FSK cycle init produces must not end the packet early, and a
+packet whose CACST never comes is still delivered, incomplete, when the next CACYC, a PACKET_TIMEOUT or the assembler's
+timer ends it.
+'''
+
+import unittest
+
+from acomms.clock import VirtualClock
+from acomms.micromodem import Micromodem
+from acomms.nmeachecksum import nmea_checksum
+
+
+class PacketAssemblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.modem = Micromodem(name='assembler', clock=self.clock)
+        self.modem.id = 2
+        self.packets = []
+        self.modem.on_packet = self.packets.append
+
+    def feed(self, *bodies):
+        for body in bodies:
+            self.modem._process_incoming_nmea("${0}*{1}\r\n".format(body, nmea_checksum(body)))
+
+    @staticmethod
+    def cycle(rate, num_frames, src=1, dest=2):
+        return "CACYC,0,{0},{1},{2},0,{3}".format(src, dest, rate, num_frames)
+
+    @staticmethod
+    def frame(frame_num, data, src=1, dest=2):
+        return "CARXD,{0},{1},0,{2},{3}".format(src, dest, frame_num, data.hex().upper())
+
+    @staticmethod
+    def cst(rate, num_frames, bad_frames=0, snr=15.0, src=1, dest=2):
+        return ("CACST,6,0,20240501120000.000000,3,250,30,10,200,0,0,0,0,0,{rate},{src},{dest},0,2,{num_frames},"
+                "{bad_frames},165,{snr:.2f},20.00,18.00,-15.00,200,0.00,100,25000,5000").format(
+            rate=rate, src=src, dest=dest, num_frames=num_frames, bad_frames=bad_frames, snr=snr)
+
+    def test_packet_is_delivered_on_its_cst(self):
+        self.feed("CARXP,1", self.cycle(1, 3))
+        self.feed(self.frame(1, b'first'), self.frame(2, b'second'), self.frame(3, b'third'))
+        self.assertEqual(self.packets, [])
+
+        self.feed(self.cst(1, 3))
+        self.assertEqual(len(self.packets), 1)
+        packet = self.packets[0]
+        self.assertTrue(packet.ok)
+        self.assertEqual((packet.src, packet.dest, packet.rate_num, packet.num_frames), (1, 2, 1, 3))
+        self.assertEqual(packet.data, b'firstsecondthird')
+        self.assertEqual(packet.cst['num_frames'], 3)
+
+        # Nothing else comes out of the same cycle.
+        self.clock.run_for(60)
+        self.assertEqual(len(self.packets), 1)
+
+    def test_bad_crc_frame_map(self):
+        self.feed("CARXP,1", self.cycle(1, 3))
+        self.feed(self.frame(1, b'first'), "CAMSG,BAD_CRC,2", self.frame(3, b'third'), self.cst(1, 3, bad_frames=1))
+
+        packet, = self.packets
+        self.assertTrue(packet.complete)
+        self.assertFalse(packet.ok)
+        self.assertEqual(packet.frame_map, {1: True, 2: False, 3: True})
+        self.assertEqual(packet.bad_frame_nums, [2])
+        self.assertEqual([frame.frame_num for frame in packet.good_frames], [1, 3])
+        self.assertEqual(packet.data, b'firstthird')
+
+    def test_bad_crc_without_frame_number(self):
+        self.feed("CARXP,1", self.cycle(1, 2))
+        self.feed(self.frame(1, b'first'), "CAMSG,BAD_CRC", self.cst(1, 2, bad_frames=1))
+        self.assertEqual(self.packets[0].frame_map, {1: True, 2: False})
+
+    def test_fsk_cycle_init_cst_is_skipped(self):
+        # On FSK the cycle init minipacket gets a CACST of its own, with a good frame that never shows up as a CARXD.
+        self.feed("CARXP,0", self.cycle(0, 1), self.cst(0, 1, snr=5.0))
+        self.assertEqual(self.packets, [])
+
+        self.feed(self.frame(1, b'fsk data'), self.cst(0, 1, snr=12.0))
+        packet, = self.packets
+        self.assertTrue(packet.ok)
+        self.assertEqual(packet.data, b'fsk data')
+        self.assertEqual(packet.cst['snr_in'], 12.0)
+
+    def test_cst_for_all_bad_frames_ends_packet(self):
+        self.feed("CARXP,1", self.cycle(1, 2), "CAMSG,BAD_CRC,1", "CAMSG,BAD_CRC,2", self.cst(1, 2, bad_frames=2))
+        packet, = self.packets
+        self.assertTrue(packet.complete)
+        self.assertEqual(packet.frame_map, {1: False, 2: False})
+
+    def test_timeout_without_cst(self):
+        timeout = self.modem.packet_assembler.cst_timeout
+        self.feed("CARXP,1", self.cycle(1, 3), self.frame(1, b'first'))
+        self.clock.run_for(timeout - 0.1)
+        self.assertEqual(self.packets, [])
+
+        self.clock.run_for(0.2)
+        packet, = self.packets
+        self.assertFalse(packet.complete)
+        self.assertIsNone(packet.cst)
+        self.assertEqual(packet.frame_map, {1: True, 2: False, 3: False})
+        self.assertEqual(self.modem.packet_assembler.incomplete, 1)
+
+    def test_timeout_before_first_frame_allows_for_airtime(self):
+        # Until the first frame arrives, the timer also allows for the time the packet takes on the air.
+        self.feed("CARXP,1", self.cycle(1, 3))
+        self.clock.run_for(self.modem.packet_assembler.cst_timeout + 1)
+        self.assertEqual(self.packets, [])
+        self.clock.run_for(60)
+        self.assertEqual(len(self.packets), 1)
+        self.assertFalse(self.packets[0].complete)
+
+    def test_next_cycle_ends_packet(self):
+        self.feed("CARXP,1", self.cycle(1, 3), self.frame(1, b'cut'))
+        self.feed("CARXP,1", self.cycle(1, 1, src=3), self.frame(1, b'next', src=3), self.cst(1, 1, src=3))
+
+        first, second = self.packets
+        self.assertEqual((first.src, first.complete, first.data), (1, False, b'cut'))
+        self.assertEqual((second.src, second.ok, second.data), (3, True, b'next'))
+
+    def test_packet_timeout_message_ends_packet(self):
+        self.feed("CARXP,1", self.cycle(1, 2), self.frame(1, b'half'), "CAMSG,PACKET_TIMEOUT")
+        packet, = self.packets
+        self.assertFalse(packet.complete)
+        self.assertEqual(packet.frame_map, {1: True, 2: False})
+
+    def test_own_cycle_is_not_a_packet(self):
+        self.feed(self.cycle(1, 2, src=2, dest=1))
+        self.clock.run_for(60)
+        self.assertEqual(self.packets, [])
+
+    def test_frames_for_another_link_are_ignored(self):
+        self.feed("CARXP,1", self.cycle(1, 1), self.frame(1, b'stray', src=4), self.frame(1, b'mine'),
+                  self.cst(1, 1))
+        self.assertEqual(self.packets[0].data, b'mine')
+
+
+if __name__ == '__main__':
+    unittest.main()
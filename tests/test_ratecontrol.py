@@ -0,0 +1,105 @@
+'''
+RateController, fed the CACSTs a Micromodem reports for packets it hears from node 1.
+
+The choice has to follow the link: the default rate while nothing is known, the fastest rate on a good link and a
+robust one on a poor link.  A small gain isn't worth moving away from the last rate chosen, packets the modem couldn't
+demodulate at all (a PSK error) count against their rate whatever the SNR says, and estimates older than max_age are
+dropped.
+'''
+
+import unittest
+
+from acomms.clock import VirtualClock
+from acomms.messageparams import DataFrame
+from acomms.micromodem import Micromodem
+from acomms.nmeachecksum import nmea_checksum
+from acomms.ratecontrol import RateController
+
+
+class RateControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.modem = Micromodem(name='ratecontrol', clock=self.clock)
+        self.modem.id = 2
+        self.controller = self.modem.rate_controller
+
+    def feed(self, rate, num_frames=3, bad_frames=0, snr=15.0, psk_error=0, src=1, dest=2):
+        body = ("CACST,6,0,20240501120000.000000,3,250,30,10,200,0,0,0,0,0,{rate},{src},{dest},{psk_error},2,"
+                "{num_frames},{bad_frames},165,{snr:.2f},20.00,18.00,-15.00,200,0.00,100,25000,5000").format(
+            rate=rate, src=src, dest=dest, psk_error=psk_error, num_frames=num_frames, bad_frames=bad_frames, snr=snr)
+        self.modem._process_incoming_nmea("${0}*{1}\r\n".format(body, nmea_checksum(body)))
+
+    def test_default_rate_without_link(self):
+        self.assertIsNone(self.controller.link(1))
+        self.assertEqual(self.controller.select_rate(1), 1)
+        self.assertEqual(RateController(self.modem, default_rate=3).select_rate(1), 3)
+
+    def test_select_rate_follows_snr(self):
+        self.feed(1, snr=20.0)
+        self.assertEqual(self.controller.select_rate(1), 5)
+        self.assertEqual(self.controller.select_rate(1, candidates=[0, 1, 2]), 2)
+
+        controller = RateController(self.modem)
+        self.modem.cst_listeners.append(controller.on_cst)
+        self.feed(1, snr=-4.0, src=3)
+        self.assertEqual(controller.select_rate(3), 2)
+
+    def test_select_rate_for_frames(self):
+        self.feed(1, snr=3.0)
+        self.assertEqual(self.controller.select_rate(1), 3)
+        frames = [DataFrame(2, 1, False, num, b'x' * 100) for num in range(1, 4)]
+        # 100 byte frames need one of the 256 byte frame rates (3, 4 and 5), and only rate 5 takes three of them.
+        self.assertEqual(self.controller.select_rate_for_frames(1, frames[:1]), 3)
+        self.assertEqual(self.controller.select_rate_for_frames(1, frames), 5)
+        # Nothing takes a 300 byte frame.
+        self.assertEqual(self.controller.select_rate_for_frames(1, [DataFrame(2, 1, False, 1, b'x' * 300)]), 1)
+
+    def test_hysteresis(self):
+        sticky = self.controller
+        eager = RateController(self.modem, hysteresis=0.0)
+        self.modem.cst_listeners.append(eager.on_cst)
+
+        # At 3 dB rate 3 is best, at 4 dB rate 4 is, but only by a few percent.
+        self.feed(1, snr=3.0)
+        self.assertEqual((sticky.select_rate(1), eager.select_rate(1)), (3, 3))
+        self.feed(1, snr=3.0 + 1.0 / sticky.alpha)
+        self.assertAlmostEqual(sticky.link(1).snr_in, 4.0, places=2)
+        link = sticky.link(1)
+        self.assertLess(sticky.goodput(link, 4), sticky.goodput(link, 3) * (1 + sticky.hysteresis))
+        self.assertEqual((sticky.select_rate(1), eager.select_rate(1)), (3, 4))
+
+        # A clear gain moves it.
+        self.feed(1, snr=30.0)
+        self.assertEqual(sticky.select_rate(1), 5)
+
+    def test_psk_errors_count_against_their_rate(self):
+        self.feed(1, snr=15.0)
+        self.assertEqual(self.controller.select_rate(1), 5)
+        for i in range(3):
+            # The SNR still looks good, but nothing at rate 5 gets through.
+            self.feed(5, num_frames=0, snr=15.0, psk_error=1)
+        link = self.controller.link(1)
+        self.assertEqual(link.psk_errors, 3)
+        self.assertEqual(link.frame_success(5)[0], 0.0)
+        self.assertEqual(self.controller.select_rate(1), 4)
+
+    def test_estimates_expire_after_max_age(self):
+        max_age = self.controller.max_age
+        self.feed(1, snr=20.0)
+        self.clock.run_for(max_age / 2)
+        # An overheard packet from node 1 to node 3 says the link has got worse, but our own estimate comes first.
+        self.feed(1, snr=-4.0, dest=3)
+        self.assertEqual(self.controller.select_rate(1), 5)
+
+        # Once ours is too old, the overheard one is all there is, and then nothing.
+        self.clock.run_for(max_age / 2 + 1)
+        self.assertEqual(self.controller.link(1).dest, 3)
+        self.assertEqual(self.controller.select_rate(1, candidates=[1, 2, 5]), 2)
+        self.clock.run_for(max_age / 2)
+        self.assertIsNone(self.controller.link(1))
+        self.assertEqual(self.controller.select_rate(1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+'''
+Segmenter and Reassembler.  Messages split into frames have to come back byte for byte whatever the frame size,
+however the frames are reordered or repeated on the way, and without frames from different sources getting mixed up.
+The segment header and varint encodings are checked on their own first, including the padding and truncation rules
+that decode_segments relies on.
+'''
+
+import os
+import random
+import unittest
+
+from acomms.segmentation import (encode_varint, decode_varint, encode_segment, decode_segments, Segmenter,
+                                 Reassembler, MessageCollector)
+
+
+class HeaderTest(unittest.TestCase):
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 16383, 16384, 2 ** 32):
+            encoded = encode_varint(value)
+            self.assertEqual(decode_varint(encoded, 0), (value, len(encoded)))
+        self.assertRaises(IndexError, decode_varint, encode_varint(300)[:1], 0)
+
+    def test_segments(self):
+        frame = encode_segment(7, 3, True, b'abc') + encode_segment(8, 0, False, b'defg')
+        self.assertEqual(list(decode_segments(frame)), [(7, 3, True, b'abc'), (8, 0, False, b'defg')])
+
+    def test_zero_padding_ends_frame(self):
+        frame = encode_segment(1, 0, True, b'xyz') + bytes(10)
+        self.assertEqual(list(decode_segments(frame)), [(1, 0, True, b'xyz')])
+
+    def test_truncated_segment_is_dropped(self):
+        frame = encode_segment(1, 0, True, b'xyz') + encode_segment(2, 0, True, b'0123456789')[:-3]
+        self.assertEqual(list(decode_segments(frame)), [(1, 0, True, b'xyz')])
+
+
+class ReassemblyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = []
+        self.reassembler = self.make_reassembler()
+
+    def make_reassembler(self):
+        return Reassembler(MessageCollector(lambda src, msg_id, payload: self.messages.append((src, msg_id, payload))))
+
+    def split(self, payloads, framesize):
+        segmenter = Segmenter(framesize)
+        ids = [segmenter.add(payload) for payload in payloads]
+        segmenter.flush()
+        return ids, list(segmenter.frames)
+
+    def test_frame_sizes(self):
+        rng = random.Random(1)
+        for framesize in (8, 32, 64, 256):
+            del self.messages[:]
+            reassembler = self.make_reassembler()
+            payloads = [os.urandom(rng.choice((0, 1, 5, framesize - 1, framesize, 3 * framesize + 7)))
+                        for _ in range(20)]
+            ids, frames = self.split(payloads, framesize)
+            self.assertTrue(all(len(frame) <= framesize for frame in frames))
+            for frame in frames:
+                reassembler.feed(1, frame)
+            self.assertEqual(self.messages, [(1, msg_id, payload) for msg_id, payload in zip(ids, payloads)])
+            self.assertEqual(reassembler.completed, len(payloads))
+
+    def test_small_messages_share_frames(self):
+        ids, frames = self.split([b'a' * 10] * 4, 64)
+        self.assertEqual(len(frames), 1)
+
+    def test_out_of_order_and_duplicate_frames(self):
+        payloads = [os.urandom(n) for n in (100, 3, 250, 64)]
+        ids, frames = self.split(payloads, 32)
+        shuffled = frames + frames[:5]
+        random.Random(2).shuffle(shuffled)
+        for frame in shuffled:
+            self.reassembler.feed(1, frame)
+        self.assertEqual(sorted(self.messages), sorted((1, msg_id, payload) for msg_id, payload in zip(ids, payloads)))
+        self.assertGreater(self.reassembler.duplicates, 0)
+
+    def test_streaming_delivers_data_in_order(self):
+        payload = os.urandom(500)
+        ids, frames = self.split([payload], 40)
+        pieces = []
+        reassembler = Reassembler(lambda src, msg_id, data, last: pieces.append((data, last)))
+        for frame in reversed(frames):
+            reassembler.feed(1, frame)
+        self.assertEqual(b''.join(data for data, last in pieces), payload)
+        self.assertEqual([last for data, last in pieces], [False] * (len(pieces) - 1) + [True])
+
+    def test_sources_are_kept_apart(self):
+        ids, frames_a = self.split([b'from one' * 20], 32)
+        ids, frames_b = self.split([b'from two' * 20], 32)
+        for frame_a, frame_b in zip(frames_a, frames_b):
+            self.reassembler.feed(1, frame_a)
+            self.reassembler.feed(2, frame_b)
+        self.assertEqual(sorted((src, payload) for src, msg_id, payload in self.messages),
+                         [(1, b'from one' * 20), (2, b'from two' * 20)])
+
+    def test_restarted_sender_reuses_message_ids(self):
+        # A sender that restarts numbers its messages from 0 again, while the first run's ids are still remembered.
+        before = Segmenter(32, session=1)
+        for payload in (b'one' * 20, b'two' * 20):
+            before.add(payload)
+        before.flush()
+        after = Segmenter(32, session=2)
+        for payload in (b'three' * 20, b'four' * 20):
+            after.add(payload)
+        after.flush()
+
+        for frame in list(before.frames) + list(after.frames):
+            self.reassembler.feed(1, frame)
+        self.assertEqual(self.messages, [(1, 0, b'one' * 20), (1, 1, b'two' * 20),
+                                         (1, 0, b'three' * 20), (1, 1, b'four' * 20)])
+        self.assertEqual((self.reassembler.duplicates, self.reassembler.restarts), (0, 1))
+
+    def test_restart_abandons_partial_message(self):
+        before = Segmenter(32, session=1)
+        before.add(b'cut short' * 20)
+        after = Segmenter(32, session=2)
+        after.add(b'whole' * 20)
+        after.flush()
+
+        self.reassembler.feed(1, before.frames[0])
+        for frame in after.frames:
+            self.reassembler.feed(1, frame)
+        self.assertEqual(self.messages, [(1, 0, b'whole' * 20)])
+        self.assertEqual(self.reassembler.abandoned, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
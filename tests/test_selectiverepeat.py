@@ -0,0 +1,110 @@
+'''
+SelectiveRepeatTransfer over the channel simulator, with frame losses forced at the receiving modem.
+
+The nodes are close enough that the channel itself loses nothing, so the only losses are the scripted ones.  Each test
+records the sequence numbers in every packet the sender hands to its modem, and checks that exactly the frames that
+weren't acknowledged were sent again, ahead of new ones, and that the file arrived intact.
+'''
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from acomms.channelsimulator import ChannelSimulator
+from acomms.selectiverepeat import SelectiveRepeatTransfer, HEADER
+from acomms.unifiedlog import UnifiedLog
+
+
+class SelectiveRepeatTest(unittest.TestCase):
+
+    def setUp(self):
+        log_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_path)
+        unified_log = UnifiedLog(log_path=log_path, rootname='test_selectiverepeat')
+        self.addCleanup(unified_log._log.removeHandler, unified_log._file_handler)
+        self.addCleanup(unified_log._file_handler.close)
+        self.sim = ChannelSimulator(unified_log=unified_log, seed=1)
+        self.sender = self.sim.add_node(1, (0, 0, 10))
+        self.receiver = self.sim.add_node(2, (1000, 0, 10))
+
+        # Sequence numbers in each packet the sender queues.
+        self.sent = []
+        send_packet = self.sender.modem.send_packet
+
+        def record(packet, *args, **kwargs):
+            self.sent.append([HEADER.unpack_from(bytes(frame.data))[1] for frame in packet.frames])
+            return send_packet(packet, *args, **kwargs)
+        self.sender.modem.send_packet = record
+
+        # Frame numbers to lose in each data packet the receiver hears, in order.
+        self.losses = []
+        hear = self.receiver.core.hear
+
+        def lossy_hear(kind, args, bad_frames=(), snr=15.0):
+            if kind == 'data':
+                bad_frames = set(bad_frames) | set(self.losses.pop(0) if self.losses else ())
+            return hear(kind, args, bad_frames, snr)
+        self.receiver.core.hear = lossy_hear
+
+    def transfer(self, data, rate=1, retry=16):
+        received = io.BytesIO()
+        rx = SelectiveRepeatTransfer(self.receiver.modem, 1, rate=rate, unified_log=self.sim.unified_log)
+        done = rx.listen(received)
+        tx = SelectiveRepeatTransfer(self.sender.modem, 2, rate=rate, ack_timeout=5.0,
+                                     unified_log=self.sim.unified_log)
+        ok = tx.send(io.BytesIO(data), retry=retry, timeout=3600)
+        self.sim.run_for(30)
+        rx.stop_listening()
+        return ok, tx.stats, done, received.getvalue()
+
+    def test_clean_link(self):
+        # 8 data frames of 61 bytes, plus the metadata frame.
+        data = os.urandom(8 * 61)
+        ok, stats, done, received = self.transfer(data)
+        self.assertTrue(ok)
+        self.assertEqual(self.sent, [[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+        self.assertEqual(stats['retransmissions'], 0)
+        self.assertTrue(done.result())
+        self.assertEqual(received, data)
+
+    def test_only_lost_frames_are_resent(self):
+        data = os.urandom(8 * 61)
+        # Lose seq 1 in the first packet, then seq 1 again and seq 4 in the second.
+        self.losses = [{2}, {1, 3}]
+        ok, stats, done, received = self.transfer(data)
+        self.assertTrue(ok)
+        self.assertEqual(self.sent, [[0, 1, 2], [1, 3, 4], [1, 4, 5], [6, 7, 8]])
+        self.assertEqual(stats['retransmissions'], 3)
+        self.assertTrue(done.result())
+        self.assertEqual(received, data)
+
+    def test_lost_packet_is_resent_whole(self):
+        data = os.urandom(5 * 61)
+        self.losses = [{1, 2, 3}]
+        ok, stats, done, received = self.transfer(data)
+        self.assertTrue(ok)
+        self.assertEqual(self.sent, [[0, 1, 2], [0, 1, 2], [3, 4, 5]])
+        self.assertEqual(received, data)
+
+    def test_gives_up_after_retry_limit(self):
+        data = os.urandom(2 * 61)
+        self.losses = [{2}] + [{1}] * 10
+        ok, stats, done, received = self.transfer(data, retry=2)
+        self.assertFalse(ok)
+        self.assertEqual(self.sent, [[0, 1, 2], [1], [1]])
+        self.assertFalse(done.done())
+
+    def test_fsk(self):
+        # One 32 byte frame per packet at rate 0.
+        data = os.urandom(3 * 29)
+        self.losses = [(), {1}]
+        ok, stats, done, received = self.transfer(data, rate=0)
+        self.assertTrue(ok)
+        self.assertEqual(self.sent, [[0], [1], [1], [2], [3]])
+        self.assertEqual(received, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+'''
+TransferJournal has to survive what an interrupted transfer does to it: being reopened by the same, a different or
+an unspecified session, a record cut short by a crash, and enough small records to need compacting.  The RangeSet it
+keeps the delivered ranges in is checked on its own first.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from acomms.transferjournal import RangeSet, TransferJournal, HEADER, RECORD
+
+
+class RangeSetTest(unittest.TestCase):
+
+    def test_merges_overlapping_and_touching_ranges(self):
+        ranges = RangeSet([(10, 20), (30, 40), (20, 25), (35, 50), (0, 5)])
+        self.assertEqual(list(ranges), [(0, 5), (10, 25), (30, 50)])
+        self.assertEqual(ranges.total, 40)
+
+    def test_bridging_range(self):
+        ranges = RangeSet([(0, 10), (20, 30), (40, 50)])
+        ranges.add(5, 45)
+        self.assertEqual(list(ranges), [(0, 50)])
+
+    def test_empty_range_is_ignored(self):
+        ranges = RangeSet([(5, 5), (7, 3)])
+        self.assertEqual(len(ranges), 0)
+
+    def test_contains_prefix_and_missing(self):
+        ranges = RangeSet([(0, 10), (20, 30)])
+        self.assertIn(0, ranges)
+        self.assertIn(9, ranges)
+        self.assertNotIn(10, ranges)
+        self.assertEqual(ranges.prefix(), 10)
+        self.assertEqual(ranges.missing(40), [(10, 20), (30, 40)])
+        self.assertEqual(RangeSet([(5, 10)]).prefix(), 0)
+
+
+class TransferJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'file.acj')
+        self.session_id = uuid.uuid4().hex
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, session_id=None, size=1000, **kwargs):
+        return TransferJournal(self.path, session_id=session_id or self.session_id, size=size, **kwargs)
+
+    def test_round_trip(self):
+        journal = self.open()
+        journal.append(0, 100)
+        journal.append(200, 300)
+        journal.append(100, 150)
+        journal.close()
+
+        journal = self.open()
+        self.assertEqual(journal.session_id, self.session_id)
+        self.assertEqual(list(journal.ranges), [(0, 150), (200, 300)])
+        self.assertEqual(journal.committed, 150)
+        journal.close()
+
+    def test_other_session_starts_over(self):
+        journal = self.open()
+        journal.append(0, 100)
+        journal.close()
+
+        journal = self.open(session_id=uuid.uuid4().hex)
+        self.assertEqual(journal.committed, 0)
+        journal.close()
+        journal = self.open(size=2000)
+        self.assertEqual(journal.committed, 0)
+        journal.close()
+
+    def test_any_session(self):
+        journal = self.open()
+        journal.append(0, 100)
+        journal.close()
+
+        journal = TransferJournal(self.path)
+        self.assertEqual(journal.session_id, self.session_id)
+        self.assertEqual(journal.committed, 100)
+        journal.close()
+
+    def test_torn_record_is_dropped(self):
+        journal = self.open()
+        journal.append(0, 100)
+        journal.append(100, 200)
+        journal.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(HEADER.size + RECORD.size + 5)
+
+        journal = self.open()
+        self.assertEqual(journal.committed, 100)
+        journal.append(100, 300)
+        journal.close()
+        self.assertEqual(self.open().committed, 300)
+
+    def test_compaction(self):
+        journal = self.open(size=10000)
+        for start in range(0, 5000, 10):
+            journal.append(start, start + 10)
+        journal.close()
+
+        journal = self.open(size=10000)
+        self.assertEqual(journal.committed, 5000)
+        journal.close()
+        self.assertEqual(os.path.getsize(self.path), HEADER.size + RECORD.size)
+
+    def test_before_sync_and_batching(self):
+        syncs = []
+        journal = self.open(sync_every=4, sync_interval=1e9, before_sync=lambda: syncs.append(True))
+        for start in range(0, 70, 10):
+            journal.append(start, start + 10)
+        self.assertEqual(len(syncs), 1)
+        journal.close()
+        self.assertEqual(len(syncs), 2)
+
+    def test_discard(self):
+        journal = self.open()
+        journal.append(0, 100)
+        journal.discard()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_garbage_file_starts_over(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a journal at all, but long enough')
+        journal = self.open()
+        self.assertEqual(journal.committed, 0)
+        self.assertEqual(journal.session_id, self.session_id)
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+acomms_ymodem between two Micromodems on simulated modems.
+
+Both ends of a ymodem transfer block, so unlike the other transfer tests this one can't run on the channel
+simulator's virtual clock: the simulated modems sit on pseudo-terminals and run in real time, with short latencies.
+The sender runs in a thread and the receiver on the test's own.  A transfer has to arrive intact, recv has to return
+the size of the file (after decompression, if it was compressed), and a resumable transfer that was cut off has to
+carry on from the receiver's journal instead of starting again.
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import pty
+except ImportError:
+    pty = None
+
+from acomms.acomms_xmodem import acomms_ymodem
+from acomms.compression import ZlibCodec
+from acomms.micromodem import Micromodem
+from acomms.modem_connections import IoHub
+from acomms.unifiedlog import UnifiedLog
+
+if pty is not None:
+    from acomms.simulatedmodem import PtySimulatedModem
+
+
+@unittest.skipIf(pty is None, "Needs pseudo-terminals")
+class YmodemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.src = os.path.join(self.directory, 'src')
+        self.dst = os.path.join(self.directory, 'dst')
+        os.makedirs(self.src)
+        os.makedirs(self.dst)
+        self.unified_log = UnifiedLog(log_path=self.directory, rootname='test_ymodem')
+        self.addCleanup(self.unified_log._log.removeHandler, self.unified_log._file_handler)
+        self.addCleanup(self.unified_log._file_handler.close)
+
+        hub = IoHub(name='test_ymodem')
+        self.addCleanup(hub.stop)
+        latencies = {'transmit': 0.05, 'owtt': 0.01}
+        sims = [PtySimulatedModem(modem_id, hub=hub, latencies=latencies) for modem_id in (1, 2)]
+        sims[0].core.link(sims[1].core)
+        self.modems = []
+        for sim in sims:
+            self.addCleanup(sim.close)
+            modem = Micromodem(name='sim{0}'.format(sim.core.id), unified_log=self.unified_log)
+            modem.connect_serial(sim.port, 19200)
+            self.addCleanup(modem.disconnect)
+            self.modems.append(modem)
+
+        # Once set, the receiving modem hears nothing but bad frames.
+        self.cut = False
+        receiver = sims[1].core
+        hear = receiver.hear
+
+        def cut_hear(kind, args, bad_frames=(), snr=15.0):
+            if kind == 'data' and self.cut:
+                bad_frames = range(1, len(args[4]) + 1)
+            return hear(kind, args, bad_frames, snr)
+        receiver.hear = cut_hear
+
+        # Packets each transfer's sender had acknowledged (the header included).
+        self.acked = []
+
+    def write_file(self, lines):
+        data = b''.join(b"%d,2024-05-01T12:00:00,41.52,-70.67\n" % i for i in range(lines))
+        with open(os.path.join(self.src, 'log.csv'), 'wb') as f:
+            f.write(data)
+        return data
+
+    def transfer(self, cut_after=None, **kwargs):
+        ''' Returns what send and recv returned. '''
+        tx = acomms_ymodem(self.modems[0], 2, 1, timeout=3, unified_log=self.unified_log)
+        rx = acomms_ymodem(self.modems[1], 1, 1, timeout=3, unified_log=self.unified_log)
+        self.acked.append(0)
+
+        def callback(total_packets, success_count, error_count):
+            self.acked[-1] = success_count
+            if success_count == cut_after:
+                self.cut = True
+
+        result = {}
+        resume = kwargs.pop('resume', False)
+        sender = threading.Thread(target=lambda: result.update(
+            sent=tx.send(os.path.join(self.src, 'log.csv'), timeout=15, delay=0.2, callback=callback,
+                         resume=resume, **kwargs)))
+        sender.daemon = True
+        sender.start()
+        received = rx.recv(self.dst, timeout=15, delay=0.2, resume=resume)
+        sender.join(60)
+        self.assertFalse(sender.is_alive())
+        self.cut = False
+        return result['sent'], received
+
+    def received(self):
+        with open(os.path.join(self.dst, 'log.csv'), 'rb') as f:
+            return f.read()
+
+    def test_transfer(self):
+        data = self.write_file(20)
+        self.assertEqual(self.transfer(), (True, len(data)))
+        self.assertEqual(self.received(), data)
+        self.assertEqual(os.listdir(self.dst), ['log.csv'])
+
+    def test_compressed_transfer_returns_file_size(self):
+        data = self.write_file(40)
+        self.assertEqual(self.transfer(compress=ZlibCodec()), (True, len(data)))
+        self.assertEqual(self.received(), data)
+        # The whole file went in one packet after the header.
+        self.assertEqual(self.acked, [2])
+
+    def test_interrupted_transfer_resumes(self):
+        data = self.write_file(30)
+        # The header and two packets of data get through.
+        sent, received = self.transfer(cut_after=3, resume=True)
+        self.assertFalse(sent)
+        self.assertIsNone(received)
+        partial = self.received()
+        self.assertTrue(0 < len(partial) < len(data))
+        self.assertEqual(partial, data[:len(partial)])
+        self.assertEqual(sorted(os.listdir(self.dst)), ['log.csv', 'log.csv.acj'])
+        self.assertTrue(os.path.exists(os.path.join(self.src, 'log.csv.2.acj')))
+
+        self.assertEqual(self.transfer(resume=True), (True, len(data)))
+        self.assertEqual(self.received(), data)
+        self.assertEqual(os.listdir(self.dst), ['log.csv'])
+        self.assertEqual(os.listdir(self.src), ['log.csv'])
+        # The first two packets weren't sent again.
+        packet_size = 3 * 64 - 1
+        full = 1 + (len(data) + packet_size - 1) // packet_size
+        self.assertEqual(self.acked[1], full - 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
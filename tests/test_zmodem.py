@@ -0,0 +1,149 @@
+'''
+acomms_zmodem over the channel simulator, with frame losses forced at the receiving modem.
+
+The receiver only listens, so the whole transfer runs on the simulator's virtual clock, on the test's thread.  A
+transfer has to arrive intact however it is interrupted: a lost frame costs a rewind to the offset in the receiver's
+ZRPOS, a receiver that restarts answers the next ZFILE from its journal, and a packet that waited too long in the
+transmit queue is withdrawn rather than sent after the one that replaced it.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from acomms.acomms_xmodem import acomms_zmodem
+from acomms.channelsimulator import ChannelSimulator
+from acomms.messageparams import DataFrame
+from acomms.txscheduler import PRIORITY_HIGH
+from acomms.unifiedlog import UnifiedLog
+
+
+class ZmodemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.src = os.path.join(self.directory, 'src')
+        self.dst = os.path.join(self.directory, 'dst')
+        os.makedirs(self.src)
+        os.makedirs(self.dst)
+        unified_log = UnifiedLog(log_path=self.directory, rootname='test_zmodem')
+        self.addCleanup(unified_log._log.removeHandler, unified_log._file_handler)
+        self.addCleanup(unified_log._file_handler.close)
+        self.sim = ChannelSimulator(unified_log=unified_log, seed=1)
+        self.sender = self.sim.add_node(1, (0, 0, 10))
+        self.receiver = self.sim.add_node(2, (1000, 0, 10))
+
+        # (frame type, offset) of the first frame of each packet the receiver hears from the sender.
+        self.heard = []
+        self.receiver.modem.packet_listeners.append(self.record)
+
+        # Frame numbers to lose in each data packet the receiver hears, in order.
+        self.losses = []
+        hear = self.receiver.core.hear
+
+        def lossy_hear(kind, args, bad_frames=(), snr=15.0):
+            if kind == 'data':
+                bad_frames = set(bad_frames) | set(self.losses.pop(0) if self.losses else ())
+            return hear(kind, args, bad_frames, snr)
+        self.receiver.core.hear = lossy_hear
+
+        self.data = b''.join(b"%d,2024-05-01T12:00:00,41.52%03d,-70.67\n" % (i, i % 1000) for i in range(150))
+        self.path = os.path.join(self.src, 'log.csv')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def record(self, packet):
+        if packet.src == 1 and packet.frames and not packet.frames[0].bad_crc:
+            frame_type, transfer_id, offset = acomms_zmodem.HEADER.unpack_from(bytes(packet.frames[0].data))
+            self.heard.append((frame_type, offset))
+
+    def zmodems(self):
+        tx = acomms_zmodem(self.sender.modem, 2, 1, unified_log=self.sim.unified_log)
+        rx = acomms_zmodem(self.receiver.modem, 1, 1, unified_log=self.sim.unified_log)
+        return tx, rx
+
+    def received(self):
+        with open(os.path.join(self.dst, 'log.csv'), 'rb') as f:
+            return f.read()
+
+    def test_clean_link(self):
+        tx, rx = self.zmodems()
+        done = rx.listen(self.dst)
+        self.assertTrue(tx.send(self.path, timeout=3600))
+        self.sim.run_for(30)
+        rx.stop_listening()
+        self.assertEqual(done.result(), os.path.join(self.dst, 'log.csv'))
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual(os.listdir(self.dst), ['log.csv'])
+        self.assertEqual((tx.stats['rewinds'], tx.stats['resumed_at'], tx.stats['bytes']), (0, 0, len(self.data)))
+
+        # ZFILE, then data in order, then ZEOF.
+        frame_types = [frame_type for frame_type, offset in self.heard]
+        self.assertEqual((frame_types[0], frame_types[-1]), (acomms_zmodem.ZFILE, acomms_zmodem.ZEOF))
+        offsets = [offset for frame_type, offset in self.heard[1:-1]]
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertEqual(len(set(offsets)), len(offsets))
+
+    def test_lost_frame_rewinds(self):
+        tx, rx = self.zmodems()
+        payload_size = tx.payload_size
+        # The ZFILE gets through, and then the second frame of the second data packet is lost.
+        self.losses = [(), (), {2}]
+        done = rx.listen(self.dst)
+        self.assertTrue(tx.send(self.path, timeout=3600))
+        self.sim.run_for(30)
+        rx.stop_listening()
+        self.assertEqual(done.result(), os.path.join(self.dst, 'log.csv'))
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual(tx.stats['rewinds'], 1)
+
+        # Up to the report, the sender carried on past the lost frame (the fifth), and then went back to it.
+        offsets = [offset for frame_type, offset in self.heard if frame_type == tx.ZDATA]
+        step = tx.rate.numframes * payload_size
+        lost = 4 * payload_size
+        self.assertEqual(offsets, list(range(0, tx.report_interval * step, step)) +
+                         list(range(lost, len(self.data), step)))
+
+    def test_receiver_restart_resumes_from_journal(self):
+        tx, rx = self.zmodems()
+        rx.listen(self.dst)
+        # The receiver goes away once it has a few packets.
+        self.sim.clock.call_later(120, rx.stop_listening)
+        self.assertFalse(tx.send(self.path, retry=2, timeout=600))
+        partial = self.received()
+        self.assertTrue(0 < len(partial) < len(self.data))
+        self.assertEqual(partial, self.data[:len(partial)])
+        self.assertEqual(sorted(os.listdir(self.dst)), ['log.csv', 'log.csv.acj'])
+
+        tx, rx = self.zmodems()
+        done = rx.listen(self.dst)
+        self.assertTrue(tx.send(self.path, timeout=3600))
+        self.sim.run_for(30)
+        rx.stop_listening()
+        self.assertEqual(done.result(), os.path.join(self.dst, 'log.csv'))
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual(os.listdir(self.dst), ['log.csv'])
+        # Only what the first receiver didn't have was sent again.
+        self.assertEqual(tx.stats['resumed_at'], len(partial))
+        self.assertEqual(tx.stats['bytes'], len(self.data) - len(partial))
+
+    def test_stale_queued_packet_is_withdrawn(self):
+        tx, rx = self.zmodems()
+        # Enough urgent traffic to another node that the first ZFILE is still queued when the sender gives up on it.
+        for i in range(6):
+            frames = [DataFrame(1, 3, False, num, b'\0' * 64) for num in range(1, 4)]
+            self.sender.modem.send_packet_frames(3, 1, frames, priority=PRIORITY_HIGH)
+        done = rx.listen(self.dst)
+        self.assertTrue(tx.send(self.path, timeout=3600))
+        self.sim.run_for(30)
+        rx.stop_listening()
+        self.assertEqual(done.result(), os.path.join(self.dst, 'log.csv'))
+        self.assertEqual(self.received(), self.data)
+        # Only the ZFILE that replaced it went out.
+        self.assertEqual([frame_type for frame_type, offset in self.heard].count(tx.ZFILE), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()